@@ -0,0 +1,209 @@
+"""Offline load test for the API against the in-process fakes in fakes.py
+
+Runs upload (single and multi-chunk), download, list, search and share
+scenarios concurrently through the ASGI app (no network, no Supabase or
+Google accounts) and reports throughput, p50/p99 latency and peak RSS per
+scenario.
+
+    python benchmark.py --requests 200 --concurrency 16
+    python benchmark.py --latency-ms 20 --error-rate 0.01 --json bench.json
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.25   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+SCENARIOS = ("upload", "upload-multichunk", "download", "list", "search", "share")
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Drive's smallest resumable chunk, so multi-chunk uploads stay cheap
+
+def configure_environment(jwt_secret: str):
+    """Settings main.py reads at import time; none of them reach the network"""
+    from cryptography.fernet import Fernet
+    os.environ.update({
+        "SUPABASE_URL": "http://supabase.invalid",
+        "SUPABASE_KEY": "benchmark.anon.key",  # only has to look like a JWT
+        "SUPABASE_JWT_SECRET": jwt_secret,
+        "ENCRYPTION_KEYS": Fernet.generate_key().decode(),
+        "CLEANUP_ENABLED": "false",
+        "CONTENT_CACHE_DIR": "",
+        "UPLOAD_CHUNK_SIZE": str(UPLOAD_CHUNK_SIZE),
+        "UPLOAD_JOB_DIR": tempfile.mkdtemp(prefix="benchmark-upload-jobs-"),
+        "METRICS_TOKEN": "",
+    })
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def mint_token(user_id: str, secret: str) -> str:
+    header = b64url(json.dumps({"alg": "HS256", "typ": "JWT"}).encode())
+    payload = b64url(json.dumps({"sub": user_id, "aud": "authenticated", "exp": int(time.time()) + 3600}).encode())
+    signature = hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
+    return f"{header}.{payload}.{b64url(signature)}"
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else 0.0
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def seed(fakes: dict, users: int, files_per_user: int, file_size: int, rng: random.Random) -> list:
+    """Create users with a shared-drive folder and some uploaded files; returns user fixtures"""
+    supabase, google = fakes["supabase_client"], fakes["google"]
+    fixtures = []
+    for index in range(users):
+        user_id = f"00000000-0000-4000-8000-{index:012d}"
+        folder = google.add_file(f"user{index}@example.com", parents=["root"], mime_type="application/vnd.google-apps.folder")
+        supabase.auth.admin.update_user_by_id(user_id, {"app_metadata": {"shared_folder_id": folder["id"]}})
+        file_ids = []
+        for number in range(files_per_user):
+            drive_file = google.add_file(f"quarterly-report-{number}.bin", rng.randbytes(file_size), parents=[folder["id"]])
+            row = supabase.table("files").insert({
+                "user_drive_id": None,
+                "drive_file_id": drive_file["id"],
+                "name": drive_file["name"],
+                "type": drive_file["mimeType"],
+                "size": int(drive_file["size"]),
+                "folder_id": folder["id"],
+                "user_id": user_id
+            }).execute().data[0]
+            file_ids.append(row["id"])
+        fixtures.append({"user_id": user_id, "folder_id": folder["id"], "file_ids": file_ids})
+    return fixtures
+
+async def run_scenario(client, name: str, fixtures: list, tokens: dict, requests: int, concurrency: int, upload_size: int, multichunk_size: int, rng: random.Random) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(number: int):
+        nonlocal errors
+        fixture = fixtures[number % len(fixtures)]
+        headers = {"Authorization": f"Bearer {tokens[fixture['user_id']]}"}
+        file_id = rng.choice(fixture["file_ids"])
+        async with slots:
+            started = time.perf_counter()
+            try:
+                response = await send(name, fixture, headers, file_id, number)
+                failed = response.status_code >= 400
+            except Exception:
+                # Injected faults can break a streamed download after the headers went out
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            if failed:
+                errors += 1
+
+    async def send(name: str, fixture: dict, headers: dict, file_id: str, number: int):
+        if name == "upload":
+            return await client.post("/shared/upload", headers=headers, files={"file": (f"upload-{number}.bin", rng.randbytes(upload_size))})
+        if name == "upload-multichunk":
+            # Goes through the 308 Resume Incomplete replies between chunks
+            return await client.post("/shared/upload", headers=headers, files={"file": (f"multichunk-{number}.bin", rng.randbytes(multichunk_size))})
+        if name == "download":
+            return await client.get(f"/shared/download/{file_id}", headers=headers)
+        if name == "list":
+            return await client.get("/shared/list", headers=headers, params={"folder_id": fixture["folder_id"]})
+        if name == "search":
+            return await client.get("/search", headers=headers, params={"q": "quarterly rep"})
+        return await client.post(f"/shared/share/{file_id}", headers=headers, json={"expires_in_days": 7})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(number) for number in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if result["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']}ms vs baseline {previous['p99_ms']}ms")
+        if result["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput_rps']}/s vs baseline {previous['throughput_rps']}/s")
+        if result["errors"] > previous["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors vs baseline {previous['errors']}")
+    return regressions
+
+async def main_async(args) -> dict:
+    import httpx
+    import main
+    from fakes import FaultProfile, fake_backends
+
+    google_faults, supabase_faults = FaultProfile(seed=args.seed), FaultProfile(seed=args.seed)
+    fakes = fake_backends(supabase_faults, google_faults)
+    main.configure_backends(**{key: value for key, value in fakes.items() if key != "google"})
+    # Measure the service, not the per-client request limits
+    main.limiter.enabled = False
+
+    rng = random.Random(args.seed)
+    fixtures = seed(fakes, args.users, args.files, args.file_size, rng)
+    tokens = {fixture["user_id"]: mint_token(fixture["user_id"], args.jwt_secret) for fixture in fixtures}
+    # Faults only start once the fixtures are in place
+    for faults in (google_faults, supabase_faults):
+        faults.latency, faults.jitter, faults.error_rate = args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for name in args.scenarios:
+            results[name] = await run_scenario(client, name, fixtures, tokens, args.requests, args.concurrency, args.upload_size, args.multichunk_size, rng)
+            print(f"{name:<17} {results[name]['requests']:>6} req  {results[name]['errors']:>4} err  "
+                  f"{results[name]['throughput_rps']:>9}/s  p50 {results[name]['p50_ms']:>8}ms  "
+                  f"p99 {results[name]['p99_ms']:>8}ms  rss {results[name]['peak_rss_mb']:>7}MB")
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--files", type=int, default=50, help="seeded files per user")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes per seeded file")
+    parser.add_argument("--upload-size", type=int, default=256 * 1024, help="bytes per uploaded file")
+    parser.add_argument("--multichunk-size", type=int, default=4 * UPLOAD_CHUNK_SIZE + 1, help="bytes per upload-multichunk file")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="base latency of every fake upstream call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against the baseline")
+    args = parser.parse_args(argv)
+    args.jwt_secret = "benchmark-secret"
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_environment(args.jwt_secret)
+    results = asyncio.run(main_async(args))
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,600 @@
+"""In-process stand-ins for Supabase, Google OAuth and the Drive v3 API
+
+They are installed with main.configure_backends(**fake_backends(...)) and
+serve the same calls main.py makes against the real services, with
+configurable latency and error rates. Used by benchmark.py.
+"""
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime
+from email.parser import BytesParser
+from types import SimpleNamespace
+from typing import Optional
+
+import google_auth_httplib2
+import httplib2
+import httpx
+from google.oauth2.credentials import Credentials as UserCredentials
+
+class FaultProfile:
+    """Latency and failure injection shared by all fakes of one backend"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self) -> bool:
+        """Sleep for one call's latency and return whether the call should fail"""
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter) if self.latency or self.jitter else 0
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+def utc_now() -> str:
+    return datetime.utcnow().isoformat()
+
+def decode_jwt_subject(token: str) -> Optional[str]:
+    try:
+        payload = token.split(".")[1]
+        return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("sub")
+    except (IndexError, ValueError):
+        return None
+
+# Supabase
+class FakeResponse:
+    def __init__(self, data: list, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    """Chainable subset of the postgrest-py request builder over in-memory rows"""
+
+    HTTP_METHODS = {"select": "GET", "insert": "POST", "upsert": "POST", "update": "PATCH", "delete": "DELETE"}
+
+    def __init__(self, database: "FakeSupabase", table: str):
+        self.database = database
+        self.table = table
+        self.path = f"/{table}"
+        self.action = "select"
+        self.columns = "*"
+        self.count_mode = None
+        self.payload = None
+        self.on_conflict = ""
+        self.filters = []
+        self.ordering = []
+        self.row_limit = None
+        self.row_offset = 0
+        self._negate = False
+
+    @property
+    def http_method(self) -> str:
+        return self.HTTP_METHODS[self.action]
+
+    def select(self, *columns, count: Optional[str] = None):
+        self.columns = ",".join(columns) or "*"
+        self.count_mode = count
+        return self
+
+    def insert(self, rows):
+        self.action, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict: str = ""):
+        self.action, self.payload, self.on_conflict = "upsert", rows, on_conflict
+        return self
+
+    def update(self, values: dict):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def _filter(self, predicate):
+        negate, self._negate = self._negate, False
+        self.filters.append((lambda row: not predicate(row)) if negate else predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and str(row.get(column)) == str(value))
+
+    def neq(self, column, value):
+        return self._filter(lambda row: str(row.get(column)) != str(value))
+
+    def in_(self, column, values):
+        wanted = {str(value) for value in values}
+        return self._filter(lambda row: str(row.get(column)) in wanted)
+
+    def is_(self, column, value):
+        expected = {"null": None, "true": True, "false": False}[str(value).lower()]
+        return self._filter(lambda row: row.get(column) is expected)
+
+    def lt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] < value)
+
+    def lte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] <= value)
+
+    def gt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] > value)
+
+    def gte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] >= value)
+
+    def contains(self, column, values):
+        return self._filter(lambda row: set(values) <= set(row.get(column) or []))
+
+    def ilike(self, column, pattern):
+        regex = re.compile("^" + re.escape(pattern).replace("%", ".*").replace("_", ".") + "$", re.IGNORECASE)
+        return self._filter(lambda row: bool(regex.match(str(row.get(column) or ""))))
+
+    def order(self, column, desc: bool = False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count: int):
+        self.row_limit = count
+        return self
+
+    def range(self, start: int, end: int):
+        self.row_offset, self.row_limit = start, end - start + 1
+        return self
+
+    def _project(self, row: dict) -> dict:
+        if self.columns.strip() == "*":
+            return dict(row)
+        return {column.strip(): row.get(column.strip()) for column in self.columns.split(",")}
+
+    def execute(self) -> FakeResponse:
+        if self.database.faults.apply():
+            raise httpx.ConnectError("Injected Supabase failure")
+        with self.database.lock:
+            return getattr(self, f"_execute_{self.action}")(self.database.tables.setdefault(self.table, []))
+
+    def _matching(self, rows: list) -> list:
+        return [row for row in rows if all(predicate(row) for predicate in self.filters)]
+
+    def _execute_select(self, rows: list) -> FakeResponse:
+        matched = self._matching(rows)
+        for column, desc in reversed(self.ordering):
+            matched.sort(key=lambda row: (row.get(column) is None, row.get(column) or ""), reverse=desc)
+        total = len(matched)
+        end = None if self.row_limit is None else self.row_offset + self.row_limit
+        page = matched[self.row_offset:end]
+        return FakeResponse([self._project(row) for row in page], total if self.count_mode else None)
+
+    def _new_row(self, values: dict) -> dict:
+        row = {"id": str(uuid.uuid4()), "created_at": utc_now()}
+        row.update(values)
+        return row
+
+    def _execute_insert(self, rows: list) -> FakeResponse:
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        inserted = [self._new_row(values) for values in payload]
+        rows.extend(inserted)
+        return FakeResponse([dict(row) for row in inserted])
+
+    def _execute_upsert(self, rows: list) -> FakeResponse:
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        keys = [key.strip() for key in (self.on_conflict or "id").split(",")]
+        written = []
+        for values in payload:
+            existing = next((row for row in rows if all(row.get(key) == values.get(key) for key in keys)), None)
+            if existing:
+                existing.update(values)
+            else:
+                existing = self._new_row(values)
+                rows.append(existing)
+            written.append(dict(existing))
+        return FakeResponse(written)
+
+    def _execute_update(self, rows: list) -> FakeResponse:
+        matched = self._matching(rows)
+        for row in matched:
+            row.update(self.payload)
+        return FakeResponse([dict(row) for row in matched])
+
+    def _execute_delete(self, rows: list) -> FakeResponse:
+        matched = self._matching(rows)
+        rows[:] = [row for row in rows if row not in matched]
+        return FakeResponse([dict(row) for row in matched])
+
+class FakeRpc:
+    def __init__(self, database: "FakeSupabase", function: str, params: dict):
+        self.database = database
+        self.function = function
+        self.params = params
+        self.path = f"/rpc/{function}"
+        self.http_method = "POST"
+
+    def execute(self) -> FakeResponse:
+        if self.database.faults.apply():
+            raise httpx.ConnectError("Injected Supabase failure")
+        with self.database.lock:
+            return FakeResponse(getattr(self.database, f"rpc_{self.function}")(**self.params))
+
+class FakeAuthAdmin:
+    def __init__(self, database: "FakeSupabase"):
+        self.database = database
+
+    def get_user_by_id(self, user_id: str):
+        with self.database.lock:
+            user = self.database.users.setdefault(user_id, {"email": f"{user_id}@example.com", "app_metadata": {}})
+            return SimpleNamespace(user=SimpleNamespace(id=user_id, email=user["email"], app_metadata=dict(user["app_metadata"])))
+
+    def update_user_by_id(self, user_id: str, attributes: dict):
+        with self.database.lock:
+            user = self.database.users.setdefault(user_id, {"email": f"{user_id}@example.com", "app_metadata": {}})
+            user["app_metadata"] = dict(attributes.get("app_metadata", user["app_metadata"]))
+
+class FakeAuth:
+    def __init__(self, database: "FakeSupabase"):
+        self.admin = FakeAuthAdmin(database)
+
+    def get_user(self, token: str):
+        user_id = decode_jwt_subject(token)
+        return SimpleNamespace(user=SimpleNamespace(id=user_id) if user_id else None)
+
+class FakeSupabase:
+    """Tables, RPC functions and auth of a Supabase project, held in memory"""
+
+    def __init__(self, faults: Optional[FaultProfile] = None):
+        self.faults = faults or FaultProfile()
+        self.tables = {}
+        self.users = {}
+        self.lock = threading.RLock()
+        self.auth = FakeAuth(self)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, function: str, params: dict) -> FakeRpc:
+        return FakeRpc(self, function, params)
+
+    def rpc_search_user_files(self, p_user_id, p_query, p_tsquery, p_limit=20, p_offset=0, p_type=None,
+                              p_min_size=None, p_max_size=None, p_created_after=None, p_created_before=None):
+        terms = [term.rstrip(":*") for term in p_tsquery.split(" & ")]
+        matched = []
+        for row in self.tables.get("files", []):
+            name = (row.get("name") or "").lower()
+            words = re.split(r"[\W_]+", name)
+            if str(row.get("user_id")) != str(p_user_id):
+                continue
+            if not (all(any(word.startswith(term) for word in words) for term in terms) or p_query.lower() in name):
+                continue
+            if p_type and not (row.get("type") or "").startswith(p_type):
+                continue
+            if p_min_size is not None and (row.get("size") or 0) < p_min_size:
+                continue
+            if p_max_size is not None and (row.get("size") or 0) > p_max_size:
+                continue
+            if p_created_after and row.get("created_at", "") < p_created_after:
+                continue
+            if p_created_before and row.get("created_at", "") >= p_created_before:
+                continue
+            matched.append(dict(row))
+        matched.sort(key=lambda row: row.get("created_at", ""), reverse=True)
+        return matched[p_offset:p_offset + p_limit]
+
+    def rpc_record_file_shares(self, p_user_drive_id, p_shares, p_link_expires_at=None, p_shared_by=None, p_shared_at=None):
+        shares = {share["drive_file_id"]: share for share in p_shares}
+        for row in self.tables.get("files", []):
+            share = shares.get(row.get("drive_file_id"))
+            if share and str(row.get("user_drive_id")) == str(p_user_drive_id):
+                row.update({
+                    "shared_link": share["shared_link"],
+                    "permission_id": share["permission_id"],
+                    "share_nonce": None,
+                    "link_expires_at": p_link_expires_at,
+                    "shared_by": p_shared_by,
+                    "shared_at": p_shared_at or utc_now()
+                })
+        return []
+
+# Google Drive and OAuth
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+DRIVE_HOSTS = ("www.googleapis.com", "oauth2.googleapis.com")
+
+def drive_error(status: int, reason: str, message: str):
+    return status, {"content-type": "application/json"}, json.dumps(
+        {"error": {"code": status, "message": message, "errors": [{"reason": reason, "message": message}]}}
+    ).encode()
+
+def json_response(payload: dict, status: int = 200):
+    return status, {"content-type": "application/json"}, json.dumps(payload).encode()
+
+class FakeGoogle:
+    """Drive v3 files/permissions/changes/media, batch and upload endpoints plus the OAuth token endpoint"""
+
+    QUERY_CLAUSE = re.compile(r"^(?:'(?P<parent>[^']*)' in parents|(?P<field>name|mimeType)\s*(?P<op>=|!=|contains)\s*'(?P<value>[^']*)'|trashed\s*=\s*(?P<trashed>true|false))$")
+
+    def __init__(self, faults: Optional[FaultProfile] = None, storage_limit: Optional[int] = None):
+        self.faults = faults or FaultProfile()
+        self.storage_limit = storage_limit  # None is an account without a quota
+        self.files = {}
+        self.contents = {}
+        self.upload_sessions = {}
+        self.lock = threading.RLock()
+
+    def add_file(self, name: str, content: bytes = b"", parents: Optional[list] = None, mime_type: str = "application/octet-stream") -> dict:
+        with self.lock:
+            metadata = {
+                "id": uuid.uuid4().hex,
+                "name": name,
+                "mimeType": mime_type,
+                "parents": parents or ["root"],
+                "modifiedTime": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+                "trashed": False,
+                "permissions": []
+            }
+            if mime_type != FOLDER_MIME_TYPE:
+                metadata["size"] = str(len(content))
+                metadata["md5Checksum"] = hashlib.md5(content).hexdigest()
+                self.contents[metadata["id"]] = content
+            self.files[metadata["id"]] = metadata
+            return self.public(metadata)
+
+    @staticmethod
+    def public(metadata: dict) -> dict:
+        return {key: value for key, value in metadata.items() if key not in ("permissions", "trashed")}
+
+    def handle(self, method: str, uri: str, body, headers: dict):
+        """Serve one HTTP call, returning (status, headers, content)"""
+        if self.faults.apply():
+            return drive_error(503, "backendError", "Injected Drive failure")
+        parsed = urllib.parse.urlsplit(uri)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        if hasattr(body, "read"):
+            # Resumable uploads hand over a stream slice of the spooled file
+            body = body.read()
+        body = body.encode() if isinstance(body, str) else (body or b"")
+        with self.lock:
+            if parsed.netloc == "oauth2.googleapis.com":
+                return self.token(body)
+            if parsed.path == "/batch/drive/v3":
+                return self.batch(body, headers)
+            if parsed.path.startswith("/upload/drive/v3/files"):
+                return self.upload(method, query, body, headers)
+            return self.route(method, parsed.path, query, body, headers)
+
+    def token(self, body: bytes):
+        return json_response({"access_token": f"fake-{uuid.uuid4().hex}", "expires_in": 3600, "token_type": "Bearer", "scope": "https://www.googleapis.com/auth/drive"})
+
+    def route(self, method: str, path: str, query: dict, body: bytes, headers: dict):
+        segments = path.strip("/").split("/")[2:]  # drop drive/v3
+        payload = json.loads(body) if body else {}
+        if segments == ["files"]:
+            return self.list_files(query) if method == "GET" else json_response(self.public(self.create(payload)))
+        if segments == ["about"]:
+            usage = sum(len(content) for content in self.contents.values())
+            quota = {"usage": str(usage), **({"limit": str(self.storage_limit)} if self.storage_limit is not None else {})}
+            return json_response({"storageQuota": quota})
+        if segments == ["changes", "startPageToken"]:
+            return json_response({"startPageToken": "1"})
+        if segments == ["changes"]:
+            return json_response({"changes": [], "newStartPageToken": query.get("pageToken", "1")})
+        if segments[0] != "files" or len(segments) < 2:
+            return drive_error(404, "notFound", f"Unknown path {path}")
+
+        file_id = segments[1]
+        if file_id == "root":
+            return json_response({"id": "root", "name": "My Drive", "mimeType": FOLDER_MIME_TYPE})
+        metadata = self.files.get(file_id)
+        if metadata is None or metadata["trashed"]:
+            return drive_error(404, "notFound", f"File not found: {file_id}")
+
+        if len(segments) == 2:
+            if method == "GET" and query.get("alt") == "media":
+                return self.media(file_id, headers)
+            if method == "GET":
+                return json_response(self.public(metadata))
+            if method == "DELETE":
+                del self.files[file_id]
+                self.contents.pop(file_id, None)
+                return 204, {}, b""
+            if method == "PATCH":
+                metadata.update({key: value for key, value in payload.items() if key in ("name", "mimeType")})
+                return json_response(self.public(metadata))
+        if segments[2:] == ["copy"] and method == "POST":
+            copy = self.add_file(payload.get("name", metadata["name"]), self.contents.get(file_id, b""), payload.get("parents", metadata["parents"]), metadata["mimeType"])
+            return json_response(copy)
+        if segments[2:3] == ["permissions"]:
+            if method == "POST" and len(segments) == 3:
+                permission_id = "anyoneWithLink" if payload.get("type") == "anyone" else uuid.uuid4().hex
+                metadata["permissions"].append({"id": permission_id, **payload})
+                return json_response({"id": permission_id})
+            if method == "DELETE" and len(segments) == 4:
+                before = len(metadata["permissions"])
+                metadata["permissions"] = [item for item in metadata["permissions"] if item["id"] != segments[3]]
+                if len(metadata["permissions"]) == before:
+                    return drive_error(404, "notFound", f"Permission not found: {segments[3]}")
+                return 204, {}, b""
+        return drive_error(400, "badRequest", f"Unsupported call {method} {path}")
+
+    def create(self, metadata: dict, content: bytes = b"") -> dict:
+        created = self.files[self.add_file(
+            metadata.get("name", "Untitled"), content, metadata.get("parents"),
+            metadata.get("mimeType", "application/octet-stream")
+        )["id"]]
+        if metadata.get("appProperties"):
+            created["appProperties"] = dict(metadata["appProperties"])
+        return created
+
+    def matches(self, metadata: dict, clauses: list) -> bool:
+        for clause in clauses:
+            if clause["parent"] is not None and clause["parent"] not in metadata["parents"]:
+                return False
+            if clause["trashed"] is not None and metadata["trashed"] != (clause["trashed"] == "true"):
+                return False
+            if clause["field"]:
+                value = metadata.get(clause["field"], "")
+                if clause["op"] == "=" and value != clause["value"]:
+                    return False
+                if clause["op"] == "!=" and value == clause["value"]:
+                    return False
+                if clause["op"] == "contains" and clause["value"].lower() not in value.lower():
+                    return False
+        return True
+
+    def list_files(self, query: dict):
+        clauses = []
+        for clause in filter(None, (part.strip() for part in re.split(r"\s+and\s+", query.get("q", "")))):
+            match = self.QUERY_CLAUSE.match(clause)
+            if match:
+                clauses.append(match.groupdict())
+        matched = [metadata for metadata in self.files.values() if self.matches(metadata, clauses)]
+        for order in reversed([part.strip() for part in query.get("orderBy", "name").split(",")]):
+            field, _, direction = order.partition(" ")
+            matched.sort(key=lambda metadata: metadata.get(field, ""), reverse=direction == "desc")
+        offset = int(query.get("pageToken") or 0)
+        page_size = int(query.get("pageSize") or 100)
+        page = {"files": [self.public(metadata) for metadata in matched[offset:offset + page_size]]}
+        if offset + page_size < len(matched):
+            page["nextPageToken"] = str(offset + page_size)
+        return json_response(page)
+
+    def media(self, file_id: str, headers: dict):
+        content = self.contents.get(file_id, b"")
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("range", headers.get("Range", "")))
+        if not match:
+            return 200, {"content-type": "application/octet-stream"}, content
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+        if start >= len(content):
+            return 416, {}, b""
+        return 206, {"content-range": f"bytes {start}-{end}/{len(content)}"}, content[start:end + 1]
+
+    def missing_parent(self, parents: list) -> Optional[str]:
+        return next((parent for parent in parents if parent != "root" and (parent not in self.files or self.files[parent]["trashed"])), None)
+
+    def upload(self, method: str, query: dict, body: bytes, headers: dict):
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        if method == "POST" and query.get("uploadType") == "resumable":
+            metadata = json.loads(body) if body else {}
+            missing = self.missing_parent(metadata.get("parents") or [])
+            if missing:
+                return drive_error(404, "notFound", f"File not found: {missing}")
+            session_id = uuid.uuid4().hex
+            self.upload_sessions[session_id] = {"metadata": metadata, "data": bytearray()}
+            location = f"https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&upload_id={session_id}"
+            return 200, {"location": location}, b""
+
+        session = self.upload_sessions.get(query.get("upload_id", ""))
+        if method != "PUT" or session is None:
+            return drive_error(404, "notFound", "Upload session not found")
+        match = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", headers.get("content-range", ""))
+        total = match.group(3) if match else str(len(body))
+        if match and match.group(1) is not None:
+            if int(match.group(1)) != len(session["data"]):
+                return drive_error(400, "badRequest", "Chunk does not continue the upload")
+            session["data"].extend(body)
+        elif not match:
+            session["data"].extend(body)
+        if total != "*" and len(session["data"]) >= int(total):
+            del self.upload_sessions[query["upload_id"]]
+            return json_response(self.public(self.create(session["metadata"], bytes(session["data"]))))
+        range_headers = {"range": f"bytes=0-{len(session['data']) - 1}"} if session["data"] else {}
+        return 308, range_headers, b""
+
+    def batch(self, body: bytes, headers: dict):
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        message = BytesParser().parsebytes(b"Content-Type: " + headers["content-type"].encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in message.get_payload():
+            request_lines, _, request_body = part.get_payload().partition("\r\n\r\n") if "\r\n\r\n" in part.get_payload() else part.get_payload().partition("\n\n")
+            request_line, *header_lines = request_lines.splitlines()
+            method, path, _ = request_line.split(" ", 2)
+            part_headers = dict(line.split(": ", 1) for line in header_lines if ": " in line)
+            parsed = urllib.parse.urlsplit(path)
+            status, response_headers, content = self.route(
+                method, parsed.path, dict(urllib.parse.parse_qsl(parsed.query)), request_body.encode(), part_headers
+            )
+            # Long request IDs arrive folded across header lines
+            content_id = " ".join(part["Content-ID"].split()).strip("<>")
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: application/json\r\n\r\n"
+                f"{content.decode()}\r\n"
+            )
+        return 200, {"content-type": f"multipart/mixed; boundary={boundary}"}, ("".join(parts) + f"--{boundary}--\r\n").encode()
+
+class FakeHttp:
+    """httplib2.Http stand-in routing Drive and OAuth calls to a FakeGoogle"""
+
+    def __init__(self, google: FakeGoogle):
+        self.google = google
+        # Same defaults as httplib2.Http, so a transport that forgets to drop
+        # 308 fails here just as it would against Drive
+        self.redirect_codes = httplib2.REDIRECT_CODES
+        self.safe_methods = list(httplib2.SAFE_METHODS)
+        self.follow_redirects = True
+        self.follow_all_redirects = False
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None, **kwargs):
+        status, response_headers, content = self.google.handle(method, uri, body, headers or {})
+        response = httplib2.Response({"status": status, **response_headers})
+        # httplib2's 3xx handling: safe methods, 303 and 308 are followed
+        if (self.follow_all_redirects or method in self.safe_methods or status in (303, 308)) \
+                and self.follow_redirects and status in self.redirect_codes:
+            if not redirections:
+                raise httplib2.RedirectLimit("Redirected more times than redirection_limit allows.", response, content)
+            if "location" not in response and status != 300:
+                raise httplib2.RedirectMissingLocation(
+                    "Redirected but the response is missing a Location: header.", response, content
+                )
+            if "location" in response:
+                location = urllib.parse.urljoin(uri, response["location"])
+                redirect_method = "GET" if status in (302, 303) else method
+                return self.request(location, redirect_method, body, headers, redirections - 1, connection_type)
+        return response, content
+
+    def close(self):
+        pass
+
+class FakeOAuthResponse:
+    def __init__(self, status: int, content: bytes):
+        self.status_code = status
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+def fake_backends(supabase_faults: Optional[FaultProfile] = None, google_faults: Optional[FaultProfile] = None) -> dict:
+    """Fresh fakes as keyword arguments for main.configure_backends()
+
+    The FakeSupabase and FakeGoogle instances are returned too (under
+    "supabase_client" and "google") so callers can seed data.
+    """
+    google = FakeGoogle(google_faults)
+
+    def oauth_post(url, data=None, **kwargs):
+        status, _, content = google.handle("POST", url, urllib.parse.urlencode(data or {}), {})
+        return FakeOAuthResponse(status, content)
+
+    return {
+        "supabase_client": FakeSupabase(supabase_faults),
+        "google": google,
+        "drive_http": lambda: FakeHttp(google),
+        "service_account_credentials": lambda: UserCredentials(token="fake-service-account"),
+        "oauth_request": lambda: google_auth_httplib2.Request(FakeHttp(google)),
+        "oauth_post": oauth_post,
+    }
@@ -1,30 +1,166 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
 from pydantic import BaseModel
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 import os
+import hmac
+import asyncio
+import functools
+import json
+import math
+import random
+import base64
+import urllib.parse
 import requests
-import io
 import re
+import secrets
+import sqlite3
+import sys
+import time
 import hashlib
+import mmap
+import shutil
+import socket
+import uuid
+import tempfile
+import zipfile
+import threading
+import bisect
+import httplib2
+import httpx
 
-from datetime import datetime, timedelta
-from typing import Optional
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from google.oauth2.service_account import Credentials
 from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2.credentials import Credentials as UserCredentials
-from cryptography.fernet import Fernet
+from google_auth_httplib2 import AuthorizedHttp
+from cryptography.exceptions import InvalidSignature
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.ec import ECDSA, SECP256R1, EllipticCurvePublicNumbers
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
+from limits.storage import Storage as LimitStorage
 
 # Rate limiting
-limiter = Limiter(key_func=get_remote_address)
+# Counters live in RATE_LIMIT_STORAGE_URI so every worker shares them:
+# memory:// (single process), sqlite:///path (all workers on one host) or
+# redis://host:port (many hosts, needs the redis package)
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+USER_REQUEST_BUDGET = os.getenv("USER_REQUEST_BUDGET", "600/minute")
+
+class SQLiteLimitStorage(LimitStorage):
+    """Fixed-window rate limit counters in a SQLite file shared by local workers"""
+
+    STORAGE_SCHEME = ["sqlite"]
+    PURGE_EVERY = 1000
+
+    def __init__(self, uri: str, **options):
+        super().__init__(uri, **options)
+        self.path = uri.split("://", 1)[1] or "rate_limits.db"
+        self._local = threading.local()
+        self._hits = 0
+        with self._connection() as connection:
+            connection.execute(
+                "create table if not exists rate_limits (key text primary key, value integer not null, expires_at real not null)"
+            )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("pragma journal_mode=wal")
+            connection.execute("pragma synchronous=normal")
+            self._local.connection = connection
+        return connection
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        connection = self._connection()
+        connection.execute("begin immediate")
+        try:
+            row = connection.execute("select value, expires_at from rate_limits where key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires_at = amount, now + expiry
+            else:
+                value, expires_at = row[0] + amount, (now + expiry if elastic_expiry else row[1])
+            connection.execute(
+                "insert or replace into rate_limits (key, value, expires_at) values (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            self._hits += 1
+            if self._hits % self.PURGE_EVERY == 0:
+                connection.execute("delete from rate_limits where expires_at <= ?", (now,))
+            connection.execute("commit")
+        except BaseException:
+            connection.execute("rollback")
+            raise
+        return value
+
+    def get(self, key: str) -> int:
+        row = self._connection().execute(
+            "select value from rate_limits where key = ? and expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._connection().execute("select expires_at from rate_limits where key = ?", (key,)).fetchone()
+        return row[0] if row and row[0] > time.time() else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute("select 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> Optional[int]:
+        return self._connection().execute("delete from rate_limits").rowcount
+
+    def clear(self, key: str) -> None:
+        self._connection().execute("delete from rate_limits where key = ?", (key,))
+
+def rate_limit_key(request: Request) -> str:
+    """Limit per user once the bearer token has been verified, otherwise per IP
+
+    Route limits are checked after dependencies run, so the verified token
+    cache already holds the caller's user ID for authenticated routes.
+    """
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+        # A peek, so every request is not counted again as a token cache hit or miss
+        user_id = verified_token_cache.peek(hashlib.sha256(token.encode()).hexdigest())
+        if user_id:
+            return f"user:{user_id}"
+    return f"ip:{get_remote_address(request)}"
+
+limiter = Limiter(key_func=rate_limit_key, storage_uri=RATE_LIMIT_STORAGE_URI)
+
+def weighted_limit(cost: int):
+    """Charge a route against the per-user budget shared by all weighted routes"""
+    return limiter.shared_limit(USER_REQUEST_BUDGET, scope="user-budget", cost=cost)
+
 app = FastAPI(title="Secure Cloud Platform API")
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -36,17 +172,44 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "HEAD", "DELETE"],
+    allow_headers=["Authorization", "Content-Type", "Upload-Offset"],
+    expose_headers=["Upload-Offset", "Upload-Length"],
 )
 
 # Security setup
 SUPABASE_URL = os.getenv("SUPABASE_URL", "your-supabase-url")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "your-supabase-key")
 
-# Generate encryption key
-ENCRYPTION_KEY = Fernet.generate_key().decode()
-cipher_suite = Fernet(ENCRYPTION_KEY.encode())
+# Token encryption key ring
+# Keys come from ENCRYPTION_KEYS (comma-separated, newest first) or from
+# ENCRYPTION_KEY_FILE (one per line, newest first). The first key encrypts,
+# every key decrypts. To rotate, put a new key first, restart all workers and
+# run `python main.py reencrypt-tokens`; then drop the old key.
+ENCRYPTION_KEY_FILE = os.getenv("ENCRYPTION_KEY_FILE", "encryption_keys")
+
+def load_encryption_keys() -> list:
+    configured = os.getenv("ENCRYPTION_KEYS", "")
+    if configured:
+        return [key.strip() for key in configured.split(",") if key.strip()]
+
+    if not os.path.exists(ENCRYPTION_KEY_FILE):
+        # First start: create the key file exactly once, even with many workers racing
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ENCRYPTION_KEY_FILE)))
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(Fernet.generate_key().decode() + "\n")
+        try:
+            os.link(temp_path, ENCRYPTION_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+
+    with open(ENCRYPTION_KEY_FILE) as key_file:
+        return [line.strip() for line in key_file if line.strip()]
+
+ENCRYPTION_KEYS = load_encryption_keys()
+cipher_suite = MultiFernet([Fernet(key.encode()) for key in ENCRYPTION_KEYS])
 
 GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", "your-client-id")
@@ -55,35 +218,809 @@ GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", "your-client-secret")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 security = HTTPBearer()
 
+# Backends
+# Every network client is created through these hooks, so the in-process
+# stand-ins in fakes.py (used by benchmark.py) can replace them wholesale
+backends = {
+    "drive_http": lambda: httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT),
+    "service_account_credentials": lambda: Credentials.from_service_account_file(GOOGLE_CREDENTIALS_PATH, scopes=DRIVE_SCOPES),
+    "oauth_request": GoogleRequest,
+    "oauth_post": requests.post,
+}
+
+def configure_backends(supabase_client=None, **hooks):
+    """Swap the Supabase client and/or backend hooks before serving requests"""
+    global supabase
+    unknown = set(hooks) - set(backends)
+    if unknown:
+        raise ValueError(f"Unknown backend hooks: {', '.join(sorted(unknown))}")
+    backends.update(hooks)
+    if supabase_client is not None:
+        supabase = supabase_client
+    # Drop anything built against the previous backends
+    drive_client_pool.reset()
+    user_folder_cache.clear()
+    verified_token_cache.clear()
+
+# Metrics
+# Minimal in-process registry rendered in the Prometheus text format. Values
+# are per process: with several workers, scrape each one (or label by pod).
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def format_labels(label_names: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """A named family of series keyed by a tuple of label values"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for labels, value in sorted(values):
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, labels: tuple, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register a function refreshing gauges from other state right before a scrape"""
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            collect()
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+http_requests = metrics.register(Counter("http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status")))
+http_latency = metrics.register(Histogram("http_request_duration_seconds", "HTTP request latency by route", ("route", "method")))
+http_in_flight = metrics.register(Gauge("http_requests_in_flight", "HTTP requests currently being served"))
+http_bytes = metrics.register(Counter("http_body_bytes_total", "Request and response body bytes by route", ("route", "direction")))
+upstream_calls = metrics.register(Counter("upstream_calls_total", "Calls to Supabase, Drive and OAuth by target and outcome", ("upstream", "target", "outcome")))
+upstream_latency = metrics.register(Histogram("upstream_call_duration_seconds", "Upstream call latency by target", ("upstream", "target")))
+upstream_in_flight = metrics.register(Gauge("upstream_calls_in_flight", "Blocking upstream calls running on the shared pool", ("upstream",)))
+cache_requests = metrics.register(Counter("cache_requests_total", "Cache lookups by cache and result", ("cache", "result")))
+
+class track_upstream:
+    """Context manager timing one upstream call; outcome is ok unless it raises"""
+
+    __slots__ = ("upstream", "target", "started", "outcome")
+
+    def __init__(self, upstream: str, target: str):
+        self.upstream = upstream
+        self.target = target
+        self.outcome = "ok"
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = "error" if exc_type else self.outcome
+        upstream_latency.observe((self.upstream, self.target), time.perf_counter() - self.started)
+        upstream_calls.inc((self.upstream, self.target, outcome))
+        return False
+
+class HTTPMetricsMiddleware:
+    """ASGI middleware recording per-route latency, status, body bytes and in-flight requests
+
+    Routes are labelled by their path template (scope["route"], set during
+    routing) so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        state = {"status": 500, "in": 0, "out": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["in"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["out"] += len(message.get("body", b""))
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            http_in_flight.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_latency.observe((route_path, method), time.perf_counter() - started)
+            http_requests.inc((route_path, method, str(state["status"])))
+            if state["in"]:
+                http_bytes.inc((route_path, "in"), state["in"])
+            if state["out"]:
+                http_bytes.inc((route_path, "out"), state["out"])
+
+app.add_middleware(HTTPMetricsMiddleware)
+
+# Caching
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, max_size: int, ttl: float, name: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if self.name:
+            cache_requests.inc((self.name, "miss" if entry is None else "hit"))
+        return default if entry is None else entry[0]
+
+    def peek(self, key, default=None):
+        """Look up a live entry without touching its LRU position or the cache metrics"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return default if entry is None or entry[1] <= time.monotonic() else entry[0]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into a single execution"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+# Upstream resilience
+# Transient Drive and Supabase failures are retried with jittered exponential
+# backoff, every Drive call or stream draws from a per-drive token bucket, and
+# a circuit breaker per upstream fails fast with 503 + Retry-After while it is
+# unhealthy
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "10"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+# Drive allows 12,000 queries per minute per user; the service account is one user
+DRIVE_BUDGET_RATE = float(os.getenv("DRIVE_BUDGET_RATE", "200"))  # calls per second per drive
+DRIVE_BUDGET_BURST = float(os.getenv("DRIVE_BUDGET_BURST", "200"))
+DRIVE_BUDGET_MAX_WAIT = float(os.getenv("DRIVE_BUDGET_MAX_WAIT", "2"))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+DRIVE_RATE_LIMIT_REASONS = {"userRateLimitExceeded", "rateLimitExceeded"}
+# PostgREST connection failures and gateway errors in front of it
+SUPABASE_OUTAGE_CODES = {"PGRST000", "PGRST001", "PGRST002", "502", "503", "504"}
+
+class UpstreamUnavailable(HTTPException):
+    """An upstream is failing or over budget; the client should retry later"""
+
+    def __init__(self, upstream: str, retry_after: float, status_code: int = 503):
+        super().__init__(
+            status_code=status_code,
+            detail=f"{upstream} is temporarily unavailable, retry later",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+        self.upstream = upstream
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than a server's Retry-After"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return min(float(value), RETRY_MAX_DELAY) if value else None
+    except ValueError:
+        return None
+
+def drive_error_reason(content) -> Optional[str]:
+    try:
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (ValueError, TypeError, KeyError, IndexError):
+        return None
+
+def is_retryable_status(status: int, content=b"") -> bool:
+    """Drive answered with a rate limit or a server error"""
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and drive_error_reason(content) in DRIVE_RATE_LIMIT_REASONS
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether a failed Drive call may succeed if repeated"""
+    if isinstance(error, HttpError):
+        return is_retryable_status(error.resp.status, error.content)
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+def is_supabase_outage(error: Exception) -> bool:
+    if isinstance(error, APIError):
+        return str(error.code) in SUPABASE_OUTAGE_CODES
+    return isinstance(error, httpx.TransportError)
+
+def is_retryable_supabase_error(error: Exception, method: str) -> bool:
+    # Connect failures never reached PostgREST; other transport errors are
+    # only safe to repeat for reads
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    if isinstance(error, httpx.TransportError):
+        return method in ("GET", "HEAD")
+    return is_supabase_outage(error)
+
+class CircuitBreaker:
+    """Fail fast after consecutive upstream failures
+
+    After failure_threshold failures in a row the circuit opens and calls
+    are rejected for reset_timeout seconds. Then a single probe call is let
+    through, and its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._probing else "open"
+
+    def before_call(self) -> bool:
+        """Reject the call while open; returns True when it is the half-open probe"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise UpstreamUnavailable(self.name, max(remaining, 1))
+            self._probing = True
+            return True
+
+    def abandon_probe(self):
+        """Free the probe slot when the probe ended without an upstream outcome"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+upstream_breakers = {
+    name: CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    for name in ("drive", "supabase")
+}
+
+circuit_state = metrics.register(Gauge("upstream_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open", ("upstream",)))
+
+@metrics.collector
+def collect_circuit_states():
+    for name, breaker in upstream_breakers.items():
+        circuit_state.set((name,), {"closed": 0, "half-open": 1, "open": 2}[breaker.state])
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at rate tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """Take a token and return 0, or return the seconds until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+drive_budgets = TTLCache(4096, 3600)
+drive_budgets_lock = threading.Lock()
+
+def wait_for_drive_budget(budget_key: str):
+    """Block until the drive's budget allows another call, or reject with 429"""
+    with drive_budgets_lock:
+        bucket = drive_budgets.get(budget_key)
+        if bucket is None:
+            bucket = TokenBucket(DRIVE_BUDGET_RATE, DRIVE_BUDGET_BURST)
+            drive_budgets.set(budget_key, bucket)
+
+    waited = 0.0
+    while True:
+        wait = bucket.take()
+        if not wait:
+            return
+        if waited + wait > DRIVE_BUDGET_MAX_WAIT:
+            raise UpstreamUnavailable("drive", wait, status_code=429)
+        time.sleep(wait)
+        waited += wait
+
+# Blocking I/O execution
+# supabase-py, googleapiclient and requests are synchronous, so every call is
+# pushed onto a bounded thread pool with a concurrency cap per upstream
+UPSTREAM_CONCURRENCY = {
+    "supabase": int(os.getenv("SUPABASE_MAX_CONCURRENCY", "32")),
+    "drive": int(os.getenv("DRIVE_MAX_CONCURRENCY", "64")),
+    "oauth": int(os.getenv("OAUTH_MAX_CONCURRENCY", "8")),
+    "disk": int(os.getenv("DISK_MAX_CONCURRENCY", "8")),
+}
+blocking_executor = ThreadPoolExecutor(
+    max_workers=sum(UPSTREAM_CONCURRENCY.values()),
+    thread_name_prefix="upstream"
+)
+upstream_semaphores = {name: asyncio.Semaphore(limit) for name, limit in UPSTREAM_CONCURRENCY.items()}
+
+async def run_blocking(upstream: str, func, *args, **kwargs):
+    """Run a blocking call in the shared pool under its upstream's concurrency limit"""
+    async with upstream_semaphores[upstream]:
+        loop = asyncio.get_running_loop()
+        upstream_in_flight.inc((upstream,))
+        try:
+            return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+        finally:
+            upstream_in_flight.dec((upstream,))
+
+def execute_supabase(query):
+    """Execute a PostgREST query on this thread, retrying transient failures behind the breaker
+
+    For code already running on the blocking pool; async code awaits
+    run_supabase instead.
+    """
+    breaker = upstream_breakers["supabase"]
+    method = getattr(query, "http_method", "GET")
+    target = f"{method} {getattr(query, 'path', '').lstrip('/')}"
+    attempt = 0
+    while True:
+        probe = breaker.before_call()
+        try:
+            with track_upstream("supabase", target):
+                result = query.execute()
+        except Exception as e:
+            if is_supabase_outage(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if attempt + 1 >= RETRY_MAX_ATTEMPTS or not is_retryable_supabase_error(e, method):
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        except BaseException:
+            # Interrupted before Supabase answered
+            if probe:
+                breaker.abandon_probe()
+            raise
+        breaker.record_success()
+        return result
+
+async def run_supabase(query):
+    """Execute a PostgREST query on the shared pool with execute_supabase's retries and breaker
+
+    The attempt loop runs to completion on its thread even if the caller is
+    cancelled, so the breaker always learns the outcome.
+    """
+    return await run_blocking("supabase", execute_supabase, query)
+
+async def run_drive(drive_request):
+    return await run_blocking("drive", drive_request.execute)
+
+async def iterate_blocking(upstream: str, iterator):
+    """Drain a blocking iterator one item at a time on the shared pool"""
+    done = object()
+    while True:
+        item = await run_blocking(upstream, next, iterator, done)
+        if item is done:
+            break
+        yield item
+
+@app.on_event("shutdown")
+def shutdown_blocking_executor():
+    blocking_executor.shutdown(wait=False)
+
 # Google Drive setup
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+DRIVE_CLIENT_POOL_SIZE = int(os.getenv("DRIVE_CLIENT_POOL_SIZE", "256"))
+DRIVE_HTTP_TIMEOUT = int(os.getenv("DRIVE_HTTP_TIMEOUT", "60"))
+
+# Parsed once from the discovery document bundled with googleapiclient,
+# so building a client never fetches or re-parses discovery JSON
+DRIVE_DISCOVERY_DOC = json.loads(get_static_doc('drive', 'v3'))
+
+DRIVE_PATH_WORDS = {
+    "drive", "v3", "upload", "batch", "files", "permissions", "changes", "startPageToken",
+    "about", "drives", "copy", "export", "watch", "generateIds", "emptyTrash", "comments",
+    "replies", "revisions"
+}
+
+def drive_call_target(method: str, uri: str) -> str:
+    """Metric label for a Drive call with file and permission IDs replaced by {id}"""
+    segments = urllib.parse.urlsplit(uri).path.strip("/").split("/")
+    return f"{method} /" + "/".join(segment if segment in DRIVE_PATH_WORDS else "{id}" for segment in segments)
+
+class ThreadLocalAuthorizedHttp:
+    """Authorized transport that keeps one keep-alive httplib2 connection per thread
+
+    httplib2.Http is not thread-safe, so a Drive client shared across the
+    thread pool hands every thread its own connection to reuse.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        # User credentials carry their user_drives.id; the service account shares one budget
+        self.budget_key = getattr(credentials, "drive_id", None) or "service-account"
+        self._local = threading.local()
+
+    def _connection(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            transport = backends["drive_http"]()
+            # As googleapiclient.http.build_http does: resumable uploads answer
+            # 308 Resume Incomplete without a Location header
+            transport.redirect_codes = transport.redirect_codes - {308}
+            http = AuthorizedHttp(self.credentials, http=transport)
+            self._local.http = http
+        return http
+
+    def request(self, uri, method="GET", *args, charge_budget: bool = True, **kwargs):
+        """Send one Drive HTTP call with budget, breaker and retries applied
+
+        Non-idempotent calls are only repeated when Drive rate limited them,
+        since the request was then rejected before doing anything. Resumable
+        upload chunks are left to upload_to_drive, which resumes from the
+        committed offset instead.
+
+        A stream is charged once, when it opens: chunks sent to an existing
+        upload session and calls made with charge_budget=False are free, so
+        the budget can never cut a transfer off halfway.
+        """
+        breaker = upstream_breakers["drive"]
+        retry = "/upload/" not in uri
+        charge_budget = charge_budget and "upload_id=" not in uri
+        attempt = 0
+        while True:
+            # Budget first, so a 429 from it never holds the breaker's probe slot
+            if charge_budget:
+                wait_for_drive_budget(self.budget_key)
+            probe = breaker.before_call()
+            try:
+                with track_upstream("drive", drive_call_target(method, uri)) as tracker:
+                    response, content = self._connection().request(uri, method, *args, **kwargs)
+                    if response.status >= 400:
+                        tracker.outcome = "server_error" if response.status >= 500 else "client_error"
+            except (OSError, httplib2.HttpLib2Error):
+                breaker.record_failure()
+                if not retry or method not in IDEMPOTENT_METHODS or attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                # Token refresh errors and the like say nothing about Drive itself
+                if probe:
+                    breaker.abandon_probe()
+                raise
+
+            if response.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            retryable = is_retryable_status(response.status, content) and (
+                method in IDEMPOTENT_METHODS or response.status < 500
+            )
+            if not retry or not retryable or attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                return response, content
+            time.sleep(backoff_delay(attempt, parse_retry_after(response.get("retry-after"))))
+            attempt += 1
+
+    def close(self):
+        http = getattr(self._local, "http", None)
+        if http is not None:
+            http.close()
+
+def build_drive_client(credentials):
+    return build_from_document(DRIVE_DISCOVERY_DOC, http=ThreadLocalAuthorizedHttp(credentials))
+
+class DriveClientPool:
+    """Process-wide cache of Drive clients
+
+    Holds a single service-account client plus per-drive user clients keyed
+    by user_drives.id with LRU eviction. A user entry is rebuilt whenever the
+    stored (encrypted) tokens no longer match the ones it was built from.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._service_account_client = None
+
+    def get_service_account_client(self):
+        with self._lock:
+            if self._service_account_client is None:
+                credentials = backends["service_account_credentials"]()
+                self._service_account_client = build_drive_client(credentials)
+            return self._service_account_client
+
+    def get_user_client(self, drive_data: dict):
+        drive_id = drive_data['id']
+        fingerprint = (drive_data['access_token'], drive_data['refresh_token'])
+        with self._lock:
+            entry = self._clients.get(drive_id)
+            if entry and entry[2] == fingerprint:
+                self._clients.move_to_end(drive_id)
+                return entry[0], entry[1]
+
+        service, credentials = build_user_drive_client(drive_data)
+        with self._lock:
+            self._clients[drive_id] = (service, credentials, fingerprint)
+            self._clients.move_to_end(drive_id)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+        return service, credentials
+
+    def user_credentials(self):
+        """Snapshot of (drive_id, credentials) for every cached user client"""
+        with self._lock:
+            return [(drive_id, entry[1]) for drive_id, entry in self._clients.items()]
+
+    def update_tokens(self, drive_id: str, encrypted_access_token: str, encrypted_refresh_token: str):
+        """Record rotated tokens written by this process so the entry stays valid"""
+        with self._lock:
+            entry = self._clients.get(drive_id)
+            if entry:
+                self._clients[drive_id] = (entry[0], entry[1], (encrypted_access_token, encrypted_refresh_token))
+
+    def invalidate(self, drive_id: str):
+        with self._lock:
+            self._clients.pop(drive_id, None)
+
+    def reset(self):
+        with self._lock:
+            self._clients.clear()
+            self._service_account_client = None
+
+drive_client_pool = DriveClientPool(DRIVE_CLIENT_POOL_SIZE)
+
 def get_drive_service():
     try:
-        credentials = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        return build('drive', 'v3', credentials=credentials)
+        return drive_client_pool.get_service_account_client()
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Google Drive service unavailable")
 
-def get_user_drive_service(encrypted_access_token: str, encrypted_refresh_token: str):
+# OAuth token management
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+TOKEN_REFRESH_CHECK_INTERVAL = int(os.getenv("TOKEN_REFRESH_CHECK_INTERVAL", "60"))
+
+token_refresh_flights = SingleFlight()
+
+class ManagedUserCredentials(UserCredentials):
+    """User credentials whose refreshes are shared per drive and persisted
+
+    google-auth refreshes automatically shortly before expiry or on a 401.
+    Routing that through a single flight keyed by drive means concurrent
+    requests on one drive trigger a single token exchange and a single
+    user_drives write.
+    """
+
+    def __init__(self, *args, drive_id: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drive_id = drive_id
+
+    def refresh(self, request):
+        if not self.drive_id:
+            return super().refresh(request)
+        token, refresh_token, expiry = token_refresh_flights.do(self.drive_id, lambda: self._refresh_and_store(request))
+        self.token, self._refresh_token, self.expiry = token, refresh_token, expiry
+
+    def _refresh_and_store(self, request):
+        with track_upstream("oauth", "token_refresh"):
+            super().refresh(request)
+        persist_user_tokens(self.drive_id, self)
+        return self.token, self.refresh_token, self.expiry
+
+def parse_utc_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Parse a stored timestamp into the naive UTC datetime google-auth expects"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def build_user_drive_client(drive_data: dict):
+    # Decrypt tokens
+    access_token = decrypt_token(drive_data['access_token'])
+    refresh_token = decrypt_token(drive_data['refresh_token']) if drive_data.get('refresh_token') else None
+    
+    credentials = ManagedUserCredentials(
+        token=access_token,
+        refresh_token=refresh_token,
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
+        scopes=DRIVE_SCOPES,
+        expiry=parse_utc_timestamp(drive_data.get('token_expires_at')),
+        drive_id=drive_data.get('id')
+    )
+    return build_drive_client(credentials), credentials
+
+def get_user_drive_service(drive_data: dict):
+    """Get a pooled Drive client and its credentials for a user_drives row"""
     try:
-        # Decrypt tokens
-        access_token = decrypt_token(encrypted_access_token)
-        refresh_token = decrypt_token(encrypted_refresh_token) if encrypted_refresh_token else None
-        
-        credentials = UserCredentials(
-            token=access_token,
-            refresh_token=refresh_token,
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=GOOGLE_CLIENT_ID,
-            client_secret=GOOGLE_CLIENT_SECRET,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        return build('drive', 'v3', credentials=credentials), credentials
+        return drive_client_pool.get_user_client(drive_data)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="User drive service unavailable")
 
+async def refresh_expiring_tokens():
+    """Refresh cached drive tokens before they expire so requests never wait on it"""
+    horizon = datetime.utcnow() + timedelta(seconds=TOKEN_REFRESH_MARGIN)
+    expiring = [
+        (drive_id, credentials) for drive_id, credentials in drive_client_pool.user_credentials()
+        if credentials.expiry and credentials.expiry <= horizon and credentials.refresh_token
+    ]
+    results = await asyncio.gather(
+        *(run_blocking("oauth", credentials.refresh, backends["oauth_request"]()) for _, credentials in expiring),
+        return_exceptions=True
+    )
+    for (drive_id, _), result in zip(expiring, results):
+        if isinstance(result, Exception):
+            print(f"Token refresh failed for drive {drive_id}: {result}")
+
 def create_user_folder(drive_service, user_email: str, parent_folder_id: str = None):
     """Create a folder for the user in Google Drive"""
     try:
@@ -111,16 +1048,88 @@ def create_user_folder(drive_service, user_email: str, parent_folder_id: str = N
         ).execute()
         
         return folder['id']
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create user folder: {str(e)}")
 
 def get_user_email_from_token(user_id: str):
     """Get user email from Supabase user ID"""
+    return get_user_profile(user_id)[0]
+
+def get_user_profile(user_id: str):
+    """Get (email, app_metadata) for a Supabase user ID"""
     try:
         user = supabase.auth.admin.get_user_by_id(user_id)
-        return user.user.email
+        return user.user.email, user.user.app_metadata or {}
     except Exception:
-        return f"user_{user_id}"  # Fallback to user ID if email not available
+        return f"user_{user_id}", {}  # Fallback to user ID if email not available
+
+# User folder cache
+USER_FOLDER_CACHE_SIZE = int(os.getenv("USER_FOLDER_CACHE_SIZE", "10000"))
+USER_FOLDER_CACHE_TTL = int(os.getenv("USER_FOLDER_CACHE_TTL", str(24 * 3600)))
+SHARED_DRIVE_FOLDER_ID = os.getenv('GOOGLE_DRIVE_FOLDER_ID', 'root')
+
+user_folder_cache = TTLCache(USER_FOLDER_CACHE_SIZE, USER_FOLDER_CACHE_TTL, name="user_folder")
+user_folder_flights = SingleFlight()
+
+def folder_exists(drive_service, folder_id: str) -> bool:
+    """False when the folder was deleted or trashed on Drive"""
+    try:
+        folder = drive_service.files().get(fileId=folder_id, fields="id,trashed").execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+    return not folder.get('trashed')
+
+def get_user_folder_id(drive_service, user_id: str, drive_data: Optional[dict] = None) -> str:
+    """Resolve the user's upload folder on a drive, creating it at most once
+
+    Lookups go memory -> stored column -> Drive. The folder ID is stored on
+    user_drives.user_folder_id for connected drives and in the user's
+    app_metadata for the shared service-account drive. A stored folder that
+    is gone from Drive is replaced. Concurrent first uploads share one
+    resolution so the folder is never created twice.
+    """
+    cache_key = (drive_data['id'] if drive_data else "shared", user_id)
+    folder_id = user_folder_cache.get(cache_key)
+    if folder_id:
+        return folder_id
+
+    def resolve():
+        folder_id = user_folder_cache.get(cache_key)
+        if folder_id:
+            return folder_id
+
+        if drive_data:
+            folder_id = drive_data.get('user_folder_id')
+            if folder_id and not folder_exists(drive_service, folder_id):
+                folder_id = None
+            if not folder_id:
+                folder_id = create_user_folder(drive_service, get_user_email_from_token(user_id))
+                try:
+                    execute_supabase(supabase.table("user_drives").update({"user_folder_id": folder_id}).eq("id", drive_data['id']))
+                except Exception as e:
+                    print(f"Failed to store folder for drive {drive_data['id']}: {e}")
+        else:
+            user_email, app_metadata = get_user_profile(user_id)
+            folder_id = app_metadata.get('shared_folder_id')
+            if folder_id and not folder_exists(drive_service, folder_id):
+                folder_id = None
+            if not folder_id:
+                folder_id = create_user_folder(drive_service, user_email, SHARED_DRIVE_FOLDER_ID)
+                try:
+                    supabase.auth.admin.update_user_by_id(user_id, {
+                        "app_metadata": {**app_metadata, "shared_folder_id": folder_id}
+                    })
+                except Exception as e:
+                    print(f"Failed to store shared folder for user {user_id}: {e}")
+
+        user_folder_cache.set(cache_key, folder_id)
+        return folder_id
+
+    return user_folder_flights.do(cache_key, resolve)
 
 def encrypt_token(token: str) -> str:
     return cipher_suite.encrypt(token.encode()).decode()
@@ -128,6 +1137,27 @@ def encrypt_token(token: str) -> str:
 def decrypt_token(encrypted_token: str) -> str:
     return cipher_suite.decrypt(encrypted_token.encode()).decode()
 
+def reencrypt_stored_tokens(page_size: int = 500) -> int:
+    """Re-encrypt every stored drive token with the primary key; returns rows updated"""
+    updated, offset = 0, 0
+    while True:
+        result = execute_supabase(supabase.table("user_drives").select("id,access_token,refresh_token")
+                                  .order("id").range(offset, offset + page_size - 1))
+        for drive_data in result.data:
+            try:
+                rotated = {
+                    column: cipher_suite.rotate(drive_data[column].encode()).decode()
+                    for column in ("access_token", "refresh_token") if drive_data.get(column)
+                }
+            except InvalidToken:
+                print(f"Skipping drive {drive_data['id']}: tokens were encrypted with a key that is no longer in the ring")
+                continue
+            execute_supabase(supabase.table("user_drives").update(rotated).eq("id", drive_data['id']))
+            updated += 1
+        if len(result.data) < page_size:
+            return updated
+        offset += page_size
+
 def sanitize_filename(filename: str) -> str:
     # Remove dangerous characters and limit length
     sanitized = re.sub(r'[^\w\s.-]', '', filename)
@@ -135,23 +1165,1308 @@ def sanitize_filename(filename: str) -> str:
 
 def verify_file_access(user_id: str, drive_id: str) -> bool:
     # Verify user owns the drive
-    result = supabase.table("user_drives").select("user_id").eq("id", drive_id).eq("user_id", user_id).execute()
+    result = execute_supabase(supabase.table("user_drives").select("user_id").eq("id", drive_id).eq("user_id", user_id))
     return len(result.data) > 0
 
-def refresh_user_token(drive_id: str, credentials: UserCredentials):
+def persist_user_tokens(drive_id: str, credentials: UserCredentials):
+    """Store refreshed tokens and their expiry, keeping the client pool entry valid"""
     try:
-        credentials.refresh(GoogleRequest())
         # Encrypt tokens before storing
         encrypted_access = encrypt_token(credentials.token)
         encrypted_refresh = encrypt_token(credentials.refresh_token) if credentials.refresh_token else None
         
-        supabase.table("user_drives").update({
+        execute_supabase(supabase.table("user_drives").update({
             "access_token": encrypted_access,
-            "refresh_token": encrypted_refresh
-        }).eq("id", drive_id).execute()
-        return credentials.token
+            "refresh_token": encrypted_refresh,
+            "token_expires_at": credentials.expiry.isoformat() if credentials.expiry else None
+        }).eq("id", drive_id))
+        drive_client_pool.update_tokens(drive_id, encrypted_access, encrypted_refresh)
+    except Exception as e:
+        # The refreshed token still lives in the pooled credentials
+        print(f"Failed to store refreshed token for drive {drive_id}: {e}")
+
+# Streaming downloads
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+DOWNLOAD_METADATA_FIELDS = "id,name,size,mimeType,md5Checksum,modifiedTime,appProperties"
+
+def make_etag(metadata: dict) -> str:
+    """Build a strong ETag from Drive metadata"""
+    return f"\"{metadata.get('md5Checksum') or metadata.get('modifiedTime', '')}\""
+
+def parse_range_header(range_header: Optional[str], file_size: int):
+    """Parse a single 'bytes=start-end' range into an inclusive (start, end) tuple"""
+    if not range_header or file_size <= 0:
+        return None
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match or match.group(1) == match.group(2) == "":
+        # Multi-range or malformed headers fall back to the full body
+        return None
+
+    if match.group(1) == "":
+        # Suffix range: the last N bytes
+        start = max(file_size - int(match.group(2)), 0)
+        end = file_size - 1
+    else:
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else file_size - 1
+
+    if start >= file_size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, min(end, file_size - 1)
+
+def iter_drive_media(drive_service, drive_file_id: str, start: int, end: int):
+    """Yield file bytes from Drive chunk by chunk without buffering the whole file"""
+    media_request = drive_service.files().get_media(fileId=drive_file_id)
+    offset = start
+    while offset <= end:
+        chunk_end = min(offset + DOWNLOAD_CHUNK_SIZE - 1, end)
+        response, content = media_request.http.request(
+            media_request.uri,
+            method="GET",
+            headers={"Range": f"bytes={offset}-{chunk_end}"},
+            # Only opening the stream counts against the drive's budget
+            charge_budget=offset == start
+        )
+        if response.status not in (200, 206):
+            raise HttpError(response, content, uri=media_request.uri)
+        if not content:
+            break
+        yield content
+        offset += len(content)
+
+async def prefetch_drive_range(drive_service, drive_file_id: str, start: int, end: int, buffer: asyncio.Queue):
+    """Feed a byte range into a bounded queue, ending with None (or the error)"""
+    try:
+        if end >= start:
+            async for chunk in iterate_blocking("drive", iter_drive_media(drive_service, drive_file_id, start, end)):
+                await buffer.put(chunk)
+        await buffer.put(None)
     except Exception as e:
-        raise HTTPException(status_code=401, detail="Token refresh failed")
+        await buffer.put(e)
+
+# Download content cache
+# Optional on-disk copy of hot files. Entries are keyed by Drive file ID plus
+# content version (md5Checksum/modifiedTime), so the metadata-only files().get
+# every download already makes doubles as revalidation.
+#
+# Each worker process keeps its own index and evicts only what it knows
+# about, so N workers sharing CONTENT_CACHE_DIR can use up to
+# N * CONTENT_CACHE_MAX_BYTES of disk. Give each worker its own directory or
+# divide the budget accordingly.
+CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR", "")
+CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CONTENT_CACHE_MAX_FILE_BYTES = int(os.getenv("CONTENT_CACHE_MAX_FILE_BYTES", str(100 * 1024 * 1024)))
+
+class DiskContentCache:
+    """Size-bounded LRU of Drive file contents stored under one directory"""
+
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._entries = OrderedDict()  # file name -> size, least recently used first
+        self._current = {}  # Drive file ID digest -> file name of its cached version
+        self._total = 0
+        self._lock = threading.Lock()
+        self._filling = set()  # entry names being written right now
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Adopt entries left by a previous process, oldest access first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._add(name, size)
+        self._evict()
+
+    @staticmethod
+    def entry_name(metadata: dict) -> str:
+        file_digest = hashlib.sha256(metadata['id'].encode()).hexdigest()
+        version = metadata.get('md5Checksum') or metadata.get('modifiedTime', '')
+        return f"{file_digest}.{hashlib.sha256(version.encode()).hexdigest()[:32]}"
+
+    def cacheable(self, metadata: dict) -> bool:
+        size = int(metadata.get('size', 0))
+        return 0 < size <= self.max_file_bytes and bool(metadata.get('md5Checksum') or metadata.get('modifiedTime'))
+
+    def _add(self, name: str, size: int):
+        # Must hold the lock (or be single-threaded during _load)
+        file_digest = name.split(".", 1)[0]
+        stale = self._current.get(file_digest)
+        if stale and stale != name:
+            self._remove(stale)
+        self._current[file_digest] = name
+        self._entries[name] = size
+        self._total += size
+
+    def _remove(self, name: str):
+        size = self._entries.pop(name, None)
+        if size is None:
+            return
+        self._total -= size
+        file_digest = name.split(".", 1)[0]
+        if self._current.get(file_digest) == name:
+            del self._current[file_digest]
+        try:
+            # Readers that already opened the file keep their mapping
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def open(self, metadata: dict):
+        """Return an open file object for a cached, current entry or None"""
+        name = self.entry_name(metadata)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+            try:
+                return open(os.path.join(self.directory, name), "rb")
+            except FileNotFoundError:
+                self._remove(name)
+                return None
+
+    def _claim(self, name: str) -> bool:
+        """Reserve an entry for writing unless it exists or another writer has it"""
+        with self._lock:
+            if name in self._entries or name in self._filling:
+                return False
+            self._filling.add(name)
+            return True
+
+    def tee(self, drive_service, metadata: dict):
+        """Yield a whole file from Drive while writing it into the cache
+
+        The entry only becomes visible once every byte arrived; a failed
+        disk write stops caching, not the download.
+        """
+        name = self.entry_name(metadata)
+        size = int(metadata['size'])
+        chunks = iter_drive_media(drive_service, metadata['id'], 0, size - 1)
+        if not self._claim(name):
+            yield from chunks
+            return
+        fd, temp_path = tempfile.mkstemp(prefix="tmp", dir=self.directory)
+        temp_file = os.fdopen(fd, "wb")
+        written = 0
+        try:
+            for chunk in chunks:
+                if temp_file:
+                    try:
+                        temp_file.write(chunk)
+                        written += len(chunk)
+                    except OSError as e:
+                        print(f"Content cache write failed for {metadata['id']}: {e}")
+                        temp_file.close()
+                        temp_file = None
+                yield chunk
+        finally:
+            if temp_file:
+                temp_file.close()
+            self._finish(name, temp_path, size if temp_file and written == size else None)
+
+    def fill(self, drive_service, metadata: dict):
+        """Download a whole file into the cache unless it is cached or being written"""
+        name = self.entry_name(metadata)
+        if not self._claim(name):
+            return
+        size = int(metadata['size'])
+        fd, temp_path = tempfile.mkstemp(prefix="tmp", dir=self.directory)
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                for chunk in iter_drive_media(drive_service, metadata['id'], 0, size - 1):
+                    temp_file.write(chunk)
+            complete = True
+        except Exception as e:
+            print(f"Content cache fill failed for {metadata['id']}: {e}")
+        finally:
+            self._finish(name, temp_path, size if complete else None)
+
+    def _finish(self, name: str, temp_path: str, size: Optional[int]):
+        """Publish a written entry (size given) or discard the partial file"""
+        with self._lock:
+            self._filling.discard(name)
+            if size is None:
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, os.path.join(self.directory, name))
+            self._add(name, size)
+            self._evict()
+
+content_cache = DiskContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES, CONTENT_CACHE_MAX_FILE_BYTES) if CONTENT_CACHE_DIR else None
+
+def iter_cached_file(cached_file, start: int, end: int):
+    """Yield a byte range of a cached file through a read-only memory map"""
+    try:
+        with mmap.mmap(cached_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = start
+            while offset <= end:
+                chunk_end = min(offset + DOWNLOAD_CHUNK_SIZE, end + 1)
+                yield mapped[offset:chunk_end]
+                offset = chunk_end
+    finally:
+        cached_file.close()
+
+def cached_content(drive_service, metadata: dict, start: int, end: int):
+    """Async iterator over a byte range through the content cache; None if not cacheable
+
+    A hit reads the local copy. A miss for the whole file streams from Drive
+    and fills the cache on the way; a ranged miss is left to Drive while the
+    cache fills in the background.
+    """
+    if not content_cache or not content_cache.cacheable(metadata):
+        return None
+    cached_file = content_cache.open(metadata)
+    cache_requests.inc(("content", "hit" if cached_file else "miss"))
+    if cached_file:
+        return iterate_blocking("disk", iter_cached_file(cached_file, start, end))
+    if start == 0 and end == int(metadata['size']) - 1:
+        return iterate_blocking("drive", content_cache.tee(drive_service, metadata))
+    blocking_executor.submit(content_cache.fill, drive_service, metadata)
+    return None
+
+def build_download_response(drive_service, drive_file_id: str, request: Request, filename: Optional[str] = None, use_cache: bool = False, inline: bool = False):
+    """Create a streaming response for a Drive file honouring Range/If-Range and If-None-Match
+
+    With use_cache, the bytes come from the local content cache when it is
+    enabled and the file fits; the metadata lookup revalidates the entry.
+    """
+    metadata = drive_service.files().get(fileId=drive_file_id, fields=DOWNLOAD_METADATA_FIELDS).execute()
+    reject_stripe(metadata)
+    file_size = int(metadata.get('size', 0))
+    etag = make_etag(metadata)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    byte_range = parse_range_header(request.headers.get("range"), file_size)
+    if_range = request.headers.get("if-range")
+    if byte_range and if_range and if_range != etag:
+        # Resource changed since the client cached it - send the full body
+        byte_range = None
+
+    start, end = byte_range or (0, file_size - 1)
+    headers = {
+        "Content-Disposition": f"{'inline' if inline else 'attachment'}; filename={filename or metadata['name']}",
+        "Content-Length": str(end - start + 1 if file_size else 0),
+        "Accept-Ranges": "bytes",
+        "ETag": etag
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+
+    content = cached_content(drive_service, metadata, start, end) if use_cache else None
+    if content is None:
+        content = iterate_blocking("drive", iter_drive_media(drive_service, drive_file_id, start, end))
+
+    return StreamingResponse(
+        content,
+        status_code=206 if byte_range else 200,
+        media_type=metadata.get('mimeType') or 'application/octet-stream',
+        headers=headers
+    )
+
+# Streaming uploads
+# Drive requires resumable chunks to be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = max(int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))) // (256 * 1024), 1) * 256 * 1024
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", "5"))
+UPLOAD_FIELDS = "id,name,size,mimeType"
+
+def upload_to_drive(drive_service, file: UploadFile, file_metadata: dict, progress=None):
+    """Stream a spooled upload into a Drive resumable session chunk by chunk
+
+    progress, if given, is called with the bytes Drive has committed so far.
+    """
+    file.file.seek(0)
+    media = MediaIoBaseUpload(
+        file.file,
+        mimetype=file.content_type or 'application/octet-stream',
+        chunksize=UPLOAD_CHUNK_SIZE,
+        resumable=True
+    )
+    drive_request = drive_service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields=UPLOAD_FIELDS
+    )
+
+    drive_file = None
+    failures = 0
+    while drive_file is None:
+        try:
+            # After a failure the client queries Drive for the committed offset
+            # and resumes from there instead of restarting the transfer
+            status, drive_file = drive_request.next_chunk(num_retries=UPLOAD_MAX_RETRIES)
+            failures = 0
+            if progress and status:
+                progress(status.resumable_progress)
+        except Exception as e:
+            failures += 1
+            if failures > UPLOAD_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            time.sleep(backoff_delay(failures - 1))
+    return drive_file
+
+# Content-addressed deduplication
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_upload(file: UploadFile) -> tuple:
+    """SHA-256 and MD5 of a spooled upload, read in fixed-size chunks
+
+    SHA-256 keys the dedup lookup; MD5 is what Drive reports as md5Checksum.
+    """
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    file.file.seek(0)
+    for chunk in iter(lambda: file.file.read(HASH_CHUNK_SIZE), b""):
+        sha256.update(chunk)
+        md5.update(chunk)
+    file.file.seek(0)
+    return sha256.hexdigest(), md5.hexdigest()
+
+def find_duplicate_file(content_sha256: str, user_id: str, user_drive_id: Optional[str]) -> Optional[dict]:
+    """Find one of the user's files with the same content on the same drive (or the shared drive)"""
+    query = (supabase.table("files").select("id,drive_file_id,name,type,size,folder_id")
+             .eq("user_id", user_id).eq("content_sha256", content_sha256))
+    query = query.eq("user_drive_id", user_drive_id) if user_drive_id else query.is_("user_drive_id", "null")
+    # A striped row's drive_file_id is only its first stripe, so it cannot be copied
+    result = execute_supabase(query.is_("stripes", "null").limit(1))
+    return result.data[0] if result.data else None
+
+def duplicate_matches(drive_service, duplicate: dict, content_md5: str) -> bool:
+    """Whether a duplicate's Drive file still exists, untrashed, with the uploaded bytes"""
+    try:
+        metadata = drive_service.files().get(fileId=duplicate['drive_file_id'], fields="trashed,md5Checksum").execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+    return not metadata.get('trashed') and metadata.get('md5Checksum') == content_md5
+
+def store_upload(drive_service, file: UploadFile, file_metadata: dict, user_id: str, user_drive_id: Optional[str] = None, progress=None) -> dict:
+    """Upload a file unless the same content already exists in this scope
+
+    An identical file with the same name in the same folder is reused as is
+    (metadata only). Otherwise the existing copy is duplicated server side
+    with files().copy, so the bytes are never re-sent to Drive. Either way
+    the Drive file is checked first; a deleted, trashed or changed original
+    means a real upload.
+    """
+    content_sha256, content_md5 = hash_upload(file)
+    duplicate = find_duplicate_file(content_sha256, user_id, user_drive_id)
+    if duplicate and not duplicate_matches(drive_service, duplicate, content_md5):
+        duplicate = None
+
+    if duplicate and duplicate['folder_id'] == file_metadata['parents'][0] and duplicate['name'] == file_metadata['name']:
+        return {"drive_file": None, "content_sha256": content_sha256, "existing_file": duplicate, "deduplicated": "reference"}
+
+    if duplicate:
+        try:
+            drive_file = drive_service.files().copy(
+                fileId=duplicate['drive_file_id'],
+                body=file_metadata,
+                fields=UPLOAD_FIELDS
+            ).execute()
+            return {"drive_file": drive_file, "content_sha256": content_sha256, "existing_file": None, "deduplicated": "copy"}
+        except HttpError as e:
+            # The original vanished from Drive - fall back to a real upload
+            if e.resp.status != 404:
+                raise
+
+    try:
+        drive_file = upload_to_drive(drive_service, file, file_metadata, progress)
+    except HttpError as e:
+        # Most likely the user's folder was deleted; resolve it again next time
+        if e.resp.status == 404:
+            user_folder_cache.pop((user_drive_id or "shared", user_id))
+        raise
+    return {"drive_file": drive_file, "content_sha256": content_sha256, "existing_file": None, "deduplicated": None}
+
+# Client-facing resumable upload sessions
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+UPLOAD_SESSION_MAX_CHUNK = int(os.getenv("UPLOAD_SESSION_MAX_CHUNK", str(64 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = timedelta(days=7)  # Drive forgets resumable session URIs after a week
+
+def create_drive_upload_session(drive_service, file_metadata: dict, size: int, mime_type: str) -> str:
+    """Open a Drive resumable upload session and return its session URI"""
+    response, content = drive_service._http.request(
+        f"{DRIVE_UPLOAD_URL}?uploadType=resumable&fields={UPLOAD_FIELDS}",
+        method="POST",
+        body=json.dumps(file_metadata),
+        headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mime_type,
+            "X-Upload-Content-Length": str(size)
+        }
+    )
+    if response.status != 200 or "location" not in response:
+        raise HttpError(response, content, uri=DRIVE_UPLOAD_URL)
+    return response["location"]
+
+def put_drive_session_chunk(drive_service, session_uri: str, chunk: bytes, offset: int, size: int):
+    """Relay a chunk into a Drive session, returning (committed_offset, drive_file or None)
+
+    An empty chunk only asks Drive how many bytes it has committed so far.
+    """
+    if chunk:
+        content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{size}"
+    else:
+        content_range = f"bytes */{size}"
+    response, content = drive_service._http.request(
+        session_uri,
+        method="PUT",
+        body=chunk,
+        headers={"Content-Length": str(len(chunk)), "Content-Range": content_range}
+    )
+    if response.status in (200, 201):
+        return size, json.loads(content)
+    if response.status == 308:
+        committed = response.get("range")
+        return (int(committed.rsplit("-", 1)[1]) + 1 if committed else 0), None
+    raise HttpError(response, content, uri=session_uri)
+
+def get_upload_session(upload_id: str, user_id: str):
+    """Load an upload session and the drive it targets for the calling user"""
+    session_result = execute_supabase(supabase.table("upload_sessions").select("*").eq("id", upload_id).eq("user_id", user_id))
+    if not session_result.data:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+    upload_session = session_result.data[0]
+    expires_at = parse_utc_timestamp(upload_session.get('expires_at'))
+    if expires_at and expires_at <= datetime.utcnow():
+        execute_supabase(supabase.table("upload_sessions").delete().eq("id", upload_id))
+        raise HTTPException(status_code=410, detail="Upload session expired")
+
+    drive_result = execute_supabase(supabase.table("user_drives").select(DRIVE_CREDENTIAL_COLUMNS).eq("id", upload_session['user_drive_id']).eq("user_id", user_id))
+    if not drive_result.data:
+        raise HTTPException(status_code=404, detail="Drive not found")
+    return upload_session, drive_result.data[0]
+
+def complete_upload_session(upload_session: dict, drive_file: dict) -> dict:
+    """Record the uploaded file once Drive has committed the final chunk"""
+    execute_supabase(supabase.table("files").insert({
+        "user_drive_id": upload_session['user_drive_id'],
+        "drive_file_id": drive_file['id'],
+        "name": drive_file['name'],
+        "type": drive_file.get('mimeType', 'unknown'),
+        "size": int(drive_file.get('size', 0)),
+        "folder_id": upload_session['folder_id'],
+        "user_id": upload_session['user_id'],
+        "created_at": datetime.utcnow().isoformat()
+    }))
+    execute_supabase(supabase.table("upload_sessions").delete().eq("id", upload_session['id']))
+
+    return {
+        "upload_id": upload_session['id'],
+        "offset": upload_session['size'],
+        "complete": True,
+        "file_id": drive_file['id'],
+        "name": drive_file['name'],
+        "size": drive_file.get('size', 0),
+        "user_folder_id": upload_session['folder_id']
+    }
+
+def expire_upload_session(upload_session: dict, error: HttpError):
+    """Drop a session Drive no longer recognises and surface 410 to the client"""
+    if error.resp.status in (404, 410):
+        execute_supabase(supabase.table("upload_sessions").delete().eq("id", upload_session['id']))
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    raise error
+
+# Folder listing
+LIST_DEFAULT_PAGE_SIZE = int(os.getenv("LIST_DEFAULT_PAGE_SIZE", "100"))
+LIST_MAX_PAGE_SIZE = 1000  # Drive's own upper bound for files.list
+LIST_FIELDS = "nextPageToken,files(id,name,mimeType,size,modifiedTime,parents)"
+
+def encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        state = json.loads(b64url_decode(cursor))
+        if not isinstance(state, dict):
+            raise ValueError("Cursor is not an object")
+        return state
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def folder_list_request(drive_service, folder_id: str, page_size: int, page_token: Optional[str] = None, fields: str = LIST_FIELDS):
+    return drive_service.files().list(
+        q=f"'{folder_id}' in parents and trashed=false",
+        pageSize=page_size,
+        pageToken=page_token,
+        fields=fields
+    )
+
+def iter_folder_ndjson(drive_service, folder_id: str, page_size: int):
+    """Yield every file in a folder as NDJSON, one Drive page per chunk"""
+    page_token = None
+    while True:
+        page = folder_list_request(drive_service, folder_id, page_size, page_token).execute()
+        lines = "".join(json.dumps(drive_file) + "\n" for drive_file in page.get('files', []))
+        if lines:
+            yield lines
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            break
+
+async def list_folder(drive_service, folder_id: str, page_size: int, cursor: Optional[str], stream: bool):
+    """List one page of a folder with an opaque cursor, or stream all pages as NDJSON"""
+    if not 1 <= page_size <= LIST_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {LIST_MAX_PAGE_SIZE}")
+
+    if stream:
+        return StreamingResponse(
+            iterate_blocking("drive", iter_folder_ndjson(drive_service, folder_id, page_size)),
+            media_type="application/x-ndjson"
+        )
+
+    page_token = None
+    if cursor:
+        state = decode_cursor(cursor)
+        if state.get('folder_id') != folder_id:
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this folder")
+        page_token = state.get('page_token')
+
+    results = await run_drive(folder_list_request(drive_service, folder_id, page_size, page_token))
+    next_page_token = results.get('nextPageToken')
+    return {
+        "files": results.get('files', []),
+        "next_cursor": encode_cursor({"folder_id": folder_id, "page_token": next_page_token}) if next_page_token else None
+    }
+
+# Unified listing across a user's drives
+UNIFIED_LIST_DRIVE_TIMEOUT = float(os.getenv("UNIFIED_LIST_DRIVE_TIMEOUT", "5"))
+UNIFIED_LIST_ORDER = "modifiedTime desc,name"
+UNIFIED_LIST_QUERIES = {
+    "root": "'root' in parents and trashed=false",
+    "all": "trashed=false"
+}
+
+def unified_sort_key(drive_file: dict):
+    """Sort key matching UNIFIED_LIST_ORDER: newest first, then by name"""
+    modified = parse_utc_timestamp(drive_file.get('modifiedTime')) or datetime.min
+    return (-modified.replace(tzinfo=timezone.utc).timestamp(), drive_file.get('name') or "", drive_file['id'])
+
+def fetch_drive_listing_page(drive_data: dict, query: str, state: dict):
+    """Fetch the unread part of a drive's current page, returning (files, next_page_token)"""
+    service, _ = get_user_drive_service(drive_data)
+    page_token, skip = state.get('t'), state.get('s', 0)
+    while True:
+        page = service.files().list(
+            q=query,
+            orderBy=UNIFIED_LIST_ORDER,
+            pageSize=state['n'],
+            pageToken=page_token,
+            fields=LIST_FIELDS
+        ).execute()
+        files = page.get('files', [])[skip:]
+        next_page_token = page.get('nextPageToken')
+        if files or not next_page_token:
+            return files, next_page_token, page_token, skip
+        # Nothing unread left on this page - move to the next one
+        page_token, skip = next_page_token, 0
+
+async def fetch_drive_listing(drive_data: dict, query: str, state: dict):
+    return await asyncio.wait_for(
+        run_blocking("drive", fetch_drive_listing_page, drive_data, query, state),
+        timeout=UNIFIED_LIST_DRIVE_TIMEOUT
+    )
+
+async def list_all_drives_page(drives: list, scope: str, page_size: int, cursor: Optional[str]):
+    """Merge one page across drives queried concurrently, with a combined cursor
+
+    Every drive is listed in the same order, so items can be merged as long
+    as no drive with more pages has run out of buffered items: anything
+    sorting after a drive's last buffered item waits for the next page.
+    Drives that miss the timeout are reported and retried from the same
+    position on the next page. Their unread items may sort anywhere after
+    the last item they contributed (the "k" key in their state), so nothing
+    past that point is emitted until they answer.
+    """
+    states = {}
+    if cursor:
+        cursor_state = decode_cursor(cursor)
+        if cursor_state.get('scope') != scope or not isinstance(cursor_state.get('drives'), dict):
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this listing")
+        states = cursor_state['drives']
+
+    pending = [
+        drive_data for drive_data in drives
+        if not states.get(drive_data['id'], {}).get('done')
+    ]
+    fetch_states = {
+        drive_data['id']: states.get(drive_data['id']) or {"t": None, "s": 0, "n": page_size}
+        for drive_data in pending
+    }
+    results = await asyncio.gather(
+        *(fetch_drive_listing(drive_data, UNIFIED_LIST_QUERIES[scope], fetch_states[drive_data['id']]) for drive_data in pending),
+        return_exceptions=True
+    )
+
+    buffers, failed = {}, []
+    new_states = {drive_id: state for drive_id, state in states.items() if state.get('done')}
+    for drive_data, result in zip(pending, results):
+        drive_id = drive_data['id']
+        if isinstance(result, BaseException):
+            failed.append({"drive_id": drive_id, "error": "timeout" if isinstance(result, asyncio.TimeoutError) else str(result)})
+            # Untouched, so the next page resumes exactly here
+            new_states[drive_id] = fetch_states[drive_id]
+            continue
+        buffers[drive_id] = result
+
+    # Items may only be emitted up to the earliest "last buffered item" of any
+    # drive that still has more pages
+    frontiers = [
+        unified_sort_key(files[-1])
+        for files, next_page_token, _, _ in buffers.values()
+        if next_page_token and files
+    ]
+    # ...and up to the last emitted item of any drive that didn't answer; one
+    # that never answered yet could hold anything, which blocks the page
+    positions = [fetch_states[failure['drive_id']].get('k') for failure in failed]
+    blocked = any(position is None for position in positions)
+    frontiers.extend(tuple(position) for position in positions if position is not None)
+    cutoff = min(frontiers) if frontiers else None
+
+    candidates = sorted(
+        (unified_sort_key(drive_file), drive_id, drive_file)
+        for drive_id, (files, _, _, _) in buffers.items()
+        for drive_file in files
+    )
+    page, consumed = [], dict.fromkeys(buffers, 0)
+    for key, drive_id, drive_file in candidates:
+        if blocked or len(page) >= page_size or (cutoff is not None and key > cutoff):
+            break
+        page.append({**drive_file, "drive_id": drive_id})
+        consumed[drive_id] += 1
+
+    for drive_id, (files, next_page_token, page_token, skip) in buffers.items():
+        count = consumed[drive_id]
+        position = list(unified_sort_key(files[count - 1])) if count else fetch_states[drive_id].get('k')
+        if count < len(files):
+            new_states[drive_id] = {"t": page_token, "s": skip + count, "n": fetch_states[drive_id]['n'], "k": position}
+        elif next_page_token:
+            new_states[drive_id] = {"t": next_page_token, "s": 0, "n": page_size, "k": position}
+        else:
+            new_states[drive_id] = {"done": True}
+
+    has_more = any(not state.get('done') for state in new_states.values())
+    return {
+        "files": page,
+        "next_cursor": encode_cursor({"scope": scope, "drives": new_states}) if has_more else None,
+        "incomplete_drives": failed
+    }
+
+async def stream_all_drives(drives: list, scope: str, page_size: int):
+    """Yield NDJSON for every file on every drive as each drive's pages arrive"""
+    queue = asyncio.Queue()
+
+    async def pump(drive_data):
+        state = {"t": None, "s": 0, "n": page_size}
+        try:
+            while True:
+                files, next_page_token, _, _ = await fetch_drive_listing(drive_data, UNIFIED_LIST_QUERIES[scope], state)
+                if files:
+                    await queue.put("".join(json.dumps({**f, "drive_id": drive_data['id']}) + "\n" for f in files))
+                if not next_page_token:
+                    break
+                state = {"t": next_page_token, "s": 0, "n": page_size}
+        except Exception as e:
+            error = "timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+            await queue.put(json.dumps({"drive_id": drive_data['id'], "error": error}) + "\n")
+        finally:
+            await queue.put(None)
+
+    tasks = [asyncio.create_task(pump(drive_data)) for drive_data in drives]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            chunk = await queue.get()
+            if chunk is None:
+                remaining -= 1
+            else:
+                yield chunk
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Background jobs
+background_jobs = []
+
+async def run_periodically(name: str, interval: float, job):
+    """Run an async job forever, every interval seconds, surviving failures"""
+    while True:
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Background job {name} failed: {e}")
+        await asyncio.sleep(interval)
+
+def schedule_job(name: str, interval: float, job):
+    """Register a periodic job to start with the app"""
+    background_jobs.append((name, interval, job))
+
+@app.on_event("startup")
+async def start_background_jobs():
+    app.state.background_tasks = [
+        asyncio.create_task(run_periodically(name, interval, job))
+        for name, interval, job in background_jobs
+    ]
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+
+schedule_job("drive-token-refresh", TOKEN_REFRESH_CHECK_INTERVAL, refresh_expiring_tokens)
+
+# Deferred uploads
+# With ?deferred=true an upload is spooled to UPLOAD_JOB_DIR and answered with
+# 202 and a job ID; a bounded set of workers then pushes it to Drive. Jobs live
+# in a SQLite file next to the spooled bytes, so they are shared by the workers
+# on one host and picked up again after a restart (a job whose worker died is
+# reclaimed once its lease runs out, and the transfer starts over).
+UPLOAD_JOB_DIR = os.getenv("UPLOAD_JOB_DIR", "upload_jobs")
+UPLOAD_JOB_WORKERS = int(os.getenv("UPLOAD_JOB_WORKERS", "2"))
+UPLOAD_JOB_MAX_ATTEMPTS = int(os.getenv("UPLOAD_JOB_MAX_ATTEMPTS", "5"))
+UPLOAD_JOB_LEASE = float(os.getenv("UPLOAD_JOB_LEASE", "120"))
+UPLOAD_JOB_POLL_INTERVAL = float(os.getenv("UPLOAD_JOB_POLL_INTERVAL", "2"))
+UPLOAD_JOB_RETENTION = float(os.getenv("UPLOAD_JOB_RETENTION", str(24 * 3600)))
+UPLOAD_JOB_COLUMNS = (
+    "id, user_id, user_drive_id, folder_id, name, content_type, size, state, bytes_sent, attempts,"
+    " error, result, created_at, started_at, updated_at, finished_at"
+)
+
+upload_job_outcomes = metrics.register(Counter("upload_jobs_total", "Deferred upload jobs by outcome", ("outcome",)))
+
+class UploadJobStore:
+    """Deferred upload jobs and their spooled files in UPLOAD_JOB_DIR"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, "jobs.db")
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "create table if not exists upload_jobs ("
+                " id text primary key, user_id text not null, user_drive_id text, folder_id text not null,"
+                " name text not null, content_type text not null, size integer not null,"
+                " state text not null, bytes_sent integer not null default 0, attempts integer not null default 0,"
+                " error text, result text, worker text, lease_expires_at real, not_before real not null default 0,"
+                " created_at real not null, started_at real, updated_at real, finished_at real)"
+            )
+            connection.execute("create index if not exists upload_jobs_pending on upload_jobs (state, created_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("pragma journal_mode=wal")
+            connection.execute("pragma synchronous=normal")
+            self._local.connection = connection
+        return connection
+
+    def spool_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.upload")
+
+    def spool(self, job_id: str, file: UploadFile) -> int:
+        """Copy an upload into the job directory, visible under its final name only once complete"""
+        partial = os.path.join(self.directory, f"{job_id}.part")
+        file.file.seek(0)
+        try:
+            with open(partial, "wb") as spooled:
+                shutil.copyfileobj(file.file, spooled, HASH_CHUNK_SIZE)
+                spooled.flush()
+                os.fsync(spooled.fileno())
+            os.replace(partial, self.spool_path(job_id))
+        except BaseException:
+            self.discard(partial)
+            raise
+        return os.path.getsize(self.spool_path(job_id))
+
+    @staticmethod
+    def discard(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def create(self, job: dict) -> dict:
+        now = time.time()
+        self._connection().execute(
+            "insert into upload_jobs (id, user_id, user_drive_id, folder_id, name, content_type, size, state, created_at, updated_at)"
+            " values (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job['id'], job['user_id'], job['user_drive_id'], job['folder_id'], job['name'], job['content_type'], job['size'], now, now)
+        )
+        return self.get(job['id'], job['user_id'])
+
+    def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            f"select {UPLOAD_JOB_COLUMNS} from upload_jobs where id = ? and user_id = ?", (job_id, user_id)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def for_user(self, user_id: str, limit: int) -> list:
+        rows = self._connection().execute(
+            f"select {UPLOAD_JOB_COLUMNS} from upload_jobs where user_id = ? order by created_at desc limit ?", (user_id, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Take the oldest runnable job, including running ones whose worker stopped renewing its lease"""
+        now = time.time()
+        connection = self._connection()
+        connection.execute("begin immediate")
+        try:
+            row = connection.execute(
+                f"select {UPLOAD_JOB_COLUMNS} from upload_jobs"
+                " where (state = 'queued' and not_before <= ?) or (state = 'running' and lease_expires_at <= ?)"
+                " order by created_at limit 1",
+                (now, now)
+            ).fetchone()
+            if row:
+                connection.execute(
+                    "update upload_jobs set state = 'running', worker = ?, lease_expires_at = ?, attempts = attempts + 1,"
+                    " bytes_sent = 0, started_at = ?, updated_at = ? where id = ?",
+                    (worker, now + UPLOAD_JOB_LEASE, now, now, row['id'])
+                )
+            connection.execute("commit")
+        except BaseException:
+            connection.execute("rollback")
+            raise
+        if not row:
+            return None
+        return {**dict(row), "state": "running", "attempts": row['attempts'] + 1, "bytes_sent": 0, "started_at": now}
+
+    def progress(self, job_id: str, bytes_sent: int):
+        """Record transferred bytes and renew the lease"""
+        now = time.time()
+        self._connection().execute(
+            "update upload_jobs set bytes_sent = ?, updated_at = ?, lease_expires_at = ? where id = ? and state = 'running'",
+            (bytes_sent, now, now + UPLOAD_JOB_LEASE, job_id)
+        )
+
+    def finish(self, job_id: str, result: dict):
+        now = time.time()
+        self._connection().execute(
+            "update upload_jobs set state = 'done', bytes_sent = size, result = ?, error = null,"
+            " lease_expires_at = null, updated_at = ?, finished_at = ? where id = ?",
+            (json.dumps(result), now, now, job_id)
+        )
+        self.discard(self.spool_path(job_id))
+
+    def fail(self, job_id: str, error: str, retry_in: Optional[float]):
+        """Queue the job again after retry_in seconds, or give up on it when retry_in is None"""
+        now = time.time()
+        if retry_in is None:
+            self._connection().execute(
+                "update upload_jobs set state = 'failed', error = ?, lease_expires_at = null,"
+                " updated_at = ?, finished_at = ? where id = ?",
+                (error, now, now, job_id)
+            )
+            self.discard(self.spool_path(job_id))
+        else:
+            self._connection().execute(
+                "update upload_jobs set state = 'queued', error = ?, not_before = ?, lease_expires_at = null,"
+                " updated_at = ? where id = ?",
+                (error, now + retry_in, now, job_id)
+            )
+
+    def purge(self, older_than: float) -> int:
+        """Forget finished jobs and remove spool files nobody will pick up"""
+        connection = self._connection()
+        purged = connection.execute(
+            "delete from upload_jobs where state in ('done', 'failed') and finished_at < ?", (older_than,)
+        ).rowcount
+        live = {row['id'] for row in connection.execute("select id from upload_jobs where state in ('queued', 'running')")}
+        for entry in os.scandir(self.directory):
+            job_id, extension = os.path.splitext(entry.name)
+            if extension in (".part", ".upload") and job_id not in live and entry.stat().st_mtime < older_than:
+                self.discard(entry.path)
+        return purged
+
+upload_jobs = UploadJobStore(UPLOAD_JOB_DIR)
+
+def describe_upload_job(job: dict) -> dict:
+    """Client view of a job with throughput and ETA of the current attempt"""
+    throughput, eta = None, None
+    if job['state'] == 'running' and job['bytes_sent'] and job['updated_at'] > job['started_at']:
+        throughput = job['bytes_sent'] / (job['updated_at'] - job['started_at'])
+        eta = max(job['size'] - job['bytes_sent'], 0) / throughput
+
+    def timestamp(value):
+        return datetime.utcfromtimestamp(value).isoformat() if value else None
+
+    return {
+        "job_id": job['id'],
+        "state": job['state'],
+        "name": job['name'],
+        "drive_id": job['user_drive_id'],
+        "size": job['size'],
+        "bytes_transferred": job['bytes_sent'],
+        "throughput_bytes_per_second": round(throughput) if throughput else None,
+        "eta_seconds": round(eta, 1) if eta is not None else None,
+        "attempts": job['attempts'],
+        "error": job['error'],
+        "result": json.loads(job['result']) if job['result'] else None,
+        "created_at": timestamp(job['created_at']),
+        "finished_at": timestamp(job['finished_at'])
+    }
+
+def transfer_upload_job(job: dict) -> dict:
+    """Push a spooled upload to Drive and record it, as the inline upload routes do"""
+    drive_data = None
+    if job['user_drive_id']:
+        drive_result = execute_supabase(supabase.table("user_drives").select(DRIVE_CREDENTIAL_COLUMNS)
+                                        .eq("id", job['user_drive_id']).eq("user_id", job['user_id']))
+        if not drive_result.data:
+            raise HTTPException(status_code=404, detail="Drive not found")
+        drive_data = drive_result.data[0]
+        service, _ = get_user_drive_service(drive_data)
+    else:
+        service = get_drive_service()
+
+    # Shared drive uploads always land in the user's folder
+    folder_id = job['folder_id']
+    if drive_data is None or folder_id == "root":
+        folder_id = get_user_folder_id(service, job['user_id'], drive_data)
+
+    with open(upload_jobs.spool_path(job['id']), "rb") as spooled:
+        file = UploadFile(spooled, filename=job['name'], headers=Headers({"content-type": job['content_type']}))
+        stored = store_upload(
+            service, file, {'name': job['name'], 'parents': [folder_id]}, job['user_id'], job['user_drive_id'],
+            progress=lambda bytes_sent: upload_jobs.progress(job['id'], bytes_sent)
+        )
+
+    existing_file = stored['existing_file']
+    if existing_file:
+        return {
+            "file_id": existing_file['id'],
+            "drive_file_id": existing_file['drive_file_id'],
+            "name": existing_file['name'],
+            "size": existing_file['size'],
+            "folder_id": folder_id,
+            "deduplicated": stored['deduplicated']
+        }
+
+    drive_file = stored['drive_file']
+    result = execute_supabase(supabase.table("files").insert({
+        "user_drive_id": job['user_drive_id'],
+        "drive_file_id": drive_file['id'],
+        "name": drive_file['name'],
+        "type": drive_file.get('mimeType', 'unknown'),
+        "size": int(drive_file.get('size', 0)),
+        "content_sha256": stored['content_sha256'],
+        "folder_id": folder_id,
+        "user_id": job['user_id'],
+        "created_at": datetime.utcnow().isoformat()
+    }))
+    return {
+        "file_id": result.data[0]['id'],
+        "drive_file_id": drive_file['id'],
+        "name": drive_file['name'],
+        "size": int(drive_file.get('size', 0)),
+        "folder_id": folder_id,
+        "deduplicated": stored['deduplicated']
+    }
+
+class UploadJobRunner:
+    """Keeps up to UPLOAD_JOB_WORKERS jobs transferring in this process"""
+
+    def __init__(self, store: UploadJobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.active = set()
+        self._filling = asyncio.Lock()
+
+    async def fill(self):
+        async with self._filling:
+            while len(self.active) < self.workers:
+                job = await run_blocking("disk", self.store.claim, self.worker_id)
+                if not job:
+                    return
+                task = asyncio.create_task(self.run(job))
+                self.active.add(task)
+                task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task):
+        self.active.discard(task)
+        # A slot just freed up; don't wait for the next poll
+        asyncio.ensure_future(self.fill())
+
+    async def run(self, job: dict):
+        try:
+            result = await run_blocking("drive", transfer_upload_job, job)
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                retryable = e.status_code >= 500 or e.status_code == 429
+            else:
+                retryable = is_retryable_error(e) or is_supabase_outage(e)
+            if retryable and job['attempts'] < UPLOAD_JOB_MAX_ATTEMPTS:
+                retry_in = backoff_delay(job['attempts'])
+                upload_job_outcomes.inc(("retried",))
+            else:
+                retry_in = None
+                upload_job_outcomes.inc(("failed",))
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            print(f"Upload job {job['id']} failed (attempt {job['attempts']}): {detail}")
+            await run_blocking("disk", self.store.fail, job['id'], detail, retry_in)
+        else:
+            await run_blocking("disk", self.store.finish, job['id'], result)
+            upload_job_outcomes.inc(("done",))
+
+upload_job_runner = UploadJobRunner(upload_jobs, UPLOAD_JOB_WORKERS)
+
+async def enqueue_upload_job(file: UploadFile, user_id: str, user_drive_id: Optional[str], folder_id: str) -> JSONResponse:
+    """Spool an upload and answer 202 right away; the transfer runs in the background"""
+    job_id = uuid.uuid4().hex
+    size = await run_blocking("disk", upload_jobs.spool, job_id, file)
+    job = await run_blocking("disk", upload_jobs.create, {
+        "id": job_id,
+        "user_id": user_id,
+        "user_drive_id": user_drive_id,
+        "folder_id": folder_id,
+        "name": sanitize_filename(file.filename),
+        "content_type": file.content_type or 'application/octet-stream',
+        "size": size
+    })
+    upload_job_outcomes.inc(("accepted",))
+    asyncio.ensure_future(upload_job_runner.fill())
+    return JSONResponse(status_code=202, content=describe_upload_job(job), headers={"Location": f"/upload-jobs/{job_id}"})
+
+async def purge_upload_jobs():
+    await run_blocking("disk", upload_jobs.purge, time.time() - UPLOAD_JOB_RETENTION)
+
+schedule_job("upload-jobs", UPLOAD_JOB_POLL_INTERVAL, upload_job_runner.fill)
+schedule_job("upload-job-purge", 3600, purge_upload_jobs)
+
+# Drive metadata mirror
+# Each connected drive is mirrored into the drive_index table and kept in step
+# through the Changes API, so browsing can be served without calling Drive.
+DRIVE_SYNC_ENABLED = os.getenv("DRIVE_SYNC_ENABLED", "false").lower() == "true"
+DRIVE_SYNC_INTERVAL = int(os.getenv("DRIVE_SYNC_INTERVAL", "60"))
+DRIVE_SYNC_PAGE_SIZE = 1000
+INDEX_FIELDS = "id,name,parents,size,mimeType,modifiedTime,trashed"
+CHANGES_FIELDS = f"nextPageToken,newStartPageToken,changes(fileId,removed,file({INDEX_FIELDS}))"
+INDEX_COLUMNS = "drive_file_id,name,parents,size,mime_type,modified_time"
+
+def to_index_row(drive_id: str, drive_file: dict) -> dict:
+    return {
+        "user_drive_id": drive_id,
+        "drive_file_id": drive_file['id'],
+        "name": drive_file.get('name'),
+        "parents": drive_file.get('parents', []),
+        "size": int(drive_file['size']) if drive_file.get('size') else None,
+        "mime_type": drive_file.get('mimeType'),
+        "modified_time": drive_file.get('modifiedTime')
+    }
+
+def from_index_row(row: dict) -> dict:
+    """Shape an index row like a Drive files.list entry"""
+    return {
+        "id": row['drive_file_id'],
+        "name": row['name'],
+        "mimeType": row['mime_type'],
+        "size": str(row['size']) if row.get('size') is not None else None,
+        "modifiedTime": row['modified_time'],
+        "parents": row['parents']
+    }
+
+def write_index_batch(drive_id: str, upserts: list, removals: list):
+    if upserts:
+        execute_supabase(supabase.table("drive_index").upsert(upserts, on_conflict="user_drive_id,drive_file_id"))
+    if removals:
+        execute_supabase(supabase.table("drive_index").delete().eq("user_drive_id", drive_id).in_("drive_file_id", removals))
+
+def full_index_drive(service, drive_id: str) -> str:
+    """Rebuild a drive's index from a full listing, returning the token to follow changes from
+
+    Listed files are upserted under a fresh generation and rows the listing
+    did not reach are pruned only once it completes, so readers keep seeing
+    the previous index while a rebuild runs or if it fails halfway.
+    """
+    # Take the token first so changes made during the listing are replayed later
+    start_page_token = service.changes().getStartPageToken().execute()['startPageToken']
+    generation = uuid.uuid4().hex
+
+    page_token = None
+    while True:
+        page = service.files().list(
+            q="trashed=false",
+            pageSize=DRIVE_SYNC_PAGE_SIZE,
+            pageToken=page_token,
+            fields=f"nextPageToken,files({INDEX_FIELDS})"
+        ).execute()
+        write_index_batch(drive_id, [{**to_index_row(drive_id, f), "generation": generation} for f in page.get('files', [])], [])
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            execute_supabase(supabase.table("drive_index").delete().eq("user_drive_id", drive_id).neq("generation", generation))
+            return start_page_token
+
+def apply_drive_changes(service, drive_id: str, page_token: str) -> str:
+    """Apply every change since page_token to the index, returning the next start token"""
+    while True:
+        page = service.changes().list(
+            pageToken=page_token,
+            pageSize=DRIVE_SYNC_PAGE_SIZE,
+            includeRemoved=True,
+            spaces='drive',
+            fields=CHANGES_FIELDS
+        ).execute()
+
+        upserts, removals = [], []
+        for change in page.get('changes', []):
+            drive_file = change.get('file')
+            if change.get('removed') or not drive_file or drive_file.get('trashed'):
+                removals.append(change['fileId'])
+            else:
+                upserts.append(to_index_row(drive_id, drive_file))
+        write_index_batch(drive_id, upserts, removals)
+
+        if page.get('newStartPageToken'):
+            return page['newStartPageToken']
+        page_token = page['nextPageToken']
+
+drive_sync_flights = SingleFlight()
+
+def sync_drive_index(drive_data: dict) -> dict:
+    """Bring one drive's index up to date; overlapping syncs of a drive share one run"""
+    return drive_sync_flights.do(drive_data['id'], lambda: run_drive_index_sync(drive_data))
+
+def run_drive_index_sync(drive_data: dict) -> dict:
+    drive_id = drive_data['id']
+    service, _ = get_user_drive_service(drive_data)
+
+    update = {"indexed_at": datetime.utcnow().isoformat()}
+    page_token = drive_data.get('changes_page_token')
+    try:
+        page_token = apply_drive_changes(service, drive_id, page_token) if page_token else None
+    except HttpError as e:
+        # An expired or invalid token means the delta is lost - rebuild
+        if e.resp.status not in (400, 404, 410):
+            raise
+        page_token = None
+
+    if page_token is None:
+        update["root_folder_id"] = service.files().get(fileId='root', fields='id').execute()['id']
+        page_token = full_index_drive(service, drive_id)
+
+    update["changes_page_token"] = page_token
+    execute_supabase(supabase.table("user_drives").update(update).eq("id", drive_id))
+    return update
+
+async def sync_all_drive_indexes():
+    drives = await run_supabase(
+        supabase.table("user_drives").select("id,access_token,refresh_token,token_expires_at,changes_page_token")
+    )
+    results = await asyncio.gather(
+        *(run_blocking("drive", sync_drive_index, drive_data) for drive_data in drives.data),
+        return_exceptions=True
+    )
+    for drive_data, result in zip(drives.data, results):
+        if isinstance(result, Exception):
+            print(f"Index sync failed for drive {drive_data['id']}: {result}")
+
+if DRIVE_SYNC_ENABLED:
+    schedule_job("drive-index-sync", DRIVE_SYNC_INTERVAL, sync_all_drive_indexes)
+
+async def list_indexed_folder(drive_data: dict, folder_id: str, page_size: int, cursor: Optional[str]):
+    """Serve a folder listing from the local index with an offset cursor"""
+    if not 1 <= page_size <= LIST_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {LIST_MAX_PAGE_SIZE}")
+    if not drive_data.get('changes_page_token'):
+        raise HTTPException(status_code=409, detail="Drive index not built yet")
+
+    parent_id = drive_data['root_folder_id'] if folder_id == "root" else folder_id
+    offset = 0
+    if cursor:
+        state = decode_cursor(cursor)
+        if state.get('folder_id') != folder_id or not isinstance(state.get('offset'), int):
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this folder")
+        offset = state['offset']
+
+    # Fetch one extra row to know whether another page exists
+    result = await run_supabase(
+        supabase.table("drive_index").select(INDEX_COLUMNS)
+        .eq("user_drive_id", drive_data['id'])
+        .contains("parents", [parent_id])
+        .order("name")
+        .range(offset, offset + page_size)
+    )
+    rows = result.data
+    has_more = len(rows) > page_size
+    return {
+        "files": [from_index_row(row) for row in rows[:page_size]],
+        "next_cursor": encode_cursor({"folder_id": folder_id, "offset": offset + page_size}) if has_more else None
+    }
+
+# File search
+# Backed by the search_user_files function and name indexes in
+# supabase/migrations/20261017000000_file_search.sql
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_OFFSET = 1000
+SEARCH_MAX_TERMS = 8
+
+def build_prefix_tsquery(q: str) -> str:
+    """Turn free text into a prefix tsquery: 'quarterly rep' -> 'quarterly:* & rep:*'"""
+    terms = re.findall(r"[^\W_]+", q.lower())[:SEARCH_MAX_TERMS]
+    return " & ".join(f"{term}:*" for term in terms)
+
+def search_fingerprint(*params) -> str:
+    """Short digest of a search's query and filters, bound into its cursors"""
+    return hashlib.sha256(json.dumps(params, default=str).encode()).hexdigest()[:16]
+
+def escape_like(value: str) -> str:
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+# Drive batch requests
+DRIVE_BATCH_SIZE = 100  # Drive's limit on calls per batch HTTP request
+
+def execute_drive_batch(drive_service, drive_requests: list) -> dict:
+    """Run (request_id, HttpRequest) pairs as Drive batch calls of up to 100
+
+    Returns {request_id: (response, exception)}. A batch that fails as a
+    whole marks each of its requests with that error instead of raising.
+    """
+    results = {}
+
+    def record(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(drive_requests), DRIVE_BATCH_SIZE):
+        chunk = drive_requests[start:start + DRIVE_BATCH_SIZE]
+        batch = drive_service.new_batch_http_request(callback=record)
+        for request_id, drive_request in chunk:
+            batch.add(drive_request, request_id=request_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            for request_id, _ in chunk:
+                results.setdefault(request_id, (None, e))
+    return results
 
 # Models
 class DriveConnect(BaseModel):
@@ -165,23 +2480,871 @@ class ShareFile(BaseModel):
     expires_in_days: Optional[int] = None
     allow_download: bool = True
     allow_view: bool = True
+    signed: bool = False  # serve through a signed /s/ link instead of an "anyone" Drive permission
+
+class UserDriveConnect(BaseModel):
+    authorization_code: str
+    drive_name: str
+
+class RevokeShare(BaseModel):
+    file_id: str
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    mime_type: str = "application/octet-stream"
+    folder_id: str = "root"
+
+class BulkFileOperation(BaseModel):
+    action: str
+    file_ids: List[str]
+    share: Optional[ShareFile] = None
+
+class ArchiveRequest(BaseModel):
+    folder_id: Optional[str] = None
+    file_ids: List[str] = []
+    name: str = "archive"
+    compress: bool = False
+
+# Bulk file operations
+BULK_ACTIONS = ("delete", "share", "revoke")
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "1000"))
+
+def build_share_permission(share_data: ShareFile) -> tuple:
+    """Drive permission body and link expiry (ISO string or None) for a share"""
+    permission = {
+        'role': 'reader' if share_data.allow_view else 'writer',
+        'type': 'anyone'
+    }
+    expires_at = None
+    if share_data.expires_in_days:
+        expiration_time = datetime.utcnow() + timedelta(days=share_data.expires_in_days)
+        permission['expirationTime'] = expiration_time.isoformat() + 'Z'
+        expires_at = expiration_time.isoformat()
+    return permission, expires_at
+
+def build_share_link(file_id: str, share_data: ShareFile) -> str:
+    if share_data.allow_download:
+        return f"https://drive.google.com/uc?id={file_id}&export=download"
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+def bulk_error(exception: Exception) -> dict:
+    if isinstance(exception, HttpError):
+        return {"status": "error", "code": exception.resp.status, "error": exception.reason}
+    return {"status": "error", "code": 500, "error": str(exception)}
+
+def record_bulk_changes(drive_id: str, user_id: str, action: str, succeeded: dict, share_data: Optional[ShareFile], expires_at: Optional[str]):
+    """Apply the files table side of a bulk action in a single statement"""
+    file_ids = list(succeeded)
+    now = datetime.utcnow().isoformat()
+    if action == "delete":
+        execute_supabase(supabase.table("files").delete().eq("user_drive_id", drive_id).in_("drive_file_id", file_ids))
+    elif action == "revoke":
+        execute_supabase(supabase.table("files").update({
+            "shared_link": None,
+            "permission_id": None,
+            "share_nonce": None,
+            "link_expires_at": None,
+            "revoked_at": now,
+            "revoked_by": user_id
+        }).eq("user_drive_id", drive_id).in_("drive_file_id", file_ids))
+        for file_id in file_ids:
+            share_nonce_cache.pop((drive_id, file_id))
+    else:
+        # Links and permission IDs differ per file, so the update goes through one RPC
+        execute_supabase(supabase.rpc("record_file_shares", {
+            "p_user_drive_id": drive_id,
+            "p_shares": [
+                {"drive_file_id": file_id, "shared_link": build_share_link(file_id, share_data), "permission_id": permission['id']}
+                for file_id, permission in succeeded.items()
+            ],
+            "p_link_expires_at": expires_at,
+            "p_shared_by": user_id,
+            "p_shared_at": now
+        }))
+        # The RPC clears share_nonce too, so earlier signed links stop working
+        for file_id in file_ids:
+            share_nonce_cache.pop((drive_id, file_id))
+
+def run_bulk_operation(service, drive_id: str, user_id: str, action: str, file_ids: list, share_data: Optional[ShareFile] = None) -> list:
+    """Apply one action to many files of a user drive
+
+    Works through the IDs in chunks of DRIVE_BATCH_SIZE: one Drive batch
+    request and one files table write per chunk. Returns a result per file
+    ID in request order; a failed item never aborts the others.
+    """
+    results = {file_id: {"file_id": file_id, "status": "ok"} for file_id in file_ids}
+    permission, expires_at = build_share_permission(share_data) if action == "share" else (None, None)
+
+    for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+        chunk = file_ids[start:start + DRIVE_BATCH_SIZE]
+        local_only = []  # nothing left to do on Drive, only the files table
+
+        if action in ("delete", "share"):
+            properties = execute_drive_batch(service, [
+                (file_id, service.files().get(fileId=file_id, fields="appProperties")) for file_id in chunk
+            ])
+            drive_requests = []
+            for file_id in chunk:
+                metadata, exception = properties[file_id]
+                if action == "delete" and isinstance(exception, HttpError) and exception.resp.status == 404:
+                    local_only.append(file_id)
+                elif exception is not None:
+                    results[file_id].update(bulk_error(exception))
+                elif is_stripe(metadata):
+                    results[file_id].update({"status": "error", "code": 409, "error": STRIPE_CONFLICT})
+                elif action == "delete":
+                    drive_requests.append((file_id, service.files().delete(fileId=file_id)))
+                else:
+                    drive_requests.append((file_id, service.permissions().create(fileId=file_id, body=permission, fields='id')))
+        else:
+            file_rows = fetch_files_by_drive_file_ids(drive_id, chunk, "drive_file_id,permission_id,share_nonce")
+            drive_requests = []
+            for file_id in chunk:
+                row = file_rows.get(file_id)
+                if row is None:
+                    results[file_id].update({"status": "error", "code": 404, "error": "File not found"})
+                elif row.get('permission_id'):
+                    drive_requests.append((file_id, service.permissions().delete(fileId=file_id, permissionId=row['permission_id'])))
+                elif row.get('share_nonce'):
+                    # Signed links have no Drive permission; clearing the nonce revokes them
+                    local_only.append(file_id)
+                else:
+                    results[file_id].update({"status": "error", "code": 400, "error": "No active share found"})
+
+        responses = execute_drive_batch(service, drive_requests) if drive_requests else {}
+
+        succeeded = dict.fromkeys(local_only)
+        for file_id, (response, exception) in responses.items():
+            # A file or permission that is already gone counts as deleted/revoked
+            already_gone = action != "share" and isinstance(exception, HttpError) and exception.resp.status == 404
+            if exception is None or already_gone:
+                succeeded[file_id] = response
+            else:
+                results[file_id].update(bulk_error(exception))
+        if not succeeded:
+            continue
+
+        try:
+            record_bulk_changes(drive_id, user_id, action, succeeded, share_data, expires_at)
+        except Exception as e:
+            for file_id in succeeded:
+                results[file_id].update({"status": "error", "code": 500, "error": f"Drive updated but metadata write failed: {e}"})
+            continue
+
+        if action == "share":
+            for file_id, permission_result in succeeded.items():
+                results[file_id].update({
+                    "shared_link": build_share_link(file_id, share_data),
+                    "permission_id": permission_result['id'],
+                    "expires_at": expires_at
+                })
+
+    return [results[file_id] for file_id in file_ids]
+
+# ZIP archives
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+ARCHIVE_FIELDS = "id,name,mimeType,size,modifiedTime,appProperties"
+ARCHIVE_LIST_FIELDS = f"nextPageToken,files({ARCHIVE_FIELDS})"
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", "5000"))
+ARCHIVE_CONCURRENCY = int(os.getenv("ARCHIVE_CONCURRENCY", "4"))
+# Chunks of DOWNLOAD_CHUNK_SIZE buffered per prefetched file; memory use is
+# bounded by ARCHIVE_CONCURRENCY * ARCHIVE_BUFFER_CHUNKS * DOWNLOAD_CHUNK_SIZE
+ARCHIVE_BUFFER_CHUNKS = int(os.getenv("ARCHIVE_BUFFER_CHUNKS", "2"))
+
+def archive_member_name(prefix: str, name: str, used: set) -> str:
+    """Safe, unique path for a Drive file inside the archive"""
+    base = sanitize_filename(name.replace("/", "_")).lstrip(".") or "unnamed"
+    stem, dot, extension = base.rpartition(".")
+    if not dot:
+        stem, extension = base, ""
+    candidate, counter = prefix + base, 1
+    while candidate.lower() in used:
+        candidate = f"{prefix}{stem} ({counter}){dot}{extension}"
+        counter += 1
+    used.add(candidate.lower())
+    return candidate
+
+def collect_archive_entries(drive_service, folder_id: Optional[str], file_ids: list) -> list:
+    """Resolve a folder and/or file IDs into ordered (archive path, metadata) pairs
+
+    Folders are walked recursively. Google Docs and other native files have no
+    binary content to download and are skipped, as are stripes of pooled
+    files found in a folder; asking for a stripe by ID is a 409.
+    """
+    entries, used = [], set()
+    pending_folders = []
+
+    if folder_id:
+        pending_folders.append((folder_id, ""))
+    if file_ids:
+        responses = execute_drive_batch(drive_service, [
+            (file_id, drive_service.files().get(fileId=file_id, fields=ARCHIVE_FIELDS)) for file_id in file_ids
+        ])
+        for file_id in file_ids:
+            metadata, exception = responses[file_id]
+            if exception is not None:
+                if isinstance(exception, HttpError) and exception.resp.status == 404:
+                    raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+                raise exception
+            reject_stripe(metadata)
+            if metadata['mimeType'] == FOLDER_MIME_TYPE:
+                pending_folders.append((file_id, archive_member_name("", metadata['name'], used) + "/"))
+            elif not metadata['mimeType'].startswith("application/vnd.google-apps."):
+                entries.append((archive_member_name("", metadata['name'], used), metadata))
+
+    while pending_folders:
+        current_id, prefix = pending_folders.pop(0)
+        page_token = None
+        while True:
+            page = folder_list_request(drive_service, current_id, LIST_MAX_PAGE_SIZE, page_token, ARCHIVE_LIST_FIELDS).execute()
+            for drive_file in page.get('files', []):
+                if is_stripe(drive_file):
+                    continue
+                if drive_file['mimeType'] == FOLDER_MIME_TYPE:
+                    pending_folders.append((drive_file['id'], archive_member_name(prefix, drive_file['name'], used) + "/"))
+                elif not drive_file['mimeType'].startswith("application/vnd.google-apps."):
+                    entries.append((archive_member_name(prefix, drive_file['name'], used), drive_file))
+            if len(entries) > ARCHIVE_MAX_FILES:
+                raise HTTPException(status_code=400, detail=f"Archives are limited to {ARCHIVE_MAX_FILES} files")
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                break
+
+    if len(entries) > ARCHIVE_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Archives are limited to {ARCHIVE_MAX_FILES} files")
+    return entries
+
+class ZipStreamSink:
+    """Write-only, unseekable file object that collects zipfile output
+
+    Without tell/seek, zipfile writes data descriptors after each member
+    instead of seeking back, so the archive can be streamed as it is built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def zip_timestamp(metadata: dict) -> tuple:
+    modified = parse_utc_timestamp(metadata.get('modifiedTime')) or datetime.utcnow()
+    return max(modified, datetime(1980, 1, 1)).timetuple()[:6]
+
+async def stream_archive(drive_service, entries: list, compress: bool = False):
+    """Yield a ZIP of the given entries while up to ARCHIVE_CONCURRENCY files download ahead"""
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    sink = ZipStreamSink()
+    buffers, prefetches = {}, []
+
+    try:
+        with zipfile.ZipFile(sink, "w", compression=compression, allowZip64=True) as archive:
+            for index, (path, metadata) in enumerate(entries):
+                for ahead in range(index, min(index + ARCHIVE_CONCURRENCY, len(entries))):
+                    if ahead not in buffers:
+                        buffers[ahead] = asyncio.Queue(maxsize=ARCHIVE_BUFFER_CHUNKS)
+                        prefetches.append(asyncio.create_task(
+                            prefetch_drive_range(
+                                drive_service, entries[ahead][1]['id'], 0, int(entries[ahead][1].get('size', 0)) - 1, buffers[ahead]
+                            )
+                        ))
+                buffer = buffers[index]
+
+                info = zipfile.ZipInfo(path, date_time=zip_timestamp(metadata))
+                info.compress_type = compression
+                # Known up front so zipfile picks ZIP64 headers for members over 4 GiB
+                info.file_size = int(metadata.get('size', 0))
+                with archive.open(info, "w") as member:
+                    while True:
+                        chunk = await buffer.get()
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        if compress:
+                            # Deflate is CPU-bound, keep it off the event loop
+                            await run_blocking("disk", member.write, chunk)
+                        else:
+                            member.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                del buffers[index]
+                data = sink.drain()
+                if data:
+                    yield data
+        yield sink.drain()
+    finally:
+        for prefetch in prefetches:
+            prefetch.cancel()
+
+# Pooled storage
+# Uploads to the pool land on whichever connected drive has the most free
+# quota. With striping, large files are cut into STRIPE_SIZE pieces spread over
+# the drives and sent in parallel, and downloads fetch the pieces concurrently,
+# so transfers are not bound by one Google account's throughput.
+DRIVE_QUOTA_TTL = float(os.getenv("DRIVE_QUOTA_TTL", "300"))
+STRIPE_SIZE = int(os.getenv("STRIPE_SIZE", str(64 * 1024 * 1024)))
+STRIPE_CONCURRENCY = int(os.getenv("STRIPE_CONCURRENCY", "4"))
+STRIPE_BUFFER_CHUNKS = int(os.getenv("STRIPE_BUFFER_CHUNKS", "2"))
+POOLED_FILE_COLUMNS = "user_id,user_drive_id,drive_file_id,name,type,size,content_sha256,stripes"
+
+drive_quota_cache = TTLCache(1000, DRIVE_QUOTA_TTL, name="drive_quota")
+drive_quota_lock = threading.Lock()
+
+def get_drive_headroom(drive_id: str, drive_service) -> float:
+    """Free bytes on a drive from a cached about().get; inf when the account has no limit"""
+    quota = drive_quota_cache.get(drive_id)
+    if quota is None:
+        storage = drive_service.about().get(fields="storageQuota(limit,usage)").execute().get('storageQuota', {})
+        limit = int(storage['limit']) if storage.get('limit') else math.inf
+        quota = {"headroom": max(limit - int(storage.get('usage', 0)), 0)}
+        drive_quota_cache.set(drive_id, quota)
+    return quota["headroom"]
+
+def reserve_drive_space(drive_id: str, size: int):
+    """Count bytes already headed to a drive until its quota is next fetched"""
+    with drive_quota_lock:
+        quota = drive_quota_cache.get(drive_id)
+        if quota is not None:
+            quota["headroom"] -= size
+
+async def pool_headroom(data: "RequestData") -> list:
+    """(headroom, drive_data, service) for every usable drive, most headroom first"""
+    drives = await data.drives()
+    if not drives:
+        raise HTTPException(status_code=400, detail="No drives connected")
+
+    async def measure(drive_data):
+        try:
+            _, service = await data.drive_service(drive_data['id'])
+            return await run_blocking("drive", get_drive_headroom, drive_data['id'], service), drive_data, service
+        except HTTPException:
+            raise
+        except Exception as e:
+            # One unreachable drive shouldn't block the pool
+            print(f"Skipping drive {drive_data['id']} for placement: {e}")
+            return None
+
+    measured = [entry for entry in await asyncio.gather(*(measure(drive_data) for drive_data in drives)) if entry]
+    return sorted(measured, key=lambda entry: entry[0], reverse=True)
+
+def plan_stripes(size: int, pool: list) -> list:
+    """Assign STRIPE_SIZE pieces round the drives, keeping each within its headroom
+
+    Every piece goes to the drive holding the fewest pieces so far (most
+    headroom breaks ties), which spreads a file over as many drives as can
+    take it and so maximises parallel transfer.
+    """
+    headroom = {drive_data['id']: free for free, drive_data, _ in pool}
+    assigned = {drive_data['id']: 0 for _, drive_data, _ in pool}
+    stripes = []
+    for offset in range(0, size, STRIPE_SIZE):
+        length = min(STRIPE_SIZE, size - offset)
+        candidates = [drive_id for drive_id, free in headroom.items() if free >= length]
+        if not candidates:
+            raise HTTPException(status_code=507, detail="Not enough free space across connected drives")
+        drive_id = min(candidates, key=lambda candidate: (assigned[candidate], -headroom[candidate]))
+        headroom[drive_id] -= length
+        assigned[drive_id] += 1
+        stripes.append({"drive_id": drive_id, "offset": offset, "size": length})
+    return stripes
+
+class FileSlice:
+    """Read-only window onto part of a file, safe to read from several threads at once"""
+
+    def __init__(self, fileno: int, offset: int, size: int):
+        self.fileno = fileno
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def seek(self, position: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = min(max(base + position, 0), self.size)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self.position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        data = os.pread(self.fileno, size, self.offset + self.position) if size else b""
+        self.position += len(data)
+        return data
+
+async def upload_stripes(fileno: int, content_type: str, name: str, stripes: list, targets: dict, user_id: str) -> list:
+    """Upload every stripe in parallel; on failure the stripes already stored are removed"""
+    slots = asyncio.Semaphore(STRIPE_CONCURRENCY)
+
+    async def upload(index: int, stripe: dict):
+        drive_data, service = targets[stripe['drive_id']]
+        async with slots:
+            folder_id = await run_blocking("drive", get_user_folder_id, service, user_id, drive_data)
+            piece = UploadFile(FileSlice(fileno, stripe['offset'], stripe['size']), filename=name, headers=Headers({"content-type": content_type}))
+            drive_file = await run_blocking("drive", upload_to_drive, service, piece, {
+                'name': f"{name}.stripe{index:04d}",
+                'parents': [folder_id],
+                'appProperties': {'stripeOf': name, 'stripeIndex': str(index)}
+            })
+        return {**stripe, "drive_file_id": drive_file['id'], "folder_id": folder_id}
+
+    uploads = [asyncio.create_task(upload(index, stripe)) for index, stripe in enumerate(stripes)]
+    results = await asyncio.gather(*uploads, return_exceptions=True)
+    failure = next((result for result in results if isinstance(result, BaseException)), None)
+    if failure:
+        stored = [result for result in results if isinstance(result, dict)]
+        await delete_stripes(stored, {drive_id: service for drive_id, (_, service) in targets.items()})
+        raise failure
+    return results
+
+STRIPE_CONFLICT = "This is one stripe of a pooled file; use the /user/pooled routes for the whole file"
+
+def is_stripe(metadata: dict) -> bool:
+    return 'stripeOf' in (metadata.get('appProperties') or {})
+
+def reject_stripe(metadata: dict):
+    """409 for a stripe file, which on its own is just a slice of the pooled file's bytes"""
+    if is_stripe(metadata):
+        raise HTTPException(status_code=409, detail=STRIPE_CONFLICT)
+
+async def delete_stripes(stripes: list, services: dict):
+    """Best-effort removal of stripe files; ones already gone count as deleted"""
+    async def delete(stripe):
+        try:
+            await run_drive(services[stripe['drive_id']].files().delete(fileId=stripe['drive_file_id']))
+        except HttpError as e:
+            if e.resp.status != 404:
+                print(f"Failed to delete stripe {stripe['drive_file_id']}: {e}")
+        except Exception as e:
+            print(f"Failed to delete stripe {stripe['drive_file_id']}: {e}")
+        drive_quota_cache.pop(stripe['drive_id'])
+
+    await asyncio.gather(*(delete(stripe) for stripe in stripes))
+
+async def stream_stripes(pieces: list):
+    """Yield the bytes of (service, drive_file_id, start, end) pieces in order, up to STRIPE_CONCURRENCY ahead"""
+    buffers, prefetches = {}, []
+    try:
+        for index in range(len(pieces)):
+            for ahead in range(index, min(index + STRIPE_CONCURRENCY, len(pieces))):
+                if ahead not in buffers:
+                    buffers[ahead] = asyncio.Queue(maxsize=STRIPE_BUFFER_CHUNKS)
+                    prefetches.append(asyncio.create_task(prefetch_drive_range(*pieces[ahead], buffers[ahead])))
+            buffer = buffers.pop(index)
+            while True:
+                chunk = await buffer.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+    finally:
+        for prefetch in prefetches:
+            prefetch.cancel()
+
+def build_striped_response(file_data: dict, services: dict, request: Request) -> Response:
+    """Stream a striped file, honouring Range/If-Range and If-None-Match like build_download_response"""
+    file_size = int(file_data['size'])
+    etag = f"\"{file_data.get('content_sha256') or file_data['drive_file_id']}\""
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    byte_range = parse_range_header(request.headers.get("range"), file_size)
+    if_range = request.headers.get("if-range")
+    if byte_range and if_range and if_range != etag:
+        byte_range = None
+
+    start, end = byte_range or (0, file_size - 1)
+    pieces = [
+        (services[stripe['drive_id']], stripe['drive_file_id'],
+         max(start - stripe['offset'], 0), min(end - stripe['offset'], stripe['size'] - 1))
+        for stripe in file_data['stripes']
+        if stripe['offset'] <= end and stripe['offset'] + stripe['size'] > start
+    ]
+    headers = {
+        "Content-Disposition": f"attachment; filename={file_data['name']}",
+        "Content-Length": str(end - start + 1 if file_size else 0),
+        "Accept-Ranges": "bytes",
+        "ETag": etag
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+
+    return StreamingResponse(
+        stream_stripes(pieces),
+        status_code=206 if byte_range else 200,
+        media_type=file_data.get('type') or 'application/octet-stream',
+        headers=headers
+    )
+
+# Supabase Authentication
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL", f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json")
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWT_VERIFY_MODE = os.getenv("JWT_VERIFY_MODE", "local")  # "local" or "remote"
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", "300"))
+JWT_LEEWAY = int(os.getenv("JWT_LEEWAY", "30"))
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", "3600"))
+JWKS_MIN_REFRESH_INTERVAL = 60
+
+verified_token_cache = TTLCache(JWT_CACHE_SIZE, JWT_CACHE_TTL, name="verified_token")
+jwks_state = {"keys": {}, "fetched_at": 0.0, "attempted_at": -math.inf}
+jwks_lock = threading.Lock()
+
+class TokenVerificationError(Exception):
+    """The token is malformed, expired or carries a bad signature"""
+
+class UnsupportedTokenError(Exception):
+    """The token cannot be checked locally and needs the remote check"""
+
+def b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def b64url_to_int(segment: str) -> int:
+    return int.from_bytes(b64url_decode(segment), "big")
+
+def load_jwk(jwk: dict):
+    """Turn a JWKS entry into a cryptography public key"""
+    if jwk.get('kty') == 'RSA':
+        return RSAPublicNumbers(b64url_to_int(jwk['e']), b64url_to_int(jwk['n'])).public_key()
+    if jwk.get('kty') == 'EC' and jwk.get('crv') == 'P-256':
+        return EllipticCurvePublicNumbers(b64url_to_int(jwk['x']), b64url_to_int(jwk['y']), SECP256R1()).public_key()
+    return None
+
+def get_jwks_key(kid: Optional[str]):
+    """Return the signing key for kid, refetching the JWKS when stale or the kid is unknown
+
+    An unknown kid, including one we couldn't fetch, raises UnsupportedTokenError
+    so the token falls back to the remote check.
+    """
+    with jwks_lock:
+        now = time.monotonic()
+        stale = now - jwks_state['fetched_at'] > JWKS_CACHE_TTL or kid not in jwks_state['keys']
+        if stale and now - jwks_state['attempted_at'] > JWKS_MIN_REFRESH_INTERVAL:
+            jwks_state['attempted_at'] = now
+            try:
+                with track_upstream("supabase", "GET auth/jwks"):
+                    response = requests.get(SUPABASE_JWKS_URL, timeout=5)
+                response.raise_for_status()
+                keys = {}
+                for jwk in response.json().get('keys', []):
+                    public_key = load_jwk(jwk)
+                    if public_key is not None:
+                        keys[jwk.get('kid')] = public_key
+                jwks_state['keys'] = keys
+                jwks_state['fetched_at'] = now
+            except (requests.RequestException, ValueError) as e:
+                # Keep any keys we had; tokens we can't check go to the remote check
+                print(f"JWKS fetch failed: {e}")
+        public_key = jwks_state['keys'].get(kid)
+
+    if public_key is None:
+        raise UnsupportedTokenError(f"Unknown signing key {kid}")
+    return public_key
+
+def decode_jwt(token: str):
+    """Split a JWT into (header, payload, signing_input, signature) without verifying it"""
+    try:
+        header_segment, payload_segment, signature_segment = token.split('.')
+        header = json.loads(b64url_decode(header_segment))
+        payload = json.loads(b64url_decode(payload_segment))
+        signature = b64url_decode(signature_segment)
+    except ValueError:
+        raise TokenVerificationError("Malformed token")
+    return header, payload, f"{header_segment}.{payload_segment}".encode(), signature
+
+def verify_jwt_signature(header: dict, signing_input: bytes, signature: bytes):
+    alg = header.get('alg')
+    if alg == 'HS256':
+        if not SUPABASE_JWT_SECRET:
+            raise UnsupportedTokenError("No JWT secret configured")
+        expected = hmac.new(SUPABASE_JWT_SECRET.encode(), signing_input, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, signature):
+            raise TokenVerificationError("Bad signature")
+        return
+
+    if alg not in ('RS256', 'ES256'):
+        raise UnsupportedTokenError(f"Unsupported algorithm {alg}")
+
+    public_key = get_jwks_key(header.get('kid'))
+    try:
+        if alg == 'RS256':
+            public_key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+        else:
+            # JWS carries ECDSA signatures as raw r || s
+            der_signature = encode_dss_signature(
+                int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big")
+            )
+            public_key.verify(der_signature, signing_input, ECDSA(hashes.SHA256()))
+    except (InvalidSignature, TypeError):
+        raise TokenVerificationError("Bad signature")
+
+def verify_jwt_locally(token: str) -> dict:
+    """Verify signature, expiry and audience of a Supabase access token"""
+    header, payload, signing_input, signature = decode_jwt(token)
+    verify_jwt_signature(header, signing_input, signature)
+
+    now = time.time()
+    if not isinstance(payload.get('exp'), (int, float)) or payload['exp'] + JWT_LEEWAY < now:
+        raise TokenVerificationError("Token expired")
+    if isinstance(payload.get('nbf'), (int, float)) and payload['nbf'] - JWT_LEEWAY > now:
+        raise TokenVerificationError("Token not yet valid")
+    audience = payload.get('aud')
+    audiences = audience if isinstance(audience, list) else [audience]
+    if SUPABASE_JWT_AUDIENCE and SUPABASE_JWT_AUDIENCE not in audiences:
+        raise TokenVerificationError("Wrong audience")
+    if not payload.get('sub'):
+        raise TokenVerificationError("Token has no subject")
+    return payload
+
+def verify_token_remotely(token: str) -> str:
+    with track_upstream("supabase", "GET auth/user"):
+        user = supabase.auth.get_user(token)
+    if not user.user:
+        raise TokenVerificationError("Invalid token")
+    return user.user.id
+
+def verify_token(token: str):
+    """Verify a token locally when possible, returning (user_id, claims)"""
+    try:
+        if JWT_VERIFY_MODE == "remote":
+            raise UnsupportedTokenError("Remote verification configured")
+        payload = verify_jwt_locally(token)
+        return payload['sub'], payload
+    except UnsupportedTokenError:
+        return verify_token_remotely(token), decode_jwt(token)[1]
+
+async def verify_supabase_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    user_id = verified_token_cache.get(cache_key)
+    if user_id:
+        return user_id
+
+    try:
+        # JWKS and remote lookups block, so misses go through the shared pool
+        user_id, payload = await run_blocking("supabase", verify_token, token)
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    # Never cache a token beyond its own expiry
+    exp = payload.get('exp')
+    ttl = min(JWT_CACHE_TTL, exp - time.time()) if isinstance(exp, (int, float)) else JWT_CACHE_TTL
+    verified_token_cache.set(cache_key, user_id, ttl)
+    return user_id
+
+async def verify_supabase_token_strict(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Always confirm the token with Supabase, for revocation-sensitive routes"""
+    try:
+        return await run_blocking("supabase", verify_token_remotely, credentials.credentials)
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+# Request-scoped data access
+# Routes ask for just the columns they use, and each row (and the Drive client
+# built from a drive row) is fetched at most once per request
+DRIVE_CREDENTIAL_COLUMNS = "id,access_token,refresh_token,token_expires_at,user_folder_id"
+DRIVE_INDEX_COLUMNS = DRIVE_CREDENTIAL_COLUMNS + ",root_folder_id,changes_page_token"
+DRIVE_SUMMARY_COLUMNS = "id,drive_type,drive_name,created_at,indexed_at"
+FILE_SUMMARY_COLUMNS = "id,user_drive_id,drive_file_id,name,type,size,folder_id,shared_link,link_expires_at,shared_at,created_at"
+IN_QUERY_CHUNK = 100  # keeps in_ filters well inside PostgREST's URL length limit
+
+def fetch_files_by_drive_file_ids(drive_id: str, drive_file_ids: list, columns: str) -> dict:
+    """Rows of files on one drive keyed by drive_file_id, one in_ query per chunk"""
+    rows = {}
+    for start in range(0, len(drive_file_ids), IN_QUERY_CHUNK):
+        result = execute_supabase(supabase.table("files").select(columns)
+                                  .eq("user_drive_id", drive_id).in_("drive_file_id", drive_file_ids[start:start + IN_QUERY_CHUNK]))
+        rows.update((row['drive_file_id'], row) for row in result.data)
+    return rows
+
+class RequestData:
+    """Memoized Supabase lookups for one request
+
+    Drive lookups are scoped to the calling user. File lookups are not: the
+    /shared routes work on any file of the shared drive, so routes that need
+    ownership (the pooled ones) check user_id on the row themselves.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self._pending = {}
+
+    async def _load(self, key: tuple, fetch):
+        # Concurrent callers within the request share one query
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(fetch())
+        return await self._pending[key]
+
+    async def drive(self, drive_id: str, columns: str = DRIVE_CREDENTIAL_COLUMNS) -> dict:
+        async def fetch():
+            result = await run_supabase(
+                supabase.table("user_drives").select(columns).eq("id", drive_id).eq("user_id", self.user_id)
+            )
+            if not result.data:
+                raise HTTPException(status_code=404, detail="Drive not found")
+            return result.data[0]
+        return await self._load(("drive", drive_id, columns), fetch)
+
+    async def drives(self, columns: str = DRIVE_CREDENTIAL_COLUMNS) -> list:
+        async def fetch():
+            result = await run_supabase(
+                supabase.table("user_drives").select(columns).eq("user_id", self.user_id).order("created_at")
+            )
+            # Later single-drive lookups with the same columns are already answered
+            for row in result.data:
+                known = asyncio.get_running_loop().create_future()
+                known.set_result(row)
+                self._pending.setdefault(("drive", row['id'], columns), known)
+            return result.data
+        return await self._load(("drives", columns), fetch)
+
+    async def drive_count(self) -> int:
+        async def fetch():
+            # Counted by PostgREST; at most one row comes back
+            result = await run_supabase(
+                supabase.table("user_drives").select("id", count="exact").eq("user_id", self.user_id).limit(1)
+            )
+            return result.count or 0
+        return await self._load(("drive_count",), fetch)
+
+    async def drive_service(self, drive_id: str, columns: str = DRIVE_CREDENTIAL_COLUMNS):
+        """Drive row plus its client, decrypting the tokens once per request"""
+        drive_data = await self.drive(drive_id, columns)
+
+        async def build():
+            service, _ = get_user_drive_service(drive_data)
+            return service
+        return drive_data, await self._load(("drive_service", drive_id), build)
+
+    async def file(self, file_id: str, columns: str) -> dict:
+        """A files row by ID, whoever owns it"""
+        async def fetch():
+            result = await run_supabase(supabase.table("files").select(columns).eq("id", file_id))
+            if not result.data:
+                raise HTTPException(status_code=404, detail="File not found")
+            return result.data[0]
+        return await self._load(("file", file_id, columns), fetch)
+
+    async def drive_files(self, drive_id: str, drive_file_ids: list, columns: str) -> dict:
+        """Rows for many Drive files on one of the user's drives, keyed by drive_file_id"""
+        await self.drive(drive_id)
+        wanted = list(dict.fromkeys(drive_file_ids))
+        columns = columns if "drive_file_id" in columns.split(",") else f"drive_file_id,{columns}"
+        return await self._load(
+            ("drive_files", drive_id, tuple(wanted), columns),
+            lambda: run_blocking("supabase", fetch_files_by_drive_file_ids, drive_id, wanted, columns)
+        )
+
+async def get_request_data(user_id: str = Depends(verify_supabase_token)) -> RequestData:
+    return RequestData(user_id)
+
+# Signed share links
+# /s/{token} links carry the file, its drive, an expiry and the share's nonce
+# under an HMAC, so an expired link simply stops verifying. The nonce must
+# still match files.share_nonce (read through a short cache), so revoking the
+# share invalidates its links; rotating the signing keys invalidates all of
+# them. Content streams through build_download_response with
+# Cache-Control/ETag, so a CDN in front of SIGNED_LINK_BASE_URL (or the local
+# content cache) absorbs repeated hits, which also bounds how long a revoked
+# link may keep being served from there.
+SIGNED_LINK_BASE_URL = os.getenv("SIGNED_LINK_BASE_URL", "")  # defaults to the URL the API was reached on
+SIGNED_LINK_DEFAULT_DAYS = int(os.getenv("SIGNED_LINK_DEFAULT_DAYS", "7"))
+SIGNED_LINK_MAX_DAYS = int(os.getenv("SIGNED_LINK_MAX_DAYS", "30"))
+SIGNED_LINK_CACHE_MAX_AGE = int(os.getenv("SIGNED_LINK_CACHE_MAX_AGE", "3600"))
+SIGNED_LINK_DRIVE_TTL = float(os.getenv("SIGNED_LINK_DRIVE_TTL", "60"))
+SIGNED_LINK_REVOCATION_TTL = float(os.getenv("SIGNED_LINK_REVOCATION_TTL", "30"))  # how stale a nonce check may be
+SIGNED_LINK_RATE_LIMIT = os.getenv("SIGNED_LINK_RATE_LIMIT", "600/minute")  # per client IP; a CDN counts as one
+
+def load_signing_keys() -> list:
+    """SHARE_SIGNING_KEYS (comma-separated, newest first), else keys derived from the token key ring"""
+    configured = os.getenv("SHARE_SIGNING_KEYS", "")
+    if configured:
+        return [key.strip().encode() for key in configured.split(",") if key.strip()]
+    # Rotating ENCRYPTION_KEYS rotates these along with it
+    return [hmac.new(key.encode(), b"signed-share-links", hashlib.sha256).digest() for key in ENCRYPTION_KEYS]
+
+SIGNING_KEYS = load_signing_keys()
+signed_link_drive_cache = TTLCache(1000, SIGNED_LINK_DRIVE_TTL, name="signed_link_drive")
+share_nonce_cache = TTLCache(10000, SIGNED_LINK_REVOCATION_TTL, name="share_nonce")
 
-class UserDriveConnect(BaseModel):
-    authorization_code: str
-    drive_name: str
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
 
-class RevokeShare(BaseModel):
-    file_id: str
+def share_signature(key: bytes, payload: str) -> bytes:
+    # 144 bits is plenty against forgery and keeps links short
+    return hmac.new(key, payload.encode(), hashlib.sha256).digest()[:18]
 
-# Supabase Authentication
-def verify_supabase_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def sign_share_token(drive_file_id: str, user_drive_id: Optional[str], expires_at: int, download: bool, nonce: str) -> str:
+    payload = b64url_encode("|".join([user_drive_id or "", drive_file_id, format(expires_at, "x"), "d" if download else "v", nonce]).encode())
+    return f"{payload}.{b64url_encode(share_signature(SIGNING_KEYS[0], payload))}"
+
+def verify_share_token(token: str) -> dict:
+    """Check a link's signature (against every key) and expiry"""
+    payload, _, signature = token.partition(".")
     try:
-        user = supabase.auth.get_user(credentials.credentials)
-        if not user.user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return user.user.id
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        signature_bytes = b64url_decode(signature)
+        fields = b64url_decode(payload).decode().split("|")
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=404, detail="Link not found")
+    if not any(hmac.compare_digest(share_signature(key, payload), signature_bytes) for key in SIGNING_KEYS) or len(fields) != 5:
+        raise HTTPException(status_code=404, detail="Link not found")
+
+    user_drive_id, drive_file_id, expires_at, mode, nonce = fields
+    expires_at = int(expires_at, 16)
+    if expires_at <= time.time():
+        raise HTTPException(status_code=410, detail="Link expired")
+    return {"user_drive_id": user_drive_id or None, "drive_file_id": drive_file_id, "expires_at": expires_at, "download": mode == "d", "nonce": nonce}
+
+def build_signed_share(request: Request, drive_file_id: str, user_drive_id: Optional[str], share_data: ShareFile) -> tuple:
+    """Signed URL, its expiry (ISO string) and the nonce to store as files.share_nonce"""
+    days = share_data.expires_in_days or SIGNED_LINK_DEFAULT_DAYS
+    if not 1 <= days <= SIGNED_LINK_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Signed links expire within 1 to {SIGNED_LINK_MAX_DAYS} days")
+    expires_at = datetime.utcnow().replace(microsecond=0) + timedelta(days=days)
+    nonce = secrets.token_urlsafe(9)
+    token = sign_share_token(drive_file_id, user_drive_id, int(expires_at.replace(tzinfo=timezone.utc).timestamp()), share_data.allow_download, nonce)
+    base_url = (SIGNED_LINK_BASE_URL or str(request.base_url)).rstrip("/")
+    return f"{base_url}/s/{token}", expires_at.isoformat(), nonce
+
+def current_share_nonce(user_drive_id: Optional[str], drive_file_id: str) -> str:
+    """The file's live signed-share nonce, "" once revoked; cached for SIGNED_LINK_REVOCATION_TTL"""
+    nonce = share_nonce_cache.get((user_drive_id, drive_file_id))
+    if nonce is None:
+        query = supabase.table("files").select("share_nonce").eq("drive_file_id", drive_file_id)
+        query = query.eq("user_drive_id", user_drive_id) if user_drive_id else query.is_("user_drive_id", "null")
+        rows = execute_supabase(query).data
+        nonce = next((row['share_nonce'] for row in rows if row.get('share_nonce')), "")
+        share_nonce_cache.set((user_drive_id, drive_file_id), nonce)
+    return nonce
+
+def signed_link_service(user_drive_id: Optional[str]):
+    """Drive client for a link's drive; user drive rows are cached briefly instead of read per hit"""
+    if not user_drive_id:
+        return get_drive_service()
+    drive_data = signed_link_drive_cache.get(user_drive_id)
+    if drive_data is None:
+        result = execute_supabase(supabase.table("user_drives").select(DRIVE_CREDENTIAL_COLUMNS).eq("id", user_drive_id))
+        if not result.data:
+            raise HTTPException(status_code=404, detail="Link not found")
+        drive_data = result.data[0]
+        signed_link_drive_cache.set(user_drive_id, drive_data)
+    return get_user_drive_service(drive_data)[0]
 
 # Root endpoint
 @app.get("/")
@@ -192,34 +3355,45 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN:
+        authorization = request.headers.get("authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Auth handled by Supabase client-side - no server endpoints needed
 
 @app.get("/user/drives")
 @limiter.limit("30/minute")
-async def get_user_drives(request: Request, user_id: str = Depends(verify_supabase_token)):
+async def get_user_drives(request: Request, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
-        result = supabase.table("user_drives").select("*").eq("user_id", user_id).execute()
-        return {"drives": result.data}
+        return {"drives": await data.drives(DRIVE_SUMMARY_COLUMNS)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get drives: {str(e)}")
 
 @app.post("/user/connect-drive")
 @limiter.limit("5/minute")
-async def connect_user_drive(request: Request, drive_data: UserDriveConnect, user_id: str = Depends(verify_supabase_token)):
+async def connect_user_drive(request: Request, drive_data: UserDriveConnect, user_id: str = Depends(verify_supabase_token_strict)):
     # Check drive limit (max 4 drives per user)
-    existing_drives = supabase.table("user_drives").select("id").eq("user_id", user_id).execute()
-    if len(existing_drives.data) >= 4:
+    if await RequestData(user_id).drive_count() >= 4:
         raise HTTPException(status_code=400, detail="Maximum 4 drives allowed per user")
     
     try:
         # Exchange authorization code for tokens
-        token_response = requests.post('https://oauth2.googleapis.com/token', data={
-            'client_id': GOOGLE_CLIENT_ID,
-            'client_secret': GOOGLE_CLIENT_SECRET,
-            'code': drive_data.authorization_code,
-            'grant_type': 'authorization_code',
-            'redirect_uri': 'http://localhost:8000/oauth/callback'
-        })
+        with track_upstream("oauth", "code_exchange") as tracker:
+            token_response = await run_blocking("oauth", backends["oauth_post"], 'https://oauth2.googleapis.com/token', data={
+                'client_id': GOOGLE_CLIENT_ID,
+                'client_secret': GOOGLE_CLIENT_SECRET,
+                'code': drive_data.authorization_code,
+                'grant_type': 'authorization_code',
+                'redirect_uri': 'http://localhost:8000/oauth/callback'
+            })
+            if token_response.status_code != 200:
+                tracker.outcome = "client_error"
         
         if token_response.status_code != 200:
             raise HTTPException(status_code=400, detail="Invalid authorization code")
@@ -230,37 +3404,59 @@ async def connect_user_drive(request: Request, drive_data: UserDriveConnect, use
         encrypted_access = encrypt_token(tokens['access_token'])
         encrypted_refresh = encrypt_token(tokens.get('refresh_token')) if tokens.get('refresh_token') else None
         
-        result = supabase.table("user_drives").insert({
+        result = await run_supabase(supabase.table("user_drives").insert({
             "user_id": user_id,
             "drive_type": "personal",
             "access_token": encrypted_access,
             "refresh_token": encrypted_refresh,
+            "token_expires_at": (datetime.utcnow() + timedelta(seconds=int(tokens.get('expires_in', 3600)))).isoformat(),
             "drive_name": sanitize_filename(drive_data.drive_name),
             "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        }))
         
         return {"message": "Drive connected successfully", "drive_id": result.data[0]["id"]}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Drive connection failed: {str(e)}")
 
 @app.post("/connect-drive")
-async def connect_drive(drive: DriveConnect, user_id: str = Depends(verify_supabase_token)):
-    result = supabase.table("user_drives").insert({
+async def connect_drive(drive: DriveConnect, user_id: str = Depends(verify_supabase_token_strict)):
+    result = await run_supabase(supabase.table("user_drives").insert({
         "user_id": user_id,
         "drive_type": drive.drive_type,
         "access_token": drive.access_token,
         "refresh_token": drive.refresh_token,
         "drive_name": drive.drive_name,
         "created_at": datetime.utcnow().isoformat()
-    }).execute()
+    }))
     
     return {"message": "Drive connected successfully", "drive_id": result.data[0]["id"]}
 
 @app.get("/list-files")
-async def list_files(user_id: str = Depends(verify_supabase_token)):
-    # Placeholder - implement drive API integration
-    return {"files": []}
+@weighted_limit(2)
+async def list_files(request: Request, scope: str = "root", page_size: int = LIST_DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, stream: bool = False, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    if scope not in UNIFIED_LIST_QUERIES:
+        raise HTTPException(status_code=400, detail=f"scope must be one of {', '.join(UNIFIED_LIST_QUERIES)}")
+    if not 1 <= page_size <= LIST_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {LIST_MAX_PAGE_SIZE}")
+    
+    try:
+        # Every connected drive is queried concurrently
+        drives = await data.drives()
+        
+        if stream:
+            return StreamingResponse(
+                stream_all_drives(drives, scope, page_size),
+                media_type="application/x-ndjson"
+            )
+        return await list_all_drives_page(drives, scope, page_size, cursor)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"List files failed: {str(e)}")
 
 @app.post("/upload-file")
 async def upload_file(user_id: str = Depends(verify_supabase_token)):
@@ -278,14 +3474,16 @@ async def delete_file(file_id: str, user_id: str = Depends(verify_supabase_token
     return {"message": "File deletion endpoint"}
 
 @app.post("/shared/upload")
-async def shared_upload(file: UploadFile = File(...), user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(5)
+async def shared_upload(request: Request, file: UploadFile = File(...), deferred: bool = False, user_id: str = Depends(verify_supabase_token)):
+    if deferred:
+        return await enqueue_upload_job(file, user_id, None, "root")
+    
     try:
         drive_service = get_drive_service()
         
-        # Get user email and create user folder
-        user_email = get_user_email_from_token(user_id)
-        base_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID', 'root')
-        user_folder_id = create_user_folder(drive_service, user_email, base_folder_id)
+        # Resolve (or create once) the user's folder
+        user_folder_id = await run_blocking("drive", get_user_folder_id, drive_service, user_id)
         
         # Upload to user's folder in shared drive
         file_metadata = {
@@ -293,119 +3491,152 @@ async def shared_upload(file: UploadFile = File(...), user_id: str = Depends(ver
             'parents': [user_folder_id]
         }
         
-        media = MediaIoBaseUpload(
-            io.BytesIO(await file.read()),
-            mimetype=file.content_type or 'application/octet-stream'
-        )
+        stored = await run_blocking("drive", store_upload, drive_service, file, file_metadata, user_id)
         
-        drive_file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id,name,size,mimeType'
-        ).execute()
+        # Identical content already stored here - nothing was transferred
+        existing_file = stored['existing_file']
+        if existing_file:
+            return {
+                "file_id": existing_file['id'],
+                "drive_file_id": existing_file['drive_file_id'],
+                "name": existing_file['name'],
+                "size": existing_file['size'],
+                "user_folder_id": user_folder_id,
+                "deduplicated": stored['deduplicated']
+            }
         
         # Store metadata in Supabase
-        result = supabase.table("files").insert({
+        drive_file = stored['drive_file']
+        result = await run_supabase(supabase.table("files").insert({
             "user_drive_id": None,
             "drive_file_id": drive_file['id'],
             "name": drive_file['name'],
             "type": drive_file.get('mimeType', 'unknown'),
             "size": int(drive_file.get('size', 0)),
+            "content_sha256": stored['content_sha256'],
             "folder_id": user_folder_id,
             "user_id": user_id,
             "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        }))
         
         return {
             "file_id": result.data[0]["id"],
             "drive_file_id": drive_file['id'],
             "name": drive_file['name'],
             "size": drive_file.get('size', 0),
-            "user_folder_id": user_folder_id
+            "user_folder_id": user_folder_id,
+            "deduplicated": stored['deduplicated']
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 @app.get("/shared/list")
-async def shared_list(folder_id: str = "root", user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(1)
+async def shared_list(request: Request, folder_id: str = "root", page_size: int = LIST_DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, stream: bool = False, user_id: str = Depends(verify_supabase_token)):
     try:
         drive_service = get_drive_service()
         
         # List files in shared drive folder
-        query = f"'{folder_id}' in parents and trashed=false"
-        results = drive_service.files().list(
-            q=query,
-            fields="files(id,name,mimeType,size,modifiedTime,parents)"
-        ).execute()
-        
-        return {"files": results.get('files', [])}
+        return await list_folder(drive_service, folder_id, page_size, cursor, stream)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"List files failed: {str(e)}")
 
 @app.get("/shared/download/{file_id}")
-async def shared_download(file_id: str, user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(2)
+async def shared_download(request: Request, file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get file metadata from Supabase
-        result = supabase.table("files").select("*").eq("id", file_id).execute()
-        if not result.data:
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        file_data = result.data[0]
+        file_data = await data.file(file_id, "drive_file_id,name")
         drive_service = get_drive_service()
         
-        # Download from Google Drive
-        request = drive_service.files().get_media(fileId=file_data['drive_file_id'])
-        file_io = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_io, request)
-        
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        
-        file_io.seek(0)
+        # Stream from Google Drive chunk by chunk
+        return await run_blocking("drive", build_download_response, drive_service, file_data['drive_file_id'], request, file_data['name'], True)
         
-        return StreamingResponse(
-            io.BytesIO(file_io.read()),
-            media_type='application/octet-stream',
-            headers={"Content-Disposition": f"attachment; filename={file_data['name']}"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+
+@app.get("/s/{token}")
+@limiter.limit(SIGNED_LINK_RATE_LIMIT)
+async def signed_share_download(request: Request, token: str):
+    link = verify_share_token(token)
+    try:
+        nonce = await run_blocking("supabase", current_share_nonce, link['user_drive_id'], link['drive_file_id'])
+        if not hmac.compare_digest(nonce, link['nonce']):
+            raise HTTPException(status_code=410, detail="Link revoked")
+        service = await run_blocking("supabase", signed_link_service, link['user_drive_id'])
+        response = await run_blocking(
+            "drive", build_download_response, service, link['drive_file_id'], request,
+            use_cache=True, inline=not link['download']
         )
-        
+    except HTTPException:
+        raise
+    except HttpError as e:
+        if e.resp.status == 404:
+            raise HTTPException(status_code=404, detail="Link not found")
+        raise HTTPException(status_code=502, detail="File temporarily unavailable")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
 
+    # Shared caches may keep the body until the link expires, never longer
+    max_age = max(min(SIGNED_LINK_CACHE_MAX_AGE, int(link['expires_at'] - time.time())), 0)
+    response.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return response
+
 @app.delete("/shared/delete/{file_id}")
-async def shared_delete(file_id: str, user_id: str = Depends(verify_supabase_token)):
+async def shared_delete(file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get file metadata from Supabase
-        result = supabase.table("files").select("*").eq("id", file_id).execute()
-        if not result.data:
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        file_data = result.data[0]
+        file_data = await data.file(file_id, "drive_file_id")
         drive_service = get_drive_service()
         
         # Delete from Google Drive
-        drive_service.files().delete(fileId=file_data['drive_file_id']).execute()
+        await run_drive(drive_service.files().delete(fileId=file_data['drive_file_id']))
         
         # Delete from Supabase
-        supabase.table("files").delete().eq("id", file_id).execute()
+        await run_supabase(supabase.table("files").delete().eq("id", file_id))
         
         return {"message": "File deleted successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete failed: {str(e)}")
 
 @app.post("/shared/share/{file_id}")
-async def shared_share(file_id: str, share_data: ShareFile, user_id: str = Depends(verify_supabase_token)):
+async def shared_share(request: Request, file_id: str, share_data: ShareFile, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get file metadata from Supabase
-        result = supabase.table("files").select("*").eq("id", file_id).execute()
-        if not result.data:
-            raise HTTPException(status_code=404, detail="File not found")
+        file_data = await data.file(file_id, "drive_file_id")
+        
+        if share_data.signed:
+            # The link itself carries access and expiry; no Drive permission is granted
+            public_link, expires_at, nonce = build_signed_share(request, file_data['drive_file_id'], None, share_data)
+            result = await run_supabase(supabase.table("files").update({
+                "shared_link": public_link,
+                "permission_id": None,
+                "share_nonce": nonce,
+                "link_expires_at": expires_at,
+                "shared_by": user_id,
+                "shared_at": datetime.utcnow().isoformat()
+            }).eq("id", file_id))
+            if not result.data:
+                raise HTTPException(status_code=404, detail="File not found")
+            share_nonce_cache.set((None, file_data['drive_file_id']), nonce)
+            return {
+                "shared_link": public_link,
+                "permission_id": None,
+                "expires_at": expires_at,
+                "message": "File shared successfully"
+            }
         
-        file_data = result.data[0]
         drive_service = get_drive_service()
         
         # Create permission with expiration if specified
@@ -418,11 +3649,11 @@ async def shared_share(file_id: str, share_data: ShareFile, user_id: str = Depen
             expiration_time = datetime.utcnow() + timedelta(days=share_data.expires_in_days)
             permission['expirationTime'] = expiration_time.isoformat() + 'Z'
         
-        permission_result = drive_service.permissions().create(
+        permission_result = await run_drive(drive_service.permissions().create(
             fileId=file_data['drive_file_id'],
             body=permission,
             fields='id'
-        ).execute()
+        ))
         
         # Generate public link
         if share_data.allow_download:
@@ -436,13 +3667,15 @@ async def shared_share(file_id: str, share_data: ShareFile, user_id: str = Depen
             expires_at = (datetime.utcnow() + timedelta(days=share_data.expires_in_days)).isoformat()
         
         # Update Supabase with shared link and metadata
-        supabase.table("files").update({
+        await run_supabase(supabase.table("files").update({
             "shared_link": public_link,
             "permission_id": permission_result['id'],
+            "share_nonce": None,
             "link_expires_at": expires_at,
             "shared_by": user_id,
             "shared_at": datetime.utcnow().isoformat()
-        }).eq("id", file_id).execute()
+        }).eq("id", file_id))
+        share_nonce_cache.pop((None, file_data['drive_file_id']))
         
         return {
             "shared_link": public_link,
@@ -451,51 +3684,58 @@ async def shared_share(file_id: str, share_data: ShareFile, user_id: str = Depen
             "message": "File shared successfully"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Share failed: {str(e)}")
 
 @app.get("/user/list-files/{drive_id}")
-async def list_user_files(drive_id: str, folder_id: str = "root", background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(1)
+async def list_user_files(request: Request, drive_id: str, folder_id: str = "root", page_size: int = LIST_DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, stream: bool = False, source: str = "drive", user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
+        drive_data = await data.drive(drive_id, DRIVE_INDEX_COLUMNS)
+        if source == "index":
+            return await list_indexed_folder(drive_data, folder_id, page_size, cursor)
         
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
+        _, service = await data.drive_service(drive_id, DRIVE_INDEX_COLUMNS)
         
         # List files in folder
-        query = f"'{folder_id}' in parents and trashed=false"
-        results = service.files().list(
-            q=query,
-            fields="files(id,name,mimeType,size,modifiedTime,parents)"
-        ).execute()
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
-        
-        return {"files": results.get('files', [])}
+        return await list_folder(service, folder_id, page_size, cursor, stream)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"List files failed: {str(e)}")
 
+@app.post("/user/drives/{drive_id}/sync")
+@limiter.limit("10/minute")
+@weighted_limit(10)
+async def sync_user_drive(request: Request, drive_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    try:
+        drive_data = await data.drive(drive_id, DRIVE_INDEX_COLUMNS)
+        update = await run_blocking("drive", sync_drive_index, drive_data)
+        return {"message": "Drive index synced", "indexed_at": update["indexed_at"]}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Drive sync failed: {str(e)}")
+
 @app.post("/user/upload-file/{drive_id}")
-async def upload_user_file(drive_id: str, file: UploadFile = File(...), folder_id: str = "root", background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(5)
+async def upload_user_file(request: Request, drive_id: str, file: UploadFile = File(...), folder_id: str = "root", deferred: bool = False, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    if deferred:
+        await data.drive(drive_id)
+        return await enqueue_upload_job(file, user_id, drive_id, folder_id)
+    
     try:
         # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
+        drive_data, service = await data.drive_service(drive_id)
         
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
-        
-        # Get user email and create user folder if uploading to root
+        # Resolve (or create once) the user folder if uploading to root
         if folder_id == "root":
-            user_email = get_user_email_from_token(user_id)
-            folder_id = create_user_folder(service, user_email)
+            folder_id = await run_blocking("drive", get_user_folder_id, service, user_id, drive_data)
         
         # Upload file
         file_metadata = {
@@ -503,157 +3743,332 @@ async def upload_user_file(drive_id: str, file: UploadFile = File(...), folder_i
             'parents': [folder_id]
         }
         
-        media = MediaIoBaseUpload(
-            io.BytesIO(await file.read()),
-            mimetype=file.content_type or 'application/octet-stream'
-        )
+        stored = await run_blocking("drive", store_upload, service, file, file_metadata, user_id, drive_id)
         
-        drive_file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id,name,size,mimeType'
-        ).execute()
+        # Identical content already stored here - nothing was transferred
+        existing_file = stored['existing_file']
+        if existing_file:
+            return {
+                "file_id": existing_file['drive_file_id'],
+                "name": existing_file['name'],
+                "size": existing_file['size'],
+                "user_folder_id": folder_id,
+                "deduplicated": stored['deduplicated']
+            }
         
         # Store metadata
-        supabase.table("files").insert({
+        drive_file = stored['drive_file']
+        await run_supabase(supabase.table("files").insert({
             "user_drive_id": drive_id,
             "drive_file_id": drive_file['id'],
             "name": drive_file['name'],
             "type": drive_file.get('mimeType', 'unknown'),
             "size": int(drive_file.get('size', 0)),
+            "content_sha256": stored['content_sha256'],
             "folder_id": folder_id,
             "user_id": user_id,
             "created_at": datetime.utcnow().isoformat()
-        }).execute()
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
+        }))
         
         return {
             "file_id": drive_file['id'],
             "name": drive_file['name'],
             "size": drive_file.get('size', 0),
-            "user_folder_id": folder_id
+            "user_folder_id": folder_id,
+            "deduplicated": stored['deduplicated']
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+@app.get("/upload-jobs")
+@limiter.limit("60/minute")
+async def list_upload_jobs(request: Request, limit: int = 50, user_id: str = Depends(verify_supabase_token)):
+    if not 1 <= limit <= 200:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 200")
+
+    jobs = await run_blocking("disk", upload_jobs.for_user, user_id, limit)
+    return {"jobs": [describe_upload_job(job) for job in jobs]}
+
+@app.get("/upload-jobs/{job_id}")
+@limiter.limit("120/minute")
+async def get_upload_job(request: Request, job_id: str, user_id: str = Depends(verify_supabase_token)):
+    job = await run_blocking("disk", upload_jobs.get, job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return describe_upload_job(job)
+
+@app.post("/user/uploads/{drive_id}")
+async def create_upload_session(drive_id: str, session_data: UploadSessionCreate, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    if session_data.size < 0:
+        raise HTTPException(status_code=400, detail="Invalid upload size")
+
+    try:
+        # Get drive credentials
+        drive_data, service = await data.drive_service(drive_id)
+
+        # Resolve (or create once) the user folder if uploading to root
+        folder_id = session_data.folder_id
+        if folder_id == "root":
+            folder_id = await run_blocking("drive", get_user_folder_id, service, user_id, drive_data)
+
+        # Open the Drive session that chunks will be relayed into
+        session_uri = await run_blocking(
+            "drive",
+            create_drive_upload_session,
+            service,
+            {'name': sanitize_filename(session_data.filename), 'parents': [folder_id]},
+            session_data.size,
+            session_data.mime_type
+        )
+
+        result = await run_supabase(supabase.table("upload_sessions").insert({
+            "user_id": user_id,
+            "user_drive_id": drive_id,
+            "session_uri": encrypt_token(session_uri),
+            "name": sanitize_filename(session_data.filename),
+            "type": session_data.mime_type,
+            "size": session_data.size,
+            "offset": 0,
+            "folder_id": folder_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "expires_at": (datetime.utcnow() + UPLOAD_SESSION_TTL).isoformat()
+        }))
+
+        return {
+            "upload_id": result.data[0]["id"],
+            "offset": 0,
+            "size": session_data.size,
+            "chunk_size": UPLOAD_CHUNK_SIZE
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload session creation failed: {str(e)}")
+
+@app.head("/user/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str, user_id: str = Depends(verify_supabase_token)):
+    try:
+        upload_session, drive_data = await run_blocking("supabase", get_upload_session, upload_id, user_id)
+        service, _ = get_user_drive_service(drive_data)
+
+        # Drive is authoritative for how many bytes were committed
+        try:
+            offset, drive_file = await run_blocking(
+                "drive",
+                put_drive_session_chunk,
+                service, decrypt_token(upload_session['session_uri']), b"", 0, upload_session['size']
+            )
+        except HttpError as e:
+            await run_blocking("supabase", expire_upload_session, upload_session, e)
+
+        if drive_file:
+            await run_blocking("supabase", complete_upload_session, upload_session, drive_file)
+        elif offset != upload_session['offset']:
+            await run_supabase(supabase.table("upload_sessions").update({"offset": offset}).eq("id", upload_id))
+
+        return Response(
+            status_code=200,
+            headers={
+                "Upload-Offset": str(offset),
+                "Upload-Length": str(upload_session['size']),
+                "Cache-Control": "no-store"
+            }
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload status failed: {str(e)}")
+
+@app.patch("/user/uploads/{upload_id}")
+async def append_upload_chunk(upload_id: str, request: Request, user_id: str = Depends(verify_supabase_token)):
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Missing or invalid Upload-Offset header")
+
+    if int(request.headers.get("content-length") or 0) > UPLOAD_SESSION_MAX_CHUNK:
+        raise HTTPException(status_code=413, detail="Chunk too large")
+
+    try:
+        upload_session, drive_data = await run_blocking("supabase", get_upload_session, upload_id, user_id)
+        if offset != upload_session['offset']:
+            raise HTTPException(
+                status_code=409,
+                detail="Upload offset mismatch",
+                headers={"Upload-Offset": str(upload_session['offset'])}
+            )
+
+        chunk = await request.body()
+        chunk_end = offset + len(chunk)
+        if len(chunk) > UPLOAD_SESSION_MAX_CHUNK:
+            raise HTTPException(status_code=413, detail="Chunk too large")
+        if chunk_end > upload_session['size']:
+            raise HTTPException(status_code=400, detail="Chunk exceeds declared upload size")
+        if chunk_end < upload_session['size'] and len(chunk) % UPLOAD_CHUNK_ALIGNMENT:
+            raise HTTPException(status_code=400, detail="Chunks must be a multiple of 256 KiB except the last")
+
+        service, _ = get_user_drive_service(drive_data)
+        try:
+            committed, drive_file = await run_blocking(
+                "drive",
+                put_drive_session_chunk,
+                service, decrypt_token(upload_session['session_uri']), chunk, offset, upload_session['size']
+            )
+        except HttpError as e:
+            await run_blocking("supabase", expire_upload_session, upload_session, e)
+
+        # Metadata is only recorded once the final chunk lands
+        if drive_file:
+            return await run_blocking("supabase", complete_upload_session, upload_session, drive_file)
+
+        await run_supabase(supabase.table("upload_sessions").update({"offset": committed}).eq("id", upload_id))
+        return {"upload_id": upload_id, "offset": committed, "complete": False}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Chunk upload failed: {str(e)}")
+
+@app.delete("/user/uploads/{upload_id}")
+async def cancel_upload_session(upload_id: str, user_id: str = Depends(verify_supabase_token)):
+    try:
+        upload_session, drive_data = await run_blocking("supabase", get_upload_session, upload_id, user_id)
+        service, _ = get_user_drive_service(drive_data)
+
+        # Drive answers 499 once a session is cancelled
+        await run_blocking("drive", service._http.request, decrypt_token(upload_session['session_uri']), method="DELETE")
+        await run_supabase(supabase.table("upload_sessions").delete().eq("id", upload_id))
+
+        return {"message": "Upload cancelled"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Cancel upload failed: {str(e)}")
+
 @app.get("/user/download-file/{drive_id}/{file_id}")
-async def download_user_file(drive_id: str, file_id: str, background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+@weighted_limit(2)
+async def download_user_file(request: Request, drive_id: str, file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
-        
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
-        
-        # Get file metadata
-        file_metadata = service.files().get(fileId=file_id, fields='name').execute()
-        
-        # Download file
-        request = service.files().get_media(fileId=file_id)
-        file_io = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_io, request)
+        drive_data, service = await data.drive_service(drive_id)
         
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
+        # Stream file from Drive (metadata lookup refreshes the token if needed)
+        return await run_blocking("drive", build_download_response, service, file_id, request)
         
-        file_io.seek(0)
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+
+@app.post("/user/archive/{drive_id}")
+@weighted_limit(20)
+async def archive_user_files(request: Request, drive_id: str, archive_request: ArchiveRequest, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    if not archive_request.folder_id and not archive_request.file_ids:
+        raise HTTPException(status_code=400, detail="Provide a folder_id or file_ids")
+    
+    try:
+        # Get drive credentials
+        drive_data, service = await data.drive_service(drive_id)
         
-        return StreamingResponse(
-            io.BytesIO(file_io.read()),
-            media_type='application/octet-stream',
-            headers={"Content-Disposition": f"attachment; filename={file_metadata['name']}"}
+        entries = await run_blocking(
+            "drive", collect_archive_entries, service,
+            archive_request.folder_id, list(dict.fromkeys(archive_request.file_ids))
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Archive failed: {str(e)}")
+    
+    if not entries:
+        raise HTTPException(status_code=404, detail="No downloadable files found")
+    
+    # Built and sent member by member; the total size is not known up front
+    archive_name = (sanitize_filename(archive_request.name) or "archive") + ".zip"
+    return StreamingResponse(
+        stream_archive(service, entries, archive_request.compress),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={archive_name}"}
+    )
 
 @app.delete("/user/delete-file/{drive_id}/{file_id}")
-async def delete_user_file(drive_id: str, file_id: str, background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+async def delete_user_file(drive_id: str, file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
+        drive_data, service = await data.drive_service(drive_id)
         
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
+        reject_stripe(await run_drive(service.files().get(fileId=file_id, fields="appProperties")))
         
         # Delete file
-        service.files().delete(fileId=file_id).execute()
+        await run_drive(service.files().delete(fileId=file_id))
         
         # Delete from database
-        supabase.table("files").delete().eq("drive_file_id", file_id).eq("user_drive_id", drive_id).execute()
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
+        await run_supabase(supabase.table("files").delete().eq("drive_file_id", file_id).eq("user_drive_id", drive_id))
         
         return {"message": "File deleted successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete failed: {str(e)}")
 
 @app.post("/user/share-file/{drive_id}/{file_id}")
-async def share_user_file(drive_id: str, file_id: str, share_data: ShareFile, background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+async def share_user_file(request: Request, drive_id: str, file_id: str, share_data: ShareFile, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
+        drive_data, service = await data.drive_service(drive_id)
+        reject_stripe(await run_drive(service.files().get(fileId=file_id, fields="appProperties")))
         
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
+        if share_data.signed:
+            # The link itself carries access and expiry; no Drive permission is granted
+            public_link, expires_at, nonce = build_signed_share(request, file_id, drive_id, share_data)
+            result = await run_supabase(supabase.table("files").update({
+                "shared_link": public_link,
+                "permission_id": None,
+                "share_nonce": nonce,
+                "link_expires_at": expires_at,
+                "shared_by": user_id,
+                "shared_at": datetime.utcnow().isoformat()
+            }).eq("drive_file_id", file_id).eq("user_drive_id", drive_id))
+            # /s/ checks the nonce on the files row, so a file without one can't get a link
+            if not result.data:
+                raise HTTPException(status_code=404, detail="File not found")
+            share_nonce_cache.set((drive_id, file_id), nonce)
+            return {
+                "shared_link": public_link,
+                "permission_id": None,
+                "expires_at": expires_at,
+                "message": "File shared successfully"
+            }
         
         # Create permission with proper settings
-        permission = {
-            'role': 'reader' if share_data.allow_view else 'writer',
-            'type': 'anyone'
-        }
-        
-        if share_data.expires_in_days:
-            expiration_time = datetime.utcnow() + timedelta(days=share_data.expires_in_days)
-            permission['expirationTime'] = expiration_time.isoformat() + 'Z'
+        permission, expires_at = build_share_permission(share_data)
         
-        permission_result = service.permissions().create(
+        permission_result = await run_drive(service.permissions().create(
             fileId=file_id,
             body=permission,
             fields='id'
-        ).execute()
+        ))
         
         # Generate appropriate link
-        if share_data.allow_download:
-            public_link = f"https://drive.google.com/uc?id={file_id}&export=download"
-        else:
-            public_link = f"https://drive.google.com/file/d/{file_id}/view"
-        
-        # Calculate expiration date
-        expires_at = None
-        if share_data.expires_in_days:
-            expires_at = (datetime.utcnow() + timedelta(days=share_data.expires_in_days)).isoformat()
+        public_link = build_share_link(file_id, share_data)
         
         # Update database with comprehensive sharing info
-        supabase.table("files").update({
+        await run_supabase(supabase.table("files").update({
             "shared_link": public_link,
             "permission_id": permission_result['id'],
+            "share_nonce": None,
             "link_expires_at": expires_at,
             "shared_by": user_id,
             "shared_at": datetime.utcnow().isoformat()
-        }).eq("drive_file_id", file_id).eq("user_drive_id", drive_id).execute()
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
+        }).eq("drive_file_id", file_id).eq("user_drive_id", drive_id))
+        share_nonce_cache.pop((drive_id, file_id))
         
         return {
             "shared_link": public_link,
@@ -662,92 +4077,270 @@ async def share_user_file(drive_id: str, file_id: str, share_data: ShareFile, ba
             "message": "File shared successfully"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Share failed: {str(e)}")
 
 @app.post("/shared/revoke/{file_id}")
-async def revoke_shared_link(file_id: str, user_id: str = Depends(verify_supabase_token)):
+async def revoke_shared_link(file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
         # Get file metadata
-        result = supabase.table("files").select("*").eq("id", file_id).execute()
-        if not result.data:
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        file_data = result.data[0]
-        if not file_data.get('permission_id'):
+        file_data = await data.file(file_id, "drive_file_id,permission_id,share_nonce")
+        if not file_data.get('permission_id') and not file_data.get('share_nonce'):
             raise HTTPException(status_code=400, detail="No active share found")
         
-        drive_service = get_drive_service()
-        
-        # Remove permission from Google Drive
-        drive_service.permissions().delete(
-            fileId=file_data['drive_file_id'],
-            permissionId=file_data['permission_id']
-        ).execute()
+        # Remove permission from Google Drive (signed links have none)
+        if file_data.get('permission_id'):
+            await run_drive(get_drive_service().permissions().delete(
+                fileId=file_data['drive_file_id'],
+                permissionId=file_data['permission_id']
+            ))
         
-        # Clear sharing info in database
-        supabase.table("files").update({
+        # Clear sharing info in database; a cleared nonce stops signed links
+        await run_supabase(supabase.table("files").update({
             "shared_link": None,
             "permission_id": None,
+            "share_nonce": None,
             "link_expires_at": None,
             "revoked_at": datetime.utcnow().isoformat(),
             "revoked_by": user_id
-        }).eq("id", file_id).execute()
+        }).eq("id", file_id))
+        share_nonce_cache.pop((None, file_data['drive_file_id']))
         
         return {"message": "Share link revoked successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Revoke failed: {str(e)}")
 
 @app.post("/user/revoke/{drive_id}/{file_id}")
-async def revoke_user_share(drive_id: str, file_id: str, background_tasks: BackgroundTasks = BackgroundTasks(), user_id: str = Depends(verify_supabase_token)):
+async def revoke_user_share(drive_id: str, file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
     try:
-        # Get drive credentials
-        drive_result = supabase.table("user_drives").select("*").eq("id", drive_id).eq("user_id", user_id).execute()
-        if not drive_result.data:
-            raise HTTPException(status_code=404, detail="Drive not found")
-        
-        # Get file metadata
-        file_result = supabase.table("files").select("*").eq("drive_file_id", file_id).eq("user_drive_id", drive_id).execute()
-        if not file_result.data:
+        # Get file metadata (also confirms the drive belongs to the user)
+        file_data = (await data.drive_files(drive_id, [file_id], "permission_id,share_nonce")).get(file_id)
+        if not file_data:
             raise HTTPException(status_code=404, detail="File not found")
         
-        file_data = file_result.data[0]
-        if not file_data.get('permission_id'):
+        if not file_data.get('permission_id') and not file_data.get('share_nonce'):
             raise HTTPException(status_code=400, detail="No active share found")
         
-        drive_data = drive_result.data[0]
-        service, credentials = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
-        
-        # Remove permission from Google Drive
-        service.permissions().delete(
-            fileId=file_id,
-            permissionId=file_data['permission_id']
-        ).execute()
+        # Remove permission from Google Drive (signed links have none)
+        if file_data.get('permission_id'):
+            _, service = await data.drive_service(drive_id)
+            await run_drive(service.permissions().delete(
+                fileId=file_id,
+                permissionId=file_data['permission_id']
+            ))
         
-        # Clear sharing info in database
-        supabase.table("files").update({
+        # Clear sharing info in database; a cleared nonce stops signed links
+        await run_supabase(supabase.table("files").update({
             "shared_link": None,
             "permission_id": None,
+            "share_nonce": None,
             "link_expires_at": None,
             "revoked_at": datetime.utcnow().isoformat(),
             "revoked_by": user_id
-        }).eq("drive_file_id", file_id).eq("user_drive_id", drive_id).execute()
-        
-        # Check if token was refreshed
-        if credentials.token != drive_data['access_token']:
-            background_tasks.add_task(refresh_user_token, drive_id, credentials)
+        }).eq("drive_file_id", file_id).eq("user_drive_id", drive_id))
+        share_nonce_cache.pop((drive_id, file_id))
         
         return {"message": "Share link revoked successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Revoke failed: {str(e)}")
 
+@app.post("/user/bulk/{drive_id}")
+@weighted_limit(10)
+async def bulk_user_files(request: Request, drive_id: str, operation: BulkFileOperation, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    if operation.action not in BULK_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported action, expected one of: {', '.join(BULK_ACTIONS)}")
+    
+    file_ids = list(dict.fromkeys(operation.file_ids))
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="No files given")
+    if len(file_ids) > BULK_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_FILES} files per request")
+    if operation.action == "share" and operation.share and operation.share.signed:
+        # Bulk shares grant Drive permissions; signed links are minted per file
+        raise HTTPException(status_code=400, detail="Signed links can't be created in bulk, use /user/share-file")
+    
+    try:
+        # Get drive credentials once for the whole batch
+        drive_data, service = await data.drive_service(drive_id)
+        
+        results = await run_blocking(
+            "drive", run_bulk_operation, service, drive_id, user_id,
+            operation.action, file_ids, operation.share or ShareFile()
+        )
+        succeeded = sum(1 for result in results if result["status"] == "ok")
+        
+        return {
+            "action": operation.action,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Bulk {operation.action} failed: {str(e)}")
+
+@app.post("/user/pooled/upload")
+@weighted_limit(5)
+async def upload_pooled_file(request: Request, file: UploadFile = File(...), striped: bool = False, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    try:
+        size = await run_blocking("disk", file.file.seek, 0, os.SEEK_END)
+        pool = await pool_headroom(data)
+        if not pool:
+            raise HTTPException(status_code=503, detail="No connected drive is reachable")
+        name = sanitize_filename(file.filename)
+        content_type = file.content_type or 'application/octet-stream'
+
+        if striped and size > STRIPE_SIZE and len(pool) > 1:
+            stripes = plan_stripes(size, pool)
+            for stripe in stripes:
+                reserve_drive_space(stripe['drive_id'], stripe['size'])
+            targets = {drive_data['id']: (drive_data, service) for _, drive_data, service in pool}
+
+            # Hashing and the stripe uploads read the same spool file independently
+            fileno = await run_blocking("disk", file.file.fileno)
+            (content_sha256, _), stored = await asyncio.gather(
+                run_blocking("disk", hash_upload, file),
+                upload_stripes(fileno, content_type, name, stripes, targets, user_id)
+            )
+
+            try:
+                result = await run_supabase(supabase.table("files").insert({
+                    "user_drive_id": stored[0]['drive_id'],
+                    "drive_file_id": stored[0]['drive_file_id'],
+                    "name": name,
+                    "type": content_type,
+                    "size": size,
+                    "content_sha256": content_sha256,
+                    "folder_id": stored[0]['folder_id'],
+                    "stripes": [
+                        {key: stripe[key] for key in ("drive_id", "drive_file_id", "offset", "size")}
+                        for stripe in stored
+                    ],
+                    "user_id": user_id,
+                    "created_at": datetime.utcnow().isoformat()
+                }))
+            except Exception:
+                await delete_stripes(stored, {drive_id: service for drive_id, (_, service) in targets.items()})
+                raise
+
+            return {
+                "file_id": result.data[0]['id'],
+                "name": name,
+                "size": size,
+                "striped": True,
+                "drive_ids": list(dict.fromkeys(stripe['drive_id'] for stripe in stored))
+            }
+
+        headroom, drive_data, service = pool[0]
+        if headroom < size:
+            raise HTTPException(status_code=507, detail="Not enough free space on any connected drive")
+        reserve_drive_space(drive_data['id'], size)
+
+        folder_id = await run_blocking("drive", get_user_folder_id, service, user_id, drive_data)
+        stored = await run_blocking("drive", store_upload, service, file, {'name': name, 'parents': [folder_id]}, user_id, drive_data['id'])
+
+        existing_file = stored['existing_file']
+        if existing_file:
+            # Nothing was written, so give the reservation back
+            reserve_drive_space(drive_data['id'], -size)
+            return {
+                "file_id": existing_file['id'],
+                "drive_id": drive_data['id'],
+                "drive_file_id": existing_file['drive_file_id'],
+                "name": existing_file['name'],
+                "size": existing_file['size'],
+                "striped": False,
+                "deduplicated": stored['deduplicated']
+            }
+
+        drive_file = stored['drive_file']
+        result = await run_supabase(supabase.table("files").insert({
+            "user_drive_id": drive_data['id'],
+            "drive_file_id": drive_file['id'],
+            "name": drive_file['name'],
+            "type": drive_file.get('mimeType', 'unknown'),
+            "size": int(drive_file.get('size', 0)),
+            "content_sha256": stored['content_sha256'],
+            "folder_id": folder_id,
+            "user_id": user_id,
+            "created_at": datetime.utcnow().isoformat()
+        }))
+
+        return {
+            "file_id": result.data[0]['id'],
+            "drive_id": drive_data['id'],
+            "drive_file_id": drive_file['id'],
+            "name": drive_file['name'],
+            "size": drive_file.get('size', 0),
+            "striped": False,
+            "deduplicated": stored['deduplicated']
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+
+@app.get("/user/pooled/download/{file_id}")
+@weighted_limit(2)
+async def download_pooled_file(request: Request, file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    try:
+        file_data = await data.file(file_id, POOLED_FILE_COLUMNS)
+        if file_data['user_id'] != user_id or not file_data.get('user_drive_id'):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        if not file_data.get('stripes'):
+            _, service = await data.drive_service(file_data['user_drive_id'])
+            return await run_blocking("drive", build_download_response, service, file_data['drive_file_id'], request, file_data['name'])
+
+        drive_ids = list(dict.fromkeys(stripe['drive_id'] for stripe in file_data['stripes']))
+        connected = await asyncio.gather(*(data.drive_service(drive_id) for drive_id in drive_ids))
+        services = {drive_id: service for drive_id, (_, service) in zip(drive_ids, connected)}
+        return build_striped_response(file_data, services, request)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+
+@app.delete("/user/pooled/{file_id}")
+async def delete_pooled_file(file_id: str, user_id: str = Depends(verify_supabase_token), data: RequestData = Depends(get_request_data)):
+    try:
+        file_data = await data.file(file_id, POOLED_FILE_COLUMNS)
+        if file_data['user_id'] != user_id or not file_data.get('user_drive_id'):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        stripes = file_data.get('stripes') or [{"drive_id": file_data['user_drive_id'], "drive_file_id": file_data['drive_file_id']}]
+        drive_ids = list(dict.fromkeys(stripe['drive_id'] for stripe in stripes))
+        connected = await asyncio.gather(*(data.drive_service(drive_id) for drive_id in drive_ids))
+        await delete_stripes(stripes, {drive_id: service for drive_id, (_, service) in zip(drive_ids, connected)})
+
+        await run_supabase(supabase.table("files").delete().eq("id", file_id))
+
+        return {"message": "File deleted successfully"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Delete failed: {str(e)}")
+
 @app.get("/user/shared-files")
 async def get_user_shared_files(user_id: str = Depends(verify_supabase_token)):
     try:
-        result = supabase.table("files").select("*").eq("shared_by", user_id).not_.is_("shared_link", "null").execute()
+        result = await run_supabase(supabase.table("files").select(FILE_SUMMARY_COLUMNS).eq("shared_by", user_id).not_.is_("shared_link", "null"))
         return {"shared_files": result.data}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get shared files: {str(e)}")
 
@@ -758,10 +4351,58 @@ async def share_file(file_id: str, user_id: str = Depends(verify_supabase_token)
 
 @app.get("/search")
 @limiter.limit("60/minute")
-async def search_files(request: Request, q: str, user_id: str = Depends(verify_supabase_token)):
+async def search_files(
+    request: Request,
+    q: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    file_type: Optional[str] = Query(None, alias="type"),
+    min_size: Optional[int] = None,
+    max_size: Optional[int] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    user_id: str = Depends(verify_supabase_token)
+):
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {SEARCH_MAX_LIMIT}")
+
+    tsquery = build_prefix_tsquery(q)
+    if not tsquery:
+        return {"files": [], "next_cursor": None}
+
+    # Offsets only line up with the same query and filters
+    fingerprint = search_fingerprint(q, file_type, min_size, max_size, created_after, created_before)
+    offset = 0
+    if cursor:
+        state = decode_cursor(cursor)
+        if state.get('search') != fingerprint or not isinstance(state.get('offset'), int):
+            raise HTTPException(status_code=400, detail="Cursor does not belong to this search")
+        offset = state['offset']
+    if offset > SEARCH_MAX_OFFSET:
+        raise HTTPException(status_code=400, detail="Search too deep, refine the query")
+
     try:
-        files_result = supabase.table("files").select("*").ilike("name", f"%{q}%").execute()
-        return {"files": files_result.data}
+        # Ask for one extra row to know whether another page exists
+        files_result = await run_supabase(supabase.rpc("search_user_files", {
+            "p_user_id": user_id,
+            "p_query": escape_like(q.strip()),
+            "p_tsquery": tsquery,
+            "p_limit": limit + 1,
+            "p_offset": offset,
+            "p_type": escape_like(file_type) if file_type else None,
+            "p_min_size": min_size,
+            "p_max_size": max_size,
+            "p_created_after": created_after.isoformat() if created_after else None,
+            "p_created_before": created_before.isoformat() if created_before else None
+        }))
+        files = files_result.data
+        has_more = len(files) > limit
+        return {
+            "files": files[:limit],
+            "next_cursor": encode_cursor({"search": fingerprint, "offset": offset + limit}) if has_more else None
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
@@ -769,8 +4410,10 @@ async def search_files(request: Request, q: str, user_id: str = Depends(verify_s
 @limiter.limit("30/minute")
 async def get_recent_files(request: Request, limit: int = 20, user_id: str = Depends(verify_supabase_token)):
     try:
-        files_result = supabase.table("files").select("*").order("created_at", desc=True).limit(limit).execute()
+        files_result = await run_supabase(supabase.table("files").select(FILE_SUMMARY_COLUMNS).order("created_at", desc=True).limit(limit))
         return {"files": files_result.data}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get recent files: {str(e)}")
 
@@ -778,7 +4421,7 @@ async def get_recent_files(request: Request, limit: int = 20, user_id: str = Dep
 @limiter.limit("30/minute")
 async def get_favorites(request: Request, user_id: str = Depends(verify_supabase_token)):
     try:
-        result = supabase.table("files").select("*").eq("shared_by", user_id).limit(10).execute()
+        result = await run_supabase(supabase.table("files").select(FILE_SUMMARY_COLUMNS).eq("shared_by", user_id).limit(10))
         return {"files": result.data}
     except Exception as e:
         return {"files": []}
@@ -814,47 +4457,134 @@ async def suggest_tags(request: Request, file_data: dict, user_id: str = Depends
         return {"tags": []}
 
 # Background task to clean up expired links
+CLEANUP_ENABLED = os.getenv("CLEANUP_ENABLED", "true").lower() == "true"
+CLEANUP_INTERVAL = int(os.getenv("CLEANUP_INTERVAL", "300"))
+CLEANUP_MAX_ROWS = int(os.getenv("CLEANUP_MAX_ROWS", "5000"))
+CLEANUP_DRIVE_CONCURRENCY = int(os.getenv("CLEANUP_DRIVE_CONCURRENCY", "8"))
+
+cleanup_metrics = {
+    "runs": 0,
+    "rows_processed": 0,
+    "failures": 0,
+    "last_run_at": None,
+    "last_run_seconds": None,
+    "last_run_processed": 0,
+    "last_run_failures": 0
+}
+cleanup_runs = metrics.register(Counter("cleanup_runs_total", "Expired link cleanup runs"))
+cleanup_rows = metrics.register(Counter("cleanup_rows_total", "Expired links handled by cleanup, by outcome", ("outcome",)))
+cleanup_duration = metrics.register(Gauge("cleanup_last_run_seconds", "Duration of the last expired link cleanup run"))
+cleanup_last_run = metrics.register(Gauge("cleanup_last_run_timestamp_seconds", "Unix time the last expired link cleanup run finished"))
+
+def cleanup_drive_group(drive_id: Optional[str], expired_rows: list, current_time: str):
+    """Revoke the expired shares of one drive in batches and clear them in bulk"""
+    if drive_id:
+        # User drive files
+        drive_result = execute_supabase(supabase.table("user_drives").select("id,access_token,refresh_token,token_expires_at").eq("id", drive_id))
+        drive_data = drive_result.data[0] if drive_result.data else None
+        service = get_user_drive_service(drive_data)[0] if drive_data else None
+    else:
+        # Shared drive files
+        service = get_drive_service()
+
+    rows_by_request = {str(row['id']): row for row in expired_rows}
+    to_revoke = [
+        (request_id, service.permissions().delete(fileId=row['drive_file_id'], permissionId=row['permission_id']))
+        for request_id, row in rows_by_request.items()
+        if service and row.get('permission_id')
+    ]
+    results = execute_drive_batch(service, to_revoke) if to_revoke else {}
+
+    cleared, failures = [], 0
+    for request_id, row in rows_by_request.items():
+        _, exception = results.get(request_id, (None, None))
+        # A permission that is already gone counts as revoked
+        if exception is None or (isinstance(exception, HttpError) and exception.resp.status == 404):
+            cleared.append(row['id'])
+        else:
+            failures += 1
+            print(f"Failed to cleanup expired link for file {row['id']}: {exception}")
+
+    # Clear sharing info
+    if cleared:
+        execute_supabase(supabase.table("files").update({
+            "shared_link": None,
+            "permission_id": None,
+            "share_nonce": None,
+            "expired_at": current_time
+        }).in_("id", cleared))
+    return len(cleared), failures
+
 async def cleanup_expired_links():
+    started = time.monotonic()
+    processed, failures = 0, 0
     try:
         current_time = datetime.utcnow().isoformat()
-        expired_files = supabase.table("files").select("*").lt("link_expires_at", current_time).not_.is_("shared_link", "null").execute()
+        expired_files = await run_supabase(
+            supabase.table("files").select("id,drive_file_id,permission_id,user_drive_id")
+            .lt("link_expires_at", current_time)
+            .not_.is_("shared_link", "null")
+            .limit(CLEANUP_MAX_ROWS)
+        )
         
+        rows_by_drive = {}
         for file_data in expired_files.data:
-            try:
-                if file_data.get('user_drive_id'):
-                    # User drive file
-                    drive_result = supabase.table("user_drives").select("*").eq("id", file_data['user_drive_id']).execute()
-                    if drive_result.data:
-                        drive_data = drive_result.data[0]
-                        service, _ = get_user_drive_service(drive_data['access_token'], drive_data['refresh_token'])
-                        service.permissions().delete(
-                            fileId=file_data['drive_file_id'],
-                            permissionId=file_data['permission_id']
-                        ).execute()
-                else:
-                    # Shared drive file
-                    drive_service = get_drive_service()
-                    drive_service.permissions().delete(
-                        fileId=file_data['drive_file_id'],
-                        permissionId=file_data['permission_id']
-                    ).execute()
-                
-                # Clear sharing info
-                supabase.table("files").update({
-                    "shared_link": None,
-                    "permission_id": None,
-                    "expired_at": current_time
-                }).eq("id", file_data['id']).execute()
-                
-            except Exception as e:
-                print(f"Failed to cleanup expired link for file {file_data['id']}: {e}")
+            rows_by_drive.setdefault(file_data.get('user_drive_id'), []).append(file_data)
+        
+        drive_slots = asyncio.Semaphore(CLEANUP_DRIVE_CONCURRENCY)
+        
+        async def cleanup_group(drive_id, rows):
+            async with drive_slots:
+                return await run_blocking("drive", cleanup_drive_group, drive_id, rows, current_time)
+        
+        results = await asyncio.gather(
+            *(cleanup_group(drive_id, rows) for drive_id, rows in rows_by_drive.items()),
+            return_exceptions=True
+        )
+        for (drive_id, rows), result in zip(rows_by_drive.items(), results):
+            if isinstance(result, Exception):
+                failures += len(rows)
+                print(f"Cleanup failed for drive {drive_id or 'shared'}: {result}")
+            else:
+                processed += result[0]
+                failures += result[1]
                 
     except Exception as e:
         print(f"Cleanup task failed: {e}")
+    finally:
+        cleanup_metrics["runs"] += 1
+        cleanup_metrics["rows_processed"] += processed
+        cleanup_metrics["failures"] += failures
+        cleanup_metrics["last_run_at"] = datetime.utcnow().isoformat()
+        cleanup_metrics["last_run_seconds"] = round(time.monotonic() - started, 3)
+        cleanup_metrics["last_run_processed"] = processed
+        cleanup_metrics["last_run_failures"] = failures
+        cleanup_runs.inc()
+        cleanup_rows.inc(("cleared",), processed)
+        cleanup_rows.inc(("failed",), failures)
+        cleanup_duration.set((), cleanup_metrics["last_run_seconds"])
+        cleanup_last_run.set((), time.time())
+        if processed or failures:
+            print(f"Expired link cleanup: {processed} cleared, {failures} failed")
+
+async def purge_upload_sessions():
+    """Drop resumable upload sessions past their expiry that clients never finished"""
+    try:
+        await run_supabase(supabase.table("upload_sessions").delete().lt("expires_at", datetime.utcnow().isoformat()))
+    except Exception as e:
+        print(f"Upload session purge failed: {e}")
+
+if CLEANUP_ENABLED:
+    schedule_job("expired-link-cleanup", CLEANUP_INTERVAL, cleanup_expired_links)
+    schedule_job("upload-session-purge", 3600, purge_upload_sessions)
 
 # Security middleware disabled for deployment
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["reencrypt-tokens"]:
+        print(f"Re-encrypted tokens of {reencrypt_stored_tokens()} drives")
+        sys.exit(0)
+
     import uvicorn
     # Use HTTPS in production
     ssl_keyfile = os.getenv("SSL_KEYFILE")
@@ -0,0 +1,49 @@
+-- Indexed, per-user file name search used by GET /search.
+--
+-- Names are tokenized into a stored tsvector (separators like "." "_" "-"
+-- split words) for ranked prefix matching, and a trigram index serves
+-- substring matches. Both are always combined with a user_id filter.
+
+create extension if not exists pg_trgm;
+
+alter table files
+    add column if not exists name_search tsvector
+    generated always as (
+        to_tsvector('simple', regexp_replace(coalesce(name, ''), '[._\-]+', ' ', 'g'))
+    ) stored;
+
+create index if not exists files_name_search_idx on files using gin (name_search);
+create index if not exists files_name_trgm_idx on files using gin (name gin_trgm_ops);
+create index if not exists files_user_id_created_at_idx on files (user_id, created_at desc);
+
+create or replace function search_user_files(
+    p_user_id uuid,
+    p_query text,
+    p_tsquery text,
+    p_limit integer default 20,
+    p_offset integer default 0,
+    p_type text default null,
+    p_min_size bigint default null,
+    p_max_size bigint default null,
+    p_created_after timestamptz default null,
+    p_created_before timestamptz default null
+)
+returns setof files
+language sql
+stable
+as $$
+    select f.*
+    from files f
+    where f.user_id = p_user_id
+      and (f.name_search @@ to_tsquery('simple', p_tsquery) or f.name ilike '%' || p_query || '%')
+      and (p_type is null or f.type like p_type || '%')
+      and (p_min_size is null or f.size >= p_min_size)
+      and (p_max_size is null or f.size <= p_max_size)
+      and (p_created_after is null or f.created_at >= p_created_after)
+      and (p_created_before is null or f.created_at < p_created_before)
+    order by ts_rank(f.name_search, to_tsquery('simple', p_tsquery)) + similarity(f.name, p_query) desc,
+             f.created_at desc,
+             f.id
+    limit least(p_limit, 101)
+    offset p_offset;
+$$;
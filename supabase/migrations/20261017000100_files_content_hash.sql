@@ -0,0 +1,9 @@
+-- Content hashes for upload deduplication (see store_upload in main.py).
+-- Lookups are always scoped to the owning user and a drive (the shared
+-- drive when user_drive_id is null).
+
+alter table files add column if not exists content_sha256 text;
+
+create index if not exists files_drive_content_sha256_idx
+    on files (user_id, content_sha256, user_drive_id)
+    where content_sha256 is not null;
@@ -0,0 +1,24 @@
+-- Records the result of a bulk share (POST /user/bulk/{drive_id}) in one
+-- statement. Each element of p_shares carries drive_file_id, shared_link
+-- and permission_id; the remaining share fields are the same for all rows.
+
+create or replace function record_file_shares(
+    p_user_drive_id uuid,
+    p_shares jsonb,
+    p_link_expires_at timestamptz default null,
+    p_shared_by uuid default null,
+    p_shared_at timestamptz default now()
+)
+returns void
+language sql
+as $$
+    update files f
+    set shared_link = s.shared_link,
+        permission_id = s.permission_id,
+        link_expires_at = p_link_expires_at,
+        shared_by = p_shared_by,
+        shared_at = p_shared_at
+    from jsonb_to_recordset(p_shares) as s(drive_file_id text, shared_link text, permission_id text)
+    where f.user_drive_id = p_user_drive_id
+      and f.drive_file_id = s.drive_file_id;
+$$;
@@ -0,0 +1,6 @@
+-- Pooled storage striping (see upload_pooled_file in main.py).
+-- A striped file keeps one row: user_drive_id/drive_file_id point at the
+-- first stripe and stripes lists every piece in order as
+-- {"drive_id", "drive_file_id", "offset", "size"}. Unstriped files leave it null.
+
+alter table files add column if not exists stripes jsonb;
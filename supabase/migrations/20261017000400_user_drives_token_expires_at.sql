@@ -0,0 +1,5 @@
+-- Access token expiry for connected drives (see persist_user_tokens and
+-- ManagedUserCredentials in main.py). Tokens are refreshed shortly before
+-- this time; rows left null keep using their token until Drive rejects it.
+
+alter table user_drives add column if not exists token_expires_at timestamptz;
@@ -0,0 +1,5 @@
+-- Drive folder that uploads to a connected drive go into (see
+-- get_user_folder_id in main.py). Filled in on first upload and replaced
+-- when the folder is gone from Drive; null means not created yet.
+
+alter table user_drives add column if not exists user_folder_id text;
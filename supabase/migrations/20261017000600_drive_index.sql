@@ -0,0 +1,28 @@
+-- Metadata mirror of connected drives (see full_index_drive and
+-- apply_drive_changes in main.py), read by the indexed folder listing.
+--
+-- A full rebuild upserts every listed file under a new generation and then
+-- prunes rows of older generations; rows added from the Changes feed keep
+-- the default until the next rebuild. Listings filter on user_drive_id and
+-- parents @> array[folder_id].
+
+create table if not exists drive_index (
+    user_drive_id uuid not null references user_drives (id) on delete cascade,
+    drive_file_id text not null,
+    name text,
+    parents text[] not null default '{}',
+    size bigint,
+    mime_type text,
+    modified_time timestamptz,
+    generation text not null default '',
+    primary key (user_drive_id, drive_file_id)
+);
+
+create index if not exists drive_index_parents_idx on drive_index using gin (parents);
+
+-- Sync state: the Changes API token to resume from, the drive's real root
+-- folder ID (listings ask for "root") and when the last sync ran.
+alter table user_drives
+    add column if not exists changes_page_token text,
+    add column if not exists root_folder_id text,
+    add column if not exists indexed_at timestamptz;
@@ -0,0 +1,23 @@
+-- Client-driven resumable uploads (POST/PATCH/DELETE /user/uploads in
+-- main.py). session_uri is the Drive resumable session, encrypted like the
+-- drive tokens; offset is the last byte count Drive confirmed.
+--
+-- Drive forgets session URIs after a week, so rows expire with them and
+-- purge_upload_sessions deletes the ones clients abandoned.
+
+create table if not exists upload_sessions (
+    id uuid primary key default gen_random_uuid(),
+    user_id uuid not null references auth.users (id) on delete cascade,
+    user_drive_id uuid not null references user_drives (id) on delete cascade,
+    session_uri text not null,
+    name text not null,
+    type text,
+    size bigint not null,
+    "offset" bigint not null default 0,
+    folder_id text,
+    created_at timestamptz not null default now(),
+    expires_at timestamptz not null default now() + interval '7 days'
+);
+
+create index if not exists upload_sessions_user_id_idx on upload_sessions (user_id);
+create index if not exists upload_sessions_expires_at_idx on upload_sessions (expires_at);
@@ -0,0 +1,7 @@
+-- Revocable signed share links (see build_signed_share and GET /s/{token}
+-- in main.py). Every signed share gets a fresh random nonce that is also
+-- signed into its links; a link only works while it matches this column.
+-- Revoking a share, letting it expire, or signing a new link for the file
+-- replaces or clears it.
+
+alter table files add column if not exists share_nonce text;